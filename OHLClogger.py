@@ -1,22 +1,17 @@
-import os
-import csv
-from datetime import date
+from ohlc import OHLCLog as _OHLCLog
 
 
-class OHLCLog():
-    def __init__(self, symbol=''):
-        tod = date.today()
-        self.filename = "{}OHLC{}.csv".format(symbol, tod.strftime("%d%b%y"))
-        if os.path.exists('./'+self.filename) == False:
-            with open(self.filename, 'w') as f:
-                fields = ['time', 'symbol', 'ltp', 'atp',
-                          'open', 'high', 'low', 'close']
-                writer = csv.DictWriter(f, fieldnames=fields)
-                writer.writeheader()
+class OHLCLog(_OHLCLog):
+    '''Single symbol logger writing {symbol}OHLC{date}.csv, see ohlc.OHLCLog
+
+    Callers of this legacy logger never close it, so by default every row
+    is written as soon as it is logged. Pass max_rows > 1 to buffer, and
+    then call poll() and close().'''
+
+    def __init__(self, symbol='', max_rows=1, max_delay=1.0):
+        _OHLCLog.__init__(self, symbol, max_rows, max_delay,
+                          pattern='{symbol}OHLC{date}.csv')
+        self.filename = self.file_for(symbol, self.tod)
 
     def logOHLC(self, ohlc_data):
-        with open(self.filename, 'a') as f:
-            fields = ['time', 'symbol', 'ltp', 'atp',
-                      'open', 'high', 'low', 'close']
-            writer = csv.DictWriter(f, fieldnames=fields)
-            writer.writerow(ohlc_data)
+        self.logohlc(ohlc_data)
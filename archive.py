@@ -0,0 +1,373 @@
+'''End of day compaction of ticks into compressed columnar files.
+
+Layout, one file per trading day and underlying:
+
+    archive/YYYYMMDD/NIFTY.tcol
+
+A file holds row groups of at most ROW_GROUP ticks of one symbol. Every
+column of a group is stored as its own zlib block (ts delta encoded first),
+and a JSON footer lists the groups with their symbol, row count, min/max ts
+and ltp and the offset of each column block. Readers load the footer, skip
+groups whose symbol or time range does not match and decompress only the
+requested columns.
+
+    python archive.py stock_db.sqlite 2018-02-01 --delete
+
+ColumnStore reads the files back with the get_ticks/iter_ticks interface of
+StockDB; StockDB.attach_archive() makes StockDB queries include them.
+'''
+
+import argparse
+from datetime import datetime, date, timedelta
+import json
+import os
+import struct
+import zlib
+from stockdb import tick_columns, to_epoch_ms, join_columns
+from utils import parse_symbol, print_l
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MAGIC = b'TCOL0001'
+TRAILER = struct.Struct('<Q8s')
+ROW_GROUP = 65536
+COLUMN_TYPES = {'ts': '<i8'}
+
+
+def day_span(day):
+    'Epoch ms of local midnight at the start and end of day'
+    if isinstance(day, str):
+        day = datetime.strptime(day.replace('-', ''), '%Y%m%d')
+    day = datetime(day.year, day.month, day.day)
+    return (int(day.timestamp() * 1000),
+            int((day + timedelta(days=1)).timestamp() * 1000))
+
+
+def _day_key(ts):
+    return datetime.fromtimestamp(ts / 1000.0).strftime('%Y%m%d')
+
+
+def _encode(name, col):
+    col = np.ascontiguousarray(col, dtype=COLUMN_TYPES.get(name, '<f8'))
+    if name == 'ts' and len(col):
+        col = np.diff(col, prepend=col[:1] * 0)
+    return zlib.compress(col.tobytes(), 6)
+
+
+def _decode(name, data):
+    col = np.frombuffer(zlib.decompress(data),
+                        dtype=COLUMN_TYPES.get(name, '<f8'))
+    if name == 'ts':
+        col = np.cumsum(col)
+    return col
+
+
+def write_partition(path, symbols, row_group=ROW_GROUP):
+    '''Writes {symbol: {field: array}} tick columns to one .tcol file.
+
+    Rows of each symbol must be in time order. The file is written under a
+    temporary name and renamed, so readers never see a partial file.
+    Returns the number of rows written.'''
+    if np is None:
+        raise ImportError('archive requires numpy')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    groups = []
+    total = 0
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        for symbol in sorted(symbols):
+            cols = symbols[symbol]
+            rows = len(cols['ts'])
+            for a in range(0, rows, row_group):
+                b = min(a + row_group, rows)
+                ts = cols['ts'][a:b]
+                ltp = cols['ltp'][a:b]
+                group = {'symbol': symbol, 'rows': b - a,
+                         'ts': [int(ts[0]), int(ts[-1])],
+                         'ltp': [float(np.min(ltp)), float(np.max(ltp))],
+                         'chunks': {}}
+                for name in tick_columns:
+                    block = _encode(name, cols[name][a:b])
+                    group['chunks'][name] = [f.tell(), len(block)]
+                    f.write(block)
+                groups.append(group)
+            total += rows
+        footer = json.dumps({'columns': list(tick_columns),
+                             'groups': groups}).encode()
+        f.write(footer)
+        f.write(TRAILER.pack(len(footer), MAGIC))
+    os.replace(tmp, path)
+    return total
+
+
+def read_footer(path):
+    with open(path, 'rb') as f:
+        f.seek(-TRAILER.size, os.SEEK_END)
+        size, magic = TRAILER.unpack(f.read(TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError('Not a tick archive: {}'.format(path))
+        f.seek(-TRAILER.size - size, os.SEEK_END)
+        return json.loads(f.read(size).decode())
+
+
+class ColumnStore:
+    '''Reader for an archive directory.
+
+    groups_read and groups_skipped count row groups decoded and skipped
+    through their statistics.
+    '''
+
+    def __init__(self, root='archive'):
+        self.root = root
+        self.footers = {}
+        self.groups_read = 0
+        self.groups_skipped = 0
+
+    def days(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(d for d in os.listdir(self.root)
+                      if d.isdigit() and len(d) == 8)
+
+    def path(self, day, underlying):
+        return os.path.join(self.root, day, '{}.tcol'.format(underlying))
+
+    def footer(self, path):
+        'Footer of path, cached until the file changes'
+        mtime = os.path.getmtime(path)
+        cached = self.footers.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = self.footers[path] = (mtime, read_footer(path))
+        return cached[1]
+
+    def symbols(self, day):
+        'Symbols archived for day (YYYYMMDD)'
+        found = set()
+        folder = os.path.join(self.root, day)
+        for name in os.listdir(folder):
+            if name.endswith('.tcol'):
+                for g in self.footer(os.path.join(folder, name))['groups']:
+                    found.add(g['symbol'])
+        return sorted(found)
+
+    def spans(self, symbol, start=None, end=None):
+        '''(start, end) epoch ms of every archived day holding symbol,
+        clipped to start <= ts < end, in time order.'''
+        symbol = symbol.upper()
+        underlying = parse_symbol(symbol).underlying
+        start = to_epoch_ms(start)
+        end = to_epoch_ms(end)
+        found = []
+        for day in self.days():
+            path = self.path(day, underlying)
+            if not os.path.exists(path) or \
+               all(g['symbol'] != symbol for g in self.footer(path)['groups']):
+                continue
+            lo, hi = day_span(day)
+            if start is not None:
+                lo = max(lo, start)
+            if end is not None:
+                hi = min(hi, end)
+            if lo < hi:
+                found.append((lo, hi))
+        return found
+
+    def iter_ticks(self, symbol, start=None, end=None, fields=tick_columns,
+                   chunk_size=None):
+        '''Yields {field: array} per matching row group of symbol with
+        start <= ts < end, in time order.'''
+        if np is None:
+            raise ImportError('archive requires numpy')
+        for f in fields:
+            if f not in tick_columns:
+                raise ValueError('Unknown tick field: {}'.format(f))
+        symbol = symbol.upper()
+        underlying = parse_symbol(symbol).underlying
+        start = to_epoch_ms(start)
+        end = to_epoch_ms(end)
+        first = None if start is None else _day_key(start)
+        last = None if end is None else _day_key(end)
+        for day in self.days():
+            if (first is not None and day < first) or \
+               (last is not None and day > last):
+                continue
+            path = self.path(day, underlying)
+            if not os.path.exists(path):
+                continue
+            groups = [g for g in self.footer(path)['groups']
+                      if g['symbol'] == symbol]
+            if not groups:
+                continue
+            with open(path, 'rb') as f:
+                for g in groups:
+                    lo, hi = g['ts']
+                    if (start is not None and hi < start) or \
+                       (end is not None and lo >= end):
+                        self.groups_skipped += 1
+                        continue
+                    self.groups_read += 1
+                    cols = {}
+                    for name in set(fields) | {'ts'}:
+                        offset, size = g['chunks'][name]
+                        f.seek(offset)
+                        cols[name] = _decode(name, f.read(size))
+                    ts = cols['ts']
+                    a = 0 if start is None or lo >= start else \
+                        int(np.searchsorted(ts, start, 'left'))
+                    b = len(ts) if end is None or hi < end else \
+                        int(np.searchsorted(ts, end, 'left'))
+                    if a < b:
+                        yield {name: cols[name][a:b] for name in fields}
+
+    def get_ticks(self, symbol, start=None, end=None, fields=tick_columns):
+        fields = tuple(fields)
+        return join_columns(list(self.iter_ticks(symbol, start, end,
+                                                 fields)), fields)
+
+
+def compact_day(source, day, root='archive', delete=False,
+                row_group=ROW_GROUP):
+    '''Moves one day of ticks from a StockDB (ticks schema) or TickJournal
+    into root, one file per underlying.
+
+    Rows already archived for that day and underlying are merged in, an
+    archived row being replaced by a source row of the same symbol and ts,
+    so running it again for a day is safe. With delete, the day's rows are
+    removed from source once every file has been written and read back.
+    Returns {underlying: rows}.
+    '''
+    if np is None:
+        raise ImportError('archive requires numpy')
+    start, end = day_span(day)
+    key = _day_key(start)
+    store = ColumnStore(root)
+    parts = {}
+    for symbol in source.tick_symbols(start, end):
+        cols = source.get_ticks(symbol, start, end)
+        if len(cols['ts']):
+            parts.setdefault(parse_symbol(symbol).underlying, {})[symbol] = \
+                cols
+    written = {}
+    for underlying, symbols in parts.items():
+        path = store.path(key, underlying)
+        if os.path.exists(path):
+            for symbol in store.symbols(key):
+                if parse_symbol(symbol).underlying != underlying:
+                    continue
+                old = store.get_ticks(symbol, start, end)
+                new = symbols.get(symbol)
+                if new is not None:
+                    # Source rows replace archived rows of the same ts, so
+                    # compacting a day twice does not duplicate it
+                    keep = ~np.isin(old['ts'], new['ts'])
+                    ts = np.concatenate((old['ts'][keep], new['ts']))
+                    order = np.argsort(ts, kind='stable')
+                    old = {f: np.concatenate((old[f][keep], new[f]))[order]
+                           for f in tick_columns}
+                symbols[symbol] = old
+        count = write_partition(path, symbols, row_group)
+        check = sum(g['rows'] for g in read_footer(path)['groups'])
+        if check != count:
+            raise IOError('Archive check failed for {}'.format(path))
+        written[underlying] = count
+        print_l('Archived {} ticks'.format(count), day=key,
+                underlying=underlying)
+    if delete:
+        for symbols in parts.values():
+            for symbol in symbols:
+                source.delete_ticks(symbol, start, end)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact a day of ticks '
+                                     'into columnar archive files')
+    parser.add_argument('source', help='StockDB file, or journal directory')
+    parser.add_argument('day', nargs='?', default=date.today().isoformat(),
+                        help='YYYY-MM-DD, default today')
+    parser.add_argument('--root', default='archive')
+    parser.add_argument('--row-group', type=int, default=ROW_GROUP)
+    parser.add_argument('--delete', action='store_true',
+                        help='remove archived rows from the source')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='reclaim the freed space of a StockDB')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.source):
+        from journal import TickJournal
+        source = TickJournal()
+    else:
+        from stockdb import StockDB
+        source = StockDB()
+    source.initialize(args.source)
+    compact_day(source, args.day, args.root, args.delete, args.row_group)
+    if args.vacuum and hasattr(source, 'conn'):
+        source.conn.execute('VACUUM')
+    source.close()
+
+
+def test_archive():
+    'Round trip through compact_day, which is safe to run twice'
+    if np is None:
+        print('test_archive skipped, archive requires numpy')
+        return
+    import shutil
+    import tempfile
+    from ohlc import OHLC
+    from stockdb import StockDB, table_types
+    symbol = 'NIFTY18FEB11200CE'
+    t0 = int(datetime(2018, 2, 1, 9, 16).timestamp() * 1000)
+    rows = [OHLC(t0 + i * 1000, symbol, 100.0 + i, 100.0, 100.0, 150.0,
+                 90.0, 99.0) for i in range(100)]
+    root = tempfile.mkdtemp()
+    db = StockDB()
+    db.initialize(':memory:')
+    db.create_tick_tables()
+    db.write_batches({(symbol, table_types.ticks): rows})
+    try:
+        assert compact_day(db, '2018-02-01', root) == {'NIFTY': 100}
+        assert compact_day(db, '2018-02-01', root) == {'NIFTY': 100}
+        cols = ColumnStore(root).get_ticks(symbol)
+        assert list(cols['ts']) == [o.ts for o in rows]
+        assert list(cols['ltp']) == [o.ltp for o in rows]
+        db.attach_archive(root)
+        assert len(db.get_ticks(symbol)['ts']) == 100
+        assert compact_day(db, '2018-02-01', root, delete=True) == \
+            {'NIFTY': 100}
+        assert db.tick_symbols() == []
+        assert list(db.get_ticks(symbol)['ts']) == [o.ts for o in rows]
+        # Late ticks of an archived day are merged in
+        late = OHLC(t0 + 100000, symbol, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0)
+        db.write_batches({(symbol, table_types.ticks): [late]})
+        assert compact_day(db, '2018-02-01', root) == {'NIFTY': 101}
+        assert list(db.get_ticks(symbol)['ts']) == \
+            [o.ts for o in rows] + [late.ts]
+        # The next day compacted while this one is still in the db
+        db.delete_ticks(symbol)
+        shutil.rmtree(root)
+        days = rows + [OHLC(o.ts + 86400000, symbol, o.ltp + 1, 1.0, 1.0,
+                            1.0, 1.0, 1.0) for o in rows]
+        db.write_batches({(symbol, table_types.ticks): days})
+        assert compact_day(db, '2018-02-02', root, delete=True) == \
+            {'NIFTY': 100}
+        cols = db.get_ticks(symbol)
+        assert list(cols['ts']) == [o.ts for o in days]
+        assert list(cols['ltp']) == [o.ltp for o in days]
+        assert len(db.get_ticks(symbol, t0 + 50000, t0 + 86450000)['ts']) \
+            == 100
+    finally:
+        db.close()
+        shutil.rmtree(root)
+    print('test_archive passed')
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        main()
+    else:
+        test_archive()
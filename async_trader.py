@@ -0,0 +1,334 @@
+'''asyncio runtime for TradeCenter.
+
+The event loop runs on the listener thread and owns the dispatch queues.
+Upstox callbacks still put messages into the Dispatcher ring buffers, so
+the overflow policies and latency stats are unchanged, and wake the loop
+with call_soon_threadsafe. Only one wakeup is scheduled at a time, so a
+burst of ticks costs a single self-pipe write.
+
+Strategies are evaluated on the loop. Blocking REST calls (place_order,
+modify_order, chain (un)subscribes) and the shutdown flush run on a bounded
+thread pool. Orders of one symbol keep their order, while a slow broker
+response for one symbol no longer holds up quotes for the others. Chain
+windows and stock_dict are only changed on the loop.
+
+Select it with runtime = asyncio in the config, see main.py.
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+import time
+from trader import TradeCenter
+from utils import print_l, Actions, is_trade_active
+
+
+class AsyncTradeCenter(TradeCenter):
+    '''TradeCenter whose listener is an asyncio event loop.
+
+    async_workers threads run blocking calls; at most async_pending calls
+    are queued for them, after which new order tasks wait their turn.
+    '''
+
+    def __init__(self, config=None):
+        TradeCenter.__init__(self, config)
+        self.loop = None
+        self.wakeup = None
+        self.wake_pending = False
+        self.executor = ThreadPoolExecutor(
+            self.setting('async_workers', 4), thread_name_prefix='blocking')
+        self.pending = None
+        self.max_pending = self.setting('async_pending', 64)
+        # symbol -> asyncio.Lock serializing its order calls
+        self.symbol_locks = {}
+        self.tasks = set()
+        # Serializes chain moves and releases
+        self.chain_lock = None
+        # Strategies yield to the loop after this many quotes
+        self.yield_every = self.setting('async_yield', 64)
+
+
+    # Producer side, called on the Upstox websocket thread
+
+    def notify(self):
+        'Wakes the event loop, scheduling at most one wakeup at a time'
+        loop = self.loop
+        if loop is None or self.wake_pending:
+            return
+        self.wake_pending = True
+        try:
+            loop.call_soon_threadsafe(self._wake)
+        except RuntimeError:
+            # Loop already closed
+            self.wake_pending = False
+
+
+    def _wake(self):
+        self.wake_pending = False
+        self.wakeup.set()
+
+
+    def quote_handler(self, message):
+        self.dispatch.put_quote(message)
+        self.notify()
+
+
+    def order_handler(self, message):
+        self.dispatch.put_order(message)
+        self.notify()
+
+
+    def trade_handler(self, message):
+        self.dispatch.put_trade(message)
+        self.notify()
+
+
+    # Event loop
+
+    def listen(self):
+        'Listener thread body: runs the event loop until listening stops'
+        # Extra sleep so main thread can finish print statements
+        time.sleep(1.0)
+        asyncio.run(self.serve())
+
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.pending = asyncio.Semaphore(self.max_pending)
+        self.chain_lock = asyncio.Lock()
+        self.start_persist()
+        print_l('Receiving updates (asyncio)...')
+        self.ready.set()
+        dispatch = self.dispatch
+        batch = dispatch.batch_size
+        try:
+            while self.listening:
+                if dispatch.depth() == 0:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), 1.0)
+                    except asyncio.TimeoutError:
+                        pass
+                self.wakeup.clear()
+                entries, latest = self.take_quotes(batch)
+                messages = [entry[1] for entry in latest]
+                await self.evaluate_quotes(messages)
+                if self.chains:
+                    self.follow_chains(messages)
+                self.finish_quotes(entries)
+                self.process_updates(batch)
+                if self.check_session and not is_trade_active():
+                    self.listening = False
+            await self.finish_tasks()
+        finally:
+            self.listening = False
+            self.dispatch.close()
+            self.ready.clear()
+            self.report_drops()
+            self.loop = None
+            # Flush queued ticks on shutdown, close_ops() waits for this
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.shutdown_storage)
+            except RuntimeError:
+                # Executor already shut down
+                self.shutdown_storage()
+
+
+    async def finish_tasks(self, timeout=5.0):
+        '''Waits for order tasks, cancelling those that take longer than
+        timeout, then processes the order and trade updates they caused.'''
+        if self.tasks:
+            done, pending = await asyncio.wait(list(self.tasks),
+                                               timeout=timeout)
+            if pending:
+                print_l('Cancelling unfinished order tasks',
+                        logging.WARNING, count=len(pending))
+                for task in pending:
+                    task.cancel()
+                await asyncio.wait(pending)
+        dispatch = self.dispatch
+        while len(dispatch.orders) or len(dispatch.trades):
+            self.process_updates(dispatch.batch_size)
+
+
+    def shutdown_storage(self):
+        self.bars.flush()
+        if self.persist is not None:
+            self.persist.stop()
+
+
+    async def evaluate_quotes(self, messages):
+        '''Runs quotes through the strategies on the loop and hands the
+        resulting order calls to order tasks.'''
+        if self.batch_quotes:
+            self.evaluate(messages)
+            return
+        for i, message in enumerate(messages, 1):
+            self.quote_update(message)
+            if i % self.yield_every == 0:
+                # Let order tasks and wakeups run between quotes
+                await asyncio.sleep(0)
+
+
+    def execute(self, sym, action, args):
+        '''Called by quote_update/evaluate on the loop. Order calls are
+        started as tasks instead of blocking the loop, unless the order
+        gateway already takes them off the loop.'''
+        if self.gateway is not None:
+            return TradeCenter.execute(self, sym, action, args)
+        if action in (Actions.buy, Actions.mod_sl) and args is not None:
+            self.spawn(self.execute_async(sym, action, args))
+        return ''
+
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+
+    async def execute_async(self, sym, action, args):
+        'Places or modifies an order on the executor, in order per symbol'
+        lock = self.symbol_locks.get(sym)
+        if lock is None:
+            lock = self.symbol_locks[sym] = asyncio.Lock()
+        async with lock:
+            return await self.run_blocking(
+                partial(TradeCenter.execute, self, sym, action, args))
+
+
+    async def run_blocking(self, func, *args):
+        'Runs func(*args) on the bounded executor'
+        async with self.pending:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, func, *args)
+
+
+    def follow_chains(self, messages):
+        '''Records spot prices on the loop and starts a task moving the
+        chains that left their band, one chain change at a time.'''
+        keys = self.chains_to_move(messages)
+        if keys and not self.chain_lock.locked():
+            self.spawn(self.move_chains(keys))
+
+
+    async def move_chains(self, keys):
+        async with self.chain_lock:
+            for underlying, expiry in keys:
+                window = self.chains[(underlying, expiry)]
+                spot = self.spot[underlying]
+                if not window.should_move(spot):
+                    continue
+                start = time.perf_counter()
+                entering, leaving = window.move(spot)
+                added = await self.register_async(entering)
+                dropped = await self.unregister_async(leaving)
+                self.hold_chain(window, leaving, dropped)
+                self.log_rebalance(window, start, entering, leaving, added,
+                                   dropped)
+
+
+    def release_chains(self, sym):
+        'Releases held symbols from a task, the unsubscribe blocks'
+        if self.loop is None:
+            return
+        for window in self.chains.values():
+            if sym in window.held:
+                self.spawn(self.release_async(window))
+
+
+    async def release_async(self, window):
+        async with self.chain_lock:
+            leaving = sorted(window.held)
+            self.hold_chain(window, leaving,
+                            await self.unregister_async(leaving))
+
+
+    async def register_async(self, insts):
+        'register_stocks for instruments, subscribing on the executor'
+        if not insts:
+            return []
+        new = self.add_strategies(insts)
+        await self.run_blocking(self.subscriptions.subscribe, self.client,
+                                insts)
+        return self.keep_subscribed(insts, new)
+
+
+    async def unregister_async(self, symbols):
+        'unregister_stocks, unsubscribing on the executor'
+        insts = self.releasable(symbols)
+        if not insts:
+            return []
+        return self.drop_strategies(await self.run_blocking(
+            self.subscriptions.unsubscribe, self.client, insts))
+
+
+    def settled(self):
+        return not self.tasks and TradeCenter.settled(self)
+
+
+    def stop_listener(self):
+        TradeCenter.stop_listener(self)
+        self.notify()
+
+
+    def join_listener(self):
+        '''Waits for the loop to exit, then for the executor to finish
+        the calls already running, the storage flush included.'''
+        TradeCenter.join_listener(self)
+        self.executor.shutdown(wait=True)
+
+
+def test_async():
+    'A lockstep replay places the same orders as the threaded listener'
+    import os
+    import random
+    import tempfile
+    from datetime import datetime
+    from backtest import Backtester, SimInstrument, make_quote
+    from replay import ReplayClient, run_replay
+    day = int(datetime(2018, 2, 1, 9, 16).timestamp() * 1000)
+    insts = [SimInstrument('NSE_FO', i, 'TEST18FEB{}CE'.format(10000 + i),
+                           75) for i in range(2)]
+    random.seed(1)
+    quotes = []
+    expected = 0
+    for inst in insts:
+        ts = [day + i * 1000 for i in range(3000)]
+        ltp = [100.0]
+        for i in range(len(ts) - 1):
+            ltp.append(max(1.0, ltp[-1] + random.gauss(0, 0.3)))
+        expected += len(Backtester().run(inst, {'ts': ts, 'ltp': ltp}))
+        quotes.extend((t, inst.token, make_quote(inst, t, p, p, p, p, p, p))
+                      for t, p in zip(ts, ltp))
+    quotes = [q for t, n, q in sorted(quotes, key=lambda q: q[:2])]
+    results = []
+    for cls in (TradeCenter, AsyncTradeCenter):
+        client = ReplayClient(quotes)
+        for inst in insts:
+            client.add_instrument(inst)
+        tc = cls({'db_file': os.path.join(tempfile.mkdtemp(), 'a.sqlite'),
+                  'db_schema': 'ticks'})
+        tc.trading = True
+        stats = run_replay(tc, client, 120)
+        assert stats['settle_timeouts'] == 0
+        results.append((stats['orders'], stats['trades']))
+    # A backtest trade is a buy and a sell fill
+    assert results[0] == results[1] and results[1][1] == 2 * expected > 0
+    # The loop is gone and the executor shut down with it
+    assert tc.loop is None and not tc.tasks
+    tc.notify()
+    assert not tc.wake_pending
+    try:
+        tc.executor.submit(int)
+        assert False, 'executor still accepts calls'
+    except RuntimeError:
+        pass
+    print('test_async passed')
+
+
+if __name__ == '__main__':
+    test_async()
@@ -0,0 +1,366 @@
+'''Offline evaluation of TradeStrategy classes over recorded ticks.
+
+Backtester replays ticks as Upstox style quotes through any TradeStrategy
+and fills its orders with SimBroker. gann_fast() computes the same
+GannAngles result for a whole day of prices with numpy.
+
+Fill model for the OCO bracket from GannAngles.buy_args():
+- the stop-limit buy triggers when it is placed and fills at the first tick
+  (the placing tick included) whose ltp is at or below the order price,
+  at that ltp
+- the stoploss and target legs sit at fill - stoploss and fill + square off
+  and exit at the first later tick that touches either, at that ltp
+- an open position is squared off at the last tick of the day
+'''
+
+from collections import namedtuple, OrderedDict
+from datetime import datetime, date, timezone
+from math import sqrt
+import os
+from gann import GannAngles
+from ohlc import OHLCLog
+from utils import Actions, round_off
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+Trade = namedtuple('Trade', 'symbol qty entry_ts entry_price '
+                            'exit_ts exit_price pnl reason')
+
+SimInstrument = namedtuple('Instrument', 'exchange token symbol lot_size')
+
+
+def make_quote(instrument, ts, ltp, atp=0.0, op=0.0, hi=0.0, lo=0.0, cl=0.0):
+    'Upstox style quote dict for a tick, ts in epoch ms'
+    return {'timestamp': str(int(ts)),
+            'symbol': instrument.symbol,
+            'instrument': instrument,
+            'exchange': instrument.exchange,
+            'ltp': ltp,
+            'atp': atp,
+            'open': op,
+            'high': hi,
+            'low': lo,
+            'close': cl}
+
+
+class SimBroker:
+    '''Fills the OCO bracket orders of one strategy against replayed ticks.
+
+    Order and trade messages are passed back through the strategy's
+    order_update and trade_update, like TradeCenter does live.'''
+
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.symbol = strategy.instrument.symbol
+        self.order_id = 0
+        self.entry = None
+        self.position = None
+        self.trades = []
+
+    def next_id(self):
+        self.order_id += 1
+        return self.order_id
+
+    def message(self, order_id, side, status, price, trigger=0.0, parent=0):
+        return {'order_id': order_id,
+                'parent_order_id': parent,
+                'symbol': self.symbol,
+                'transaction_type': side,
+                'status': status,
+                'price': price,
+                'trigger_price': trigger}
+
+    def place_order(self, side, instrument, qty, order_type, product, price,
+                    trigger, disclosed, duration, stoploss, square_off,
+                    trailing=None):
+        oid = self.next_id()
+        self.entry = {'id': oid, 'qty': qty, 'price': price,
+                      'trigger': trigger, 'stoploss': stoploss,
+                      'square_off': square_off}
+        self.strategy.order_update(self.message(oid, 'B', 'trigger pending',
+                                                price, trigger))
+        return self.message(oid, 'B', 'trigger pending', price, trigger)
+
+    def modify_order(self, order_id, trigger_price=None):
+        if self.position is not None and trigger_price is not None and \
+           order_id == self.position['sl_id']:
+            self.position['stop'] = trigger_price
+        return {'order_id': order_id}
+
+    def on_tick(self, i, ts, ltp):
+        pos = self.position
+        if pos is not None and pos['index'] < i:
+            if ltp <= pos['stop']:
+                self.exit(ts, ltp, 'stoploss')
+            elif ltp >= pos['target']:
+                self.exit(ts, ltp, 'target')
+        entry = self.entry
+        if entry is not None and ltp <= entry['price']:
+            self.entry = None
+            self.position = {'index': i, 'ts': ts, 'price': ltp,
+                             'qty': entry['qty'],
+                             'stop': ltp - entry['stoploss'],
+                             'target': ltp + entry['square_off'],
+                             'sl_id': self.next_id(),
+                             'tgt_id': self.next_id()}
+            pos = self.position
+            upd = self.strategy.order_update
+            upd(self.message(entry['id'], 'B', 'complete', ltp))
+            self.strategy.trade_update(self.message(entry['id'], 'B',
+                                                    'complete', ltp))
+            upd(self.message(pos['sl_id'], 'S', 'trigger pending',
+                             pos['stop'], pos['stop'], entry['id']))
+            upd(self.message(pos['tgt_id'], 'S', 'open',
+                             pos['target'], 0.0, entry['id']))
+
+    def exit(self, ts, ltp, reason):
+        pos = self.position
+        self.position = None
+        self.trades.append(Trade(self.symbol, pos['qty'], pos['ts'],
+                                 pos['price'], ts, ltp,
+                                 (ltp - pos['price']) * pos['qty'], reason))
+        done, other = pos['sl_id'], pos['tgt_id']
+        if reason == 'target':
+            done, other = other, done
+        self.strategy.order_update(self.message(done, 'S', 'complete', ltp))
+        self.strategy.trade_update(self.message(done, 'S', 'complete', ltp))
+        self.strategy.order_update(self.message(other, 'S', 'cancelled', ltp))
+
+    def close(self, ts, ltp):
+        'End of data, square off whatever is open'
+        self.entry = None
+        if self.position is not None:
+            self.exit(ts, ltp, 'eod')
+
+
+class Backtester:
+    '''Replays one symbol's ticks through a TradeStrategy class.
+
+    Every trading day gets a fresh strategy instance, as a live session
+    would. Strategy attributes (e.g. GannAngles.trigger_idx) can be
+    overridden per run with params.'''
+
+    def __init__(self, strategy_cls=GannAngles, params=None):
+        self.params = params or {}
+        self.strategy_cls = strategy_cls.with_params(**self.params)
+
+    def make_strategy(self, instrument):
+        return self.strategy_cls(instrument)
+
+    def run_day(self, instrument, ticks):
+        '''ticks is {'ts', 'ltp', ...} arrays for a single day.
+
+        Returns the list of completed Trades.'''
+        ts = ticks['ts']
+        ltp = ticks['ltp']
+        if len(ts) == 0:
+            return []
+        strategy = self.make_strategy(instrument)
+        broker = SimBroker(strategy)
+        extra = [ticks.get(k) for k in ('atp', 'open', 'high', 'low', 'close')]
+        for i in range(len(ts)):
+            vals = [0.0 if col is None else col[i] for col in extra]
+            quote = make_quote(instrument, ts[i], ltp[i], *vals)
+            action, args = strategy.quote_update(quote)
+            if action == Actions.buy and args is not None:
+                broker.place_order(*args)
+            elif action == Actions.mod_sl and args is not None:
+                broker.modify_order(args[0], args[1])
+            broker.on_tick(i, ts[i], ltp[i])
+        broker.close(ts[-1], ltp[-1])
+        strategy.close()
+        return broker.trades
+
+    def run(self, instrument, ticks, fast=False):
+        'Splits ticks by day and runs each; fast uses gann_fast()'
+        trades = []
+        for day, cols in split_days(ticks).items():
+            if fast:
+                trade = gann_fast(instrument.symbol, cols['ts'], cols['ltp'],
+                                  **self.params)
+                if trade is not None:
+                    trades.append(trade)
+            else:
+                trades.extend(self.run_day(instrument, cols))
+        return trades
+
+
+def day_bounds(ts):
+    '''[(date, start, stop), ...] slices of time ordered epoch ms ts that
+    fall on the same local date.'''
+    if len(ts) == 0:
+        return []
+    if np is not None:
+        t0 = ts[0] / 1000
+        offset = datetime.fromtimestamp(t0) - \
+                 datetime.fromtimestamp(t0, timezone.utc).replace(tzinfo=None)
+        offset = int(offset.total_seconds() * 1000)
+        days = (np.asarray(ts, dtype=np.int64) + offset) // 86400000
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(days)) + 1))
+        stops = np.concatenate((starts[1:], [len(ts)]))
+        return [(date.fromtimestamp(ts[a] / 1000), int(a), int(b))
+                for a, b in zip(starts, stops)]
+    bounds = []
+    start = 0
+    current = None
+    for i in range(len(ts)):
+        day = date.fromtimestamp(ts[i] / 1000)
+        if day != current:
+            if current is not None:
+                bounds.append((current, start, i))
+            current = day
+            start = i
+    if current is not None:
+        bounds.append((current, start, len(ts)))
+    return bounds
+
+
+def split_days(ticks):
+    'Splits time ordered {field: array} ticks into {date: {field: array}}'
+    days = OrderedDict()
+    for day, a, b in day_bounds(ticks['ts']):
+        days[day] = dict((k, v[a:b]) for k, v in ticks.items())
+    return days
+
+
+def active_mask(ts):
+    '''Vectorized utils.is_trade_active over epoch ms timestamps of one day.'''
+    first = datetime.fromtimestamp(ts[0] / 1000)
+    open_ms = datetime(first.year, first.month, first.day, 9, 15)
+    close_ms = datetime(first.year, first.month, first.day, 15, 31)
+    open_ms = int(open_ms.timestamp() * 1000)
+    close_ms = int(close_ms.timestamp() * 1000)
+    return (ts > open_ms) & (ts < close_ms)
+
+
+def gann_fast(symbol, ts, ltp, trigger_idx=GannAngles.trigger_idx,
+              price_idx=GannAngles.price_idx,
+              support_idx=GannAngles.support_idx,
+              target_idx=GannAngles.target_idx,
+              quantity=GannAngles.quantity,
+              gann_angles=GannAngles.gann_angles):
+    '''GannAngles plus the SimBroker fill model over one day, vectorized.
+
+    Gives the same Trade as Backtester.run_day for GannAngles, or None.
+    Requires numpy.
+    '''
+    if np is None:
+        raise ImportError('gann_fast requires numpy')
+    ts = np.asarray(ts, dtype=np.int64)
+    ltp = np.asarray(ltp, dtype=np.float64)
+    n = len(ltp)
+    if n == 0:
+        return None
+    angles = np.asarray(gann_angles)
+    active = active_mask(ts)
+
+    # Levels are first computed on the first tick inside market hours
+    first = np.flatnonzero(active)
+    if len(first) == 0:
+        return None
+    k = first[0]
+    sup = (sqrt(ltp[k]) - angles[support_idx]) ** 2
+
+    # Resistance is re-anchored on every tick at or below support; the
+    # trigger seen by tick i comes from the last anchor before i.
+    idx = np.arange(n)
+    anchor = np.where((ltp <= sup) & (idx > k), idx, k)
+    anchor = np.maximum.accumulate(anchor)
+    anchor = np.concatenate(([k], anchor[:-1]))
+    trigger = (np.sqrt(ltp[anchor]) + angles[trigger_idx]) ** 2
+    hits = np.flatnonzero((ltp >= trigger) & active & (idx > k))
+    if len(hits) == 0:
+        return None
+    signal = hits[0]
+
+    res = (sqrt(ltp[anchor[signal]]) + angles) ** 2
+    price = round_off(res[price_idx])
+    stoploss = round_off(res[price_idx] - sup)
+    square_off = round_off(res[target_idx] - res[price_idx])
+
+    fills = np.flatnonzero(ltp[signal:] <= price)
+    if len(fills) == 0:
+        return None
+    entry = signal + fills[0]
+    fill = ltp[entry]
+    stop = fill - stoploss
+    target = fill + square_off
+    after = ltp[entry + 1:]
+    exits = np.flatnonzero((after <= stop) | (after >= target))
+    if len(exits) == 0:
+        out, reason = n - 1, 'eod'
+    else:
+        out = entry + 1 + exits[0]
+        reason = 'stoploss' if ltp[out] <= stop else 'target'
+    return Trade(symbol, quantity, int(ts[entry]), float(fill),
+                 int(ts[out]), float(ltp[out]),
+                 float((ltp[out] - fill) * quantity), reason)
+
+
+def load_ticks(source, symbol=None, start=None, end=None):
+    '''Tick columns from a StockDB (ticks schema), an archive directory
+    (see archive.py) or an OHLCLog csv file.'''
+    if isinstance(source, str) and os.path.isdir(source):
+        from archive import ColumnStore
+        return ColumnStore(source).get_ticks(symbol, start, end)
+    if isinstance(source, str):
+        cols = {'ts': [], 'ltp': [], 'atp': [], 'open': [],
+                'high': [], 'low': [], 'close': []}
+        for o in OHLCLog.readohlc(source):
+            cols['ts'].append(o.ts)
+            cols['ltp'].append(float(o.ltp))
+            cols['atp'].append(float(o.atp))
+            cols['open'].append(float(o.op))
+            cols['high'].append(float(o.hi))
+            cols['low'].append(float(o.lo))
+            cols['close'].append(float(o.cl))
+        return cols
+    return source.get_ticks(symbol, start, end)
+
+
+def summarize(trades):
+    'Total pnl, trade count and win rate of a list of Trades'
+    wins = len([t for t in trades if t.pnl > 0])
+    return {'trades': len(trades),
+            'pnl': sum(t.pnl for t in trades),
+            'win_rate': wins / len(trades) if trades else 0.0}
+
+
+def backtest_test(seeds=range(1, 6)):
+    'Replays synthetic days through both paths and checks they agree'
+    import random
+    day = datetime(2018, 2, 1, 9, 16)
+    ts = [int(day.timestamp() * 1000) + i * 1000 for i in range(20000)]
+    inst = SimInstrument('NSE_FO', 0, 'TEST18FEBCE', 75)
+    traded = 0
+    for seed in seeds:
+        random.seed(seed)
+        ltp = [100.0]
+        for i in range(len(ts) - 1):
+            ltp.append(max(1.0, ltp[-1] + random.gauss(0, 0.3)))
+        ticks = {'ts': ts, 'ltp': ltp}
+        slow = Backtester().run(inst, ticks)
+        print('Event driven:', slow)
+        traded += len(slow)
+        if np is None:
+            continue
+        fast = Backtester().run(inst, ticks, fast=True)
+        print('Vectorized:  ', fast)
+        assert len(slow) == len(fast), (seed, slow, fast)
+        for a, b in zip(slow, fast):
+            assert (a.symbol, a.qty, a.entry_ts, a.exit_ts, a.reason) == \
+                   (b.symbol, b.qty, b.entry_ts, b.exit_ts, b.reason), seed
+            assert abs(a.entry_price - b.entry_price) < 1e-6, seed
+            assert abs(a.exit_price - b.exit_price) < 1e-6, seed
+            assert abs(a.pnl - b.pnl) < 1e-6, seed
+        assert abs(sum(t.pnl for t in slow) - sum(t.pnl for t in fast)) \
+            < 1e-6, seed
+    assert traded > 0, 'synthetic days produced no trades'
+    print('backtest_test passed')
+
+
+if __name__ == '__main__':
+    backtest_test()
@@ -0,0 +1,209 @@
+'''Time bars built from the tick stream.
+
+BarBuilder keeps one open bar per symbol and resolution and updates it in
+constant time per tick. resample() builds the same bars in bulk from stored
+tick arrays.
+'''
+
+from collections import namedtuple
+from stockdb import table_types
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# res is the bar length in seconds, ts the bar start in epoch ms
+Bar = namedtuple('Bar', 'symbol res ts open high low close volume')
+
+
+class BarBuilder:
+    '''Incremental OHLCV bars at several resolutions per symbol.
+
+    Volume is the increase in the quote's cumulative traded volume (vtt)
+    during the bar. A bar is emitted to every subscriber once the first tick
+    of the next bar arrives, or by flush().
+    '''
+
+    def __init__(self, resolutions=(1, 60, 300)):
+        self.resolutions = tuple(resolutions)
+        self.spans = tuple(r * 1000 for r in self.resolutions)
+        # symbol -> [[bucket, open, high, low, close, volume], ...]
+        self.open_bars = {}
+        self.last_volume = {}
+        self.subscribers = []
+        self.emitted = 0
+
+    def subscribe(self, func):
+        'func(bar) is called for every closed Bar'
+        self.subscribers.append(func)
+
+    def update_quote(self, quote):
+        vol = quote.get('vtt')
+        self.update(quote['symbol'], int(quote['timestamp']),
+                    float(quote['ltp']), None if vol is None else float(vol))
+
+    def update(self, symbol, ts, price, cum_volume=None):
+        'ts in epoch ms, cum_volume is the day total traded so far'
+        vol = 0.0
+        if cum_volume is not None:
+            last = self.last_volume.get(symbol)
+            if last is not None and cum_volume > last:
+                vol = cum_volume - last
+            self.last_volume[symbol] = cum_volume
+
+        bars = self.open_bars.get(symbol)
+        if bars is None:
+            bars = self.open_bars[symbol] = [None] * len(self.spans)
+        for i, span in enumerate(self.spans):
+            bucket = ts // span
+            bar = bars[i]
+            if bar is None or bucket > bar[0]:
+                if bar is not None:
+                    self.emit(symbol, i, bar)
+                bars[i] = [bucket, price, price, price, price, vol]
+                continue
+            # Same bar, late ticks are folded into the open bar
+            if price > bar[2]:
+                bar[2] = price
+            if price < bar[3]:
+                bar[3] = price
+            bar[4] = price
+            bar[5] += vol
+
+    def emit(self, symbol, i, bar):
+        closed = Bar(symbol, self.resolutions[i], bar[0] * self.spans[i],
+                     bar[1], bar[2], bar[3], bar[4], bar[5])
+        self.emitted += 1
+        for func in self.subscribers:
+            func(closed)
+
+    def flush(self):
+        'Emits every open bar, e.g. at the end of the session'
+        for symbol, bars in self.open_bars.items():
+            for i, bar in enumerate(bars):
+                if bar is not None:
+                    self.emit(symbol, i, bar)
+        self.open_bars = {}
+
+
+def resample(ts, price, res, volume=None):
+    '''Builds bars of res seconds from time ordered tick arrays.
+
+    ts is epoch ms and volume, if given, the cumulative traded volume.
+    Returns {'ts', 'open', 'high', 'low', 'close', 'volume'} arrays. Uses
+    numpy reductions when available and BarBuilder otherwise.
+    '''
+    span = res * 1000
+    if np is None:
+        out = {'ts': [], 'open': [], 'high': [],
+               'low': [], 'close': [], 'volume': []}
+
+        def collect(bar):
+            for key in out:
+                out[key].append(getattr(bar, key))
+        builder = BarBuilder((res,))
+        builder.subscribe(collect)
+        for i in range(len(ts)):
+            builder.update('', ts[i], price[i],
+                           None if volume is None else volume[i])
+        builder.flush()
+        return out
+
+    ts = np.asarray(ts, dtype=np.int64)
+    price = np.asarray(price, dtype=np.float64)
+    if len(ts) == 0:
+        empty = np.zeros(0)
+        return {'ts': ts, 'open': empty, 'high': empty,
+                'low': empty, 'close': empty, 'volume': empty}
+    bucket = ts // span
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(bucket)) + 1))
+    ends = np.concatenate((starts[1:], [len(ts)])) - 1
+    if volume is None:
+        vol = np.zeros(len(starts))
+    else:
+        delta = np.diff(np.asarray(volume, dtype=np.float64), prepend=np.nan)
+        delta[~(delta > 0)] = 0.0
+        vol = np.add.reduceat(delta, starts)
+    return {'ts': bucket[starts] * span,
+            'open': price[starts],
+            'high': np.maximum.reduceat(price, starts),
+            'low': np.minimum.reduceat(price, starts),
+            'close': price[ends],
+            'volume': vol}
+
+
+def rebuild_bars(db, symbol, resolutions=(1, 60, 300), start=None, end=None):
+    '''Recomputes stored bars for symbol from the ticks table of a StockDB.
+
+    The ticks table has no traded volume, so new bars carry volume 0 and
+    bars already stored, e.g. by a live BarBuilder, keep theirs while their
+    prices are replaced. Returns the bar count.
+    '''
+    ticks = db.get_ticks(symbol, start, end, fields=('ts', 'ltp'))
+    total = 0
+    for res in resolutions:
+        cols = resample(ticks['ts'], ticks['ltp'], res)
+        bars = [Bar(symbol, res, int(cols['ts'][i]), cols['open'][i],
+                    cols['high'][i], cols['low'][i], cols['close'][i],
+                    cols['volume'][i])
+                for i in range(len(cols['ts']))]
+        db.create_table(symbol, table_types.bars)
+        db.merge_bars(symbol, bars)
+        total += len(bars)
+    return total
+
+
+def test_bars():
+    'Bar rollover, resample against BarBuilder and rebuild_bars'
+    from ohlc import OHLC
+    from stockdb import StockDB
+    t0 = 1517456760000
+    bars = []
+    builder = BarBuilder((1, 60))
+    builder.subscribe(bars.append)
+    for dt, price, vtt in ((0, 10.0, 100), (400, 12.0, 110), (900, 9.0, 130),
+                           (1200, 11.0, 131), (60500, 13.0, 150)):
+        builder.update('BAR', t0 + dt, price, vtt)
+    assert [(b.res, b.ts) for b in bars] == \
+        [(1, t0), (1, t0 + 1000), (60, t0)]
+    assert bars[0][3:] == (10.0, 12.0, 9.0, 9.0, 30.0)
+    assert bars[2][3:] == (10.0, 12.0, 9.0, 11.0, 31.0)
+    builder.flush()
+    assert [(b.res, b.ts, b.volume) for b in bars[3:]] == \
+        [(1, t0 + 60000, 19.0), (60, t0 + 60000, 19.0)]
+
+    ts = [t0 + i * 250 for i in range(20)]
+    price = [100.0 + (i * 7) % 5 for i in range(20)]
+    volume = [1000.0 + i * 3 for i in range(20)]
+    cols = resample(ts, price, 1, volume)
+    assert list(cols['ts']) == [t0 + i * 1000 for i in range(5)]
+    assert list(cols['open']) == price[::4]
+    assert list(cols['close']) == price[3::4]
+    assert list(cols['high']) == [max(price[i:i + 4]) for i in range(0, 20, 4)]
+    assert list(cols['volume']) == [9.0] + [12.0] * 4
+
+    db = StockDB()
+    db.initialize(':memory:')
+    db.create_table('BAR', table_types.ticks)
+    db.create_table('BAR', table_types.bars)
+    db.add_many('BAR', table_types.ticks,
+                [OHLC(t, 'BAR', p, p, p, p, p, p) for t, p in zip(ts, price)])
+    # A live bar of the same slot keeps its traded volume
+    db.add_many('BAR', table_types.bars,
+                [Bar('BAR', 1, t0, 1.0, 1.0, 1.0, 1.0, 500.0)])
+    assert rebuild_bars(db, 'BAR', (1, 60)) == 6
+    db.cursor.execute('SELECT res, ts, open, close, volume FROM bars '
+                      'ORDER BY res, ts')
+    rows = db.cursor.fetchall()
+    assert rows[0] == (1, t0, price[0], price[3], 500.0)
+    assert [r[4] for r in rows[1:]] == [0.0] * 5
+    assert rebuild_bars(db, 'BAR', (1, 60)) == 6
+    db.cursor.execute('SELECT COUNT(*), SUM(volume) FROM bars')
+    assert db.cursor.fetchone() == (6, 500.0)
+    db.close()
+    print('test_bars passed')
+
+
+if __name__ == '__main__':
+    test_bars()
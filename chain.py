@@ -0,0 +1,257 @@
+'''Batched live feed subscriptions and option chain windows.
+
+Upstox accepts a list of instruments of one exchange per subscribe and
+unsubscribe request, so a chain of 100+ strikes takes a few round trips
+instead of one per symbol. ChainWindow picks the strikes of an underlying
+and expiry within width strikes of the money from an InstrumentRegistry.
+'''
+
+from bisect import bisect_left
+from time import perf_counter
+from upstox_api.api import LiveFeedType
+from utils import LatencyStats, print_l
+
+BATCH_SIZE = 50
+
+# Index instrument (NSE_INDEX) of an F&O underlying
+INDEX_SYMBOLS = {'NIFTY': 'NIFTY_50', 'BANKNIFTY': 'BANK_NIFTY'}
+
+
+def batches(instruments, size=BATCH_SIZE):
+    'Splits instruments into lists of at most size, one exchange per list'
+    by_exchange = {}
+    for inst in instruments:
+        by_exchange.setdefault(inst.exchange.lower(), []).append(inst)
+    for group in by_exchange.values():
+        for a in range(0, len(group), size):
+            yield group[a:a + size]
+
+
+class ChainSubscriber:
+    '''Tracks live feed subscriptions and makes them in batches.
+
+    If the client rejects a batch, its instruments are retried one at a
+    time, and so are requests for the next backoff seconds. The backoff
+    doubles with every batch that fails in a row, up to max_backoff, and is
+    reset by a batch that succeeds. latency holds the time taken by every
+    request, failed lists the symbols that could not be (un)subscribed.
+    '''
+
+    def __init__(self, feed_type=LiveFeedType.Full, batch_size=BATCH_SIZE,
+                 backoff=1.0, max_backoff=300.0):
+        self.feed_type = feed_type
+        self.batch_size = batch_size
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Batch failures in a row, and when batching is tried again
+        self.batch_failures = 0
+        self.batch_after = 0.0
+        # symbol -> instrument
+        self.subscribed = {}
+        self.latency = LatencyStats()
+        self.failed = []
+
+    def __contains__(self, symbol):
+        return symbol.upper() in self.subscribed
+
+    def _request(self, method, instruments):
+        'Returns the instruments the request succeeded for'
+        start = perf_counter()
+        if len(instruments) > 1 and start >= self.batch_after:
+            try:
+                method(instruments, self.feed_type)
+                self.latency.add(perf_counter() - start)
+                self.batch_failures = 0
+                return instruments
+            except Exception as e:
+                delay = min(self.backoff * 2 ** self.batch_failures,
+                            self.max_backoff)
+                self.batch_failures += 1
+                self.batch_after = perf_counter() + delay
+                print_l('Batch request failed, retrying one at a time',
+                        error=str(e), backoff=delay)
+        done = []
+        for inst in instruments:
+            start = perf_counter()
+            try:
+                method(inst, self.feed_type)
+                self.latency.add(perf_counter() - start)
+                done.append(inst)
+            except Exception as e:
+                print_l('Request failed', symbol=inst.symbol, error=str(e))
+                self.failed.append(inst.symbol)
+        return done
+
+    def subscribe(self, client, instruments):
+        'Subscribes instruments not yet subscribed. Returns the new ones.'
+        new = [inst for inst in instruments
+               if inst.symbol.upper() not in self.subscribed]
+        done = []
+        for batch in batches(new, self.batch_size):
+            done.extend(self._request(client.subscribe, batch))
+        for inst in done:
+            self.subscribed[inst.symbol.upper()] = inst
+        return done
+
+    def unsubscribe(self, client, instruments):
+        'Unsubscribes instruments. Returns the ones that were dropped.'
+        done = []
+        for batch in batches(instruments, self.batch_size):
+            done.extend(self._request(client.unsubscribe, batch))
+        for inst in done:
+            self.subscribed.pop(inst.symbol.upper(), None)
+        return done
+
+    def unsubscribe_all(self, client):
+        return self.unsubscribe(client, list(self.subscribed.values()))
+
+    def stats(self):
+        stats = self.latency.as_dict()
+        stats['subscribed'] = len(self.subscribed)
+        stats['failed'] = len(self.failed)
+        stats['batch_failures'] = self.batch_failures
+        return stats
+
+
+class ChainWindow:
+    '''Option contracts of one underlying and expiry around the money.
+
+    With hysteresis h the window only moves once spot is more than
+    (0.5 + h) strike steps away from the current ATM strike, so a spot
+    hovering between two strikes does not flip the subscriptions.
+
+    symbols are the contracts of the window. held are contracts that left
+    it but are kept subscribed for open orders; they are leaving again on
+    every move until the owner releases them.
+    '''
+
+    def __init__(self, registry, underlying, expiry, width=5,
+                 kinds=('CE', 'PE'), hysteresis=0.25):
+        self.registry = registry
+        self.underlying = underlying.upper()
+        self.expiry = expiry.upper()
+        self.width = width
+        self.kinds = kinds
+        self.hysteresis = hysteresis
+        self.atm = None
+        self.symbols = set()
+        self.held = set()
+
+    def atm_strike(self, spot):
+        'Listed strike nearest to spot'
+        strikes = self.registry.strikes(self.underlying, self.expiry)
+        if not strikes:
+            return None
+        i = bisect_left(strikes, spot)
+        if i == len(strikes) or \
+           (i > 0 and spot - strikes[i - 1] <= strikes[i] - spot):
+            i -= 1
+        return strikes[i]
+
+    def step(self, atm):
+        'Distance from atm to its nearest listed neighbour'
+        strikes = self.registry.strikes(self.underlying, self.expiry)
+        i = bisect_left(strikes, atm)
+        gaps = [abs(strikes[j] - atm) for j in (i - 1, i + 1)
+                if 0 <= j < len(strikes)]
+        return min(gaps) if gaps else 0.0
+
+    def should_move(self, spot):
+        'True if spot has left the hysteresis band around the ATM strike'
+        if self.atm is None:
+            return True
+        step = self.step(self.atm)
+        if step == 0.0:
+            return False
+        return abs(spot - self.atm) > step * (0.5 + self.hysteresis)
+
+    def strikes(self, atm):
+        'Listed strikes within width of atm'
+        strikes = self.registry.strikes(self.underlying, self.expiry)
+        i = bisect_left(strikes, atm)
+        return strikes[max(i - self.width, 0):i + self.width + 1]
+
+    def instruments(self, atm):
+        return self.registry.chain(self.underlying, self.expiry,
+                                   self.strikes(atm), self.kinds)
+
+    def move(self, spot):
+        '''Centres the window on the strike nearest spot.
+
+        Returns (instruments entering, symbols leaving) the window. Held
+        symbols back in the window are no longer held.'''
+        atm = self.atm_strike(spot)
+        if atm is None:
+            return [], []
+        self.atm = atm
+        target = self.instruments(atm)
+        symbols = {inst.symbol.upper() for inst in target}
+        current = self.symbols | self.held
+        entering = [inst for inst in target
+                    if inst.symbol.upper() not in current]
+        self.held -= symbols
+        leaving = sorted(current - symbols)
+        self.symbols = symbols
+        return entering, leaving
+
+
+def test_chain():
+    'Batching with backoff, window hysteresis and held symbols'
+    import os
+    import tempfile
+    from upstox_api.api import Instrument
+    from instruments import InstrumentRegistry
+    insts = [Instrument('NSE_FO', i, None, 'NIFTY18FEB{}CE'.format(k), '',
+                        0.0, None, k, 0.05, 75, 'OPTIDX', '')
+             for i, k in enumerate(range(10000, 11100, 100))]
+    index = Instrument('NSE_INDEX', 99, None, 'NIFTY_50', '', 0.0, None,
+                       None, 0.05, 1, '', '')
+    assert [len(b) for b in batches(insts + [index], 4)] == [4, 4, 3, 1]
+
+    class Client:
+        fail = True
+        calls = 0
+
+        def subscribe(self, instruments, feed_type):
+            self.calls += 1
+            if isinstance(instruments, list) and self.fail:
+                raise Exception('batch rejected')
+
+    client = Client()
+    sub = ChainSubscriber(batch_size=4, backoff=60.0)
+    assert len(sub.subscribe(client, insts[:4])) == 4
+    assert client.calls == 5 and sub.batch_failures == 1
+    # Within the backoff requests go one at a time without a batch attempt
+    client.fail = False
+    assert len(sub.subscribe(client, insts[4:8])) == 4
+    assert client.calls == 9 and 'NIFTY18FEB10500CE' in sub
+    sub.batch_after = 0.0
+    assert len(sub.subscribe(client, insts)) == 3
+    assert client.calls == 10 and sub.stats()['batch_failures'] == 0
+
+    reg = InstrumentRegistry(os.path.join(tempfile.mkdtemp(), 'i.sqlite'))
+    reg.add('nse_fo', insts)
+    reg.loaded = True
+    window = ChainWindow(reg, 'nifty', '18feb', width=1, kinds=('CE',))
+    assert window.should_move(10500)
+    entering, leaving = window.move(10520)
+    assert [i.strike_price for i in entering] == [10400, 10500, 10600]
+    assert window.atm == 10500 and leaving == []
+    # 0.75 steps either side of the ATM strike is inside the band
+    assert not window.should_move(10574) and not window.should_move(10426)
+    assert window.should_move(10576) and window.should_move(10424)
+    window.held.add('NIFTY18FEB10400CE')
+    entering, leaving = window.move(10800)
+    assert [i.strike_price for i in entering] == [10700, 10800, 10900]
+    assert leaving == ['NIFTY18FEB10400CE', 'NIFTY18FEB10500CE',
+                       'NIFTY18FEB10600CE']
+    # Still held, so it is leaving again; back in the window it is not
+    window.held.add('NIFTY18FEB10400CE')
+    entering, leaving = window.move(10500)
+    assert [i.strike_price for i in entering] == [10500, 10600]
+    assert window.held == set() and 'NIFTY18FEB10400CE' not in leaving
+    print('test_chain passed')
+
+
+if __name__ == '__main__':
+    test_chain()
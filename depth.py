@@ -0,0 +1,56 @@
+'''Order book capture from LiveFeedType.Full quotes.
+
+Each quote becomes one fixed-width row: the top levels of bids and asks
+(price, quantity, orders) plus total buy/sell quantity, open interest,
+traded volume and spot price. StockDB stores the rows in typed columns of
+its depth table.
+'''
+
+# Upstox full feed carries five levels a side
+DEPTH_LEVELS = 5
+
+_totals = ('tbq', 'tsq', 'oi', 'vtt', 'spot')
+
+
+def depth_fields(levels=DEPTH_LEVELS):
+    '''Column names after ts: bp1..N, bq1..N, bo1..N, then ap/aq/ao for
+    asks, then the totals.'''
+    names = []
+    for side in ('b', 'a'):
+        for kind in ('p', 'q', 'o'):
+            names.extend('{}{}{}'.format(side, kind, i + 1)
+                         for i in range(levels))
+    return names + list(_totals)
+
+
+def _side(book, levels):
+    prices = [0.0] * levels
+    qtys = [0] * levels
+    orders = [0] * levels
+    if book:
+        for i, lvl in enumerate(book[:levels]):
+            prices[i] = lvl['price']
+            qtys[i] = lvl['quantity']
+            orders[i] = lvl['orders']
+    return prices + qtys + orders
+
+
+def depth_row(quote, levels=DEPTH_LEVELS):
+    '(ts, *depth_fields) tuple from a full quote, missing levels are 0'
+    return tuple([int(quote['timestamp'])] +
+                 _side(quote.get('bids'), levels) +
+                 _side(quote.get('asks'), levels) +
+                 [quote.get('total_buy_qty') or 0,
+                  quote.get('total_sell_qty') or 0,
+                  quote.get('oi') or 0.0,
+                  quote.get('vtt') or 0.0,
+                  quote.get('spot_price') or 0.0])
+
+
+def imbalance_sql(levels):
+    '''SQL expression for (bid qty - ask qty) / (bid qty + ask qty) over the
+    top levels, NULL when both sides are empty.'''
+    bids = ' + '.join('bq{}'.format(i + 1) for i in range(levels))
+    asks = ' + '.join('aq{}'.format(i + 1) for i in range(levels))
+    return '(({b}) - ({a})) * 1.0 / NULLIF(({b}) + ({a}), 0)'.\
+           format(b=bids, a=asks)
@@ -0,0 +1,266 @@
+'''Bounded queues between the Upstox websocket thread and the
+TradeCenter listener.
+
+The websocket thread is the only producer and the listener the only
+consumer of each buffer. Entries are [enqueue_time, message] lists so the
+listener can measure how long a message waited before it was processed.
+'''
+
+from collections import deque, namedtuple
+import threading
+import time
+from utils import LatencyStats
+
+Pols = namedtuple('Overflow', 'drop_oldest coalesce block')
+Overflow = Pols(0, 1, 2)
+
+
+class RingBuffer:
+    '''Fixed capacity FIFO with a configurable overflow policy.
+
+    drop_oldest - the oldest pending message is discarded. Backed by a
+                  deque with maxlen, whose append/popleft are atomic, so
+                  neither side takes a lock.
+    coalesce    - a new message replaces the pending message with the same
+                  key (see key_func) and only drops the oldest when there
+                  is nothing to replace.
+    block       - the producer waits until the consumer makes room.
+    '''
+
+    def __init__(self, size=4096, policy=Overflow.drop_oldest, key_func=None):
+        self.size = size
+        self.policy = policy
+        self.key_func = key_func
+        self.received = 0
+        self.dropped = 0
+        self.replaced = 0
+        self.blocked = 0
+        # Set once the consumer is gone, so block no longer waits
+        self.closed = False
+        if policy == Overflow.drop_oldest:
+            self.items = deque(maxlen=size)
+        else:
+            self.items = deque()
+        # key -> pending entry, only maintained for coalesce
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, message):
+        entry = [time.perf_counter(), message]
+        self.received += 1
+        if self.policy == Overflow.drop_oldest:
+            if len(self.items) >= self.size:
+                self.dropped += 1
+            self.items.append(entry)
+        elif self.policy == Overflow.coalesce:
+            key = self.key_func(message)
+            with self.lock:
+                if len(self.items) >= self.size:
+                    current = self.pending.get(key)
+                    if current is not None:
+                        # Keep the original enqueue time so latency counts
+                        # from when the symbol first started waiting.
+                        current[1] = message
+                        self.replaced += 1
+                        return
+                    self._pop_oldest()
+                    self.dropped += 1
+                self.items.append(entry)
+                self.pending[key] = entry
+        else:
+            with self.not_full:
+                if len(self.items) >= self.size:
+                    self.blocked += 1
+                    while len(self.items) >= self.size and not self.closed:
+                        self.not_full.wait(0.5)
+                    if self.closed and len(self.items) >= self.size:
+                        # Nobody will drain it any more
+                        self.dropped += 1
+                        return
+                self.items.append(entry)
+
+    def close(self):
+        with self.not_full:
+            self.closed = True
+            self.not_full.notify_all()
+
+    def _pop_oldest(self):
+        entry = self.items.popleft()
+        key = self.key_func(entry[1])
+        if self.pending.get(key) is entry:
+            del self.pending[key]
+        return entry
+
+    def drain(self, max_items=0):
+        '''Removes and returns up to max_items entries (all if 0) in arrival
+        order.'''
+        n = len(self.items)
+        if max_items > 0 and n > max_items:
+            n = max_items
+        batch = []
+        if n == 0:
+            return batch
+        if self.policy == Overflow.drop_oldest:
+            popleft = self.items.popleft
+            try:
+                for _ in range(n):
+                    batch.append(popleft())
+            except IndexError:
+                pass
+        elif self.policy == Overflow.coalesce:
+            with self.lock:
+                for _ in range(n):
+                    batch.append(self._pop_oldest())
+        else:
+            with self.not_full:
+                for _ in range(n):
+                    batch.append(self.items.popleft())
+                self.not_full.notify_all()
+        return batch
+
+    def stats(self):
+        return {'depth': len(self.items),
+                'size': self.size,
+                'received': self.received,
+                'dropped': self.dropped,
+                'replaced': self.replaced,
+                'blocked': self.blocked}
+
+
+class Dispatcher:
+    '''Quote, order and trade buffers plus the listener wakeup event.
+
+    Order and trade updates are never dropped; only the quote stream uses
+    the configured overflow policy.'''
+
+    def __init__(self, size=4096, policy=Overflow.drop_oldest, batch_size=512):
+        self.quotes = RingBuffer(size, policy,
+                                 key_func=lambda m: m['symbol'])
+        self.orders = RingBuffer(size, Overflow.block)
+        self.trades = RingBuffer(size, Overflow.block)
+        self.batch_size = batch_size
+        self.wakeup = threading.Event()
+        self.latency = LatencyStats()
+        self.coalesced = 0
+        self.processed = 0
+
+    def put_quote(self, message):
+        self.quotes.put(message)
+        self.wakeup.set()
+
+    def put_order(self, message):
+        self.orders.put(message)
+        self.wakeup.set()
+
+    def put_trade(self, message):
+        self.trades.put(message)
+        self.wakeup.set()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def close(self):
+        'Called when the listener exits, releases blocked producers'
+        for buf in (self.quotes, self.orders, self.trades):
+            buf.close()
+
+    def depth(self):
+        return len(self.quotes) + len(self.orders) + len(self.trades)
+
+    def wait(self, timeout=1.0):
+        '''Blocks until any buffer has data or timeout expires.
+
+        Returns immediately if work is still pending from a partial drain.'''
+        if self.depth() == 0:
+            self.wakeup.wait(timeout)
+        self.wakeup.clear()
+
+    def coalesce(self, entries):
+        '''Collapses drained quote entries to the latest one per symbol.
+
+        Returned entries keep the order in which each symbol last arrived.'''
+        latest = {}
+        for entry in entries:
+            sym = entry[1]['symbol']
+            if sym in latest:
+                del latest[sym]
+            latest[sym] = entry
+        self.coalesced += len(entries) - len(latest)
+        return list(latest.values())
+
+    def done(self, entry):
+        'Records end-to-end latency for a processed entry'
+        self.processed += 1
+        self.latency.add(time.perf_counter() - entry[0])
+
+    def idle(self):
+        'True once every message put so far has been processed'
+        queued = 0
+        for buf in (self.quotes, self.orders, self.trades):
+            queued += buf.received - buf.dropped - buf.replaced
+        return queued == self.processed
+
+    def stats(self):
+        return {'quotes': self.quotes.stats(),
+                'orders': self.orders.stats(),
+                'trades': self.trades.stats(),
+                'coalesced': self.coalesced,
+                'latency': self.latency.as_dict()}
+
+
+def test_dispatch():
+    'Overflow policies, coalescing and idle accounting'
+    q = lambda sym, n: {'symbol': sym, 'n': n}
+    buf = RingBuffer(3, Overflow.drop_oldest)
+    for i in range(5):
+        buf.put(q('A', i))
+    assert [e[1]['n'] for e in buf.drain()] == [2, 3, 4]
+    assert buf.stats()['dropped'] == 2
+
+    buf = RingBuffer(3, Overflow.coalesce, key_func=lambda m: m['symbol'])
+    for sym, n in (('A', 0), ('B', 1), ('C', 2), ('B', 3), ('D', 4)):
+        buf.put(q(sym, n))
+    # B replaced in place, then A dropped to make room for D
+    assert [(e[1]['symbol'], e[1]['n']) for e in buf.drain(2)] == \
+        [('B', 3), ('C', 2)]
+    assert [e[1]['symbol'] for e in buf.drain()] == ['D']
+    assert (buf.replaced, buf.dropped) == (1, 1)
+
+    buf = RingBuffer(2, Overflow.block)
+    buf.put(q('A', 0))
+    buf.put(q('A', 1))
+    t = threading.Thread(target=buf.put, args=(q('A', 2),))
+    t.start()
+    t.join(0.2)
+    assert t.is_alive() and buf.blocked == 1
+    assert [e[1]['n'] for e in buf.drain(1)] == [0]
+    t.join(1.0)
+    assert not t.is_alive()
+    assert [e[1]['n'] for e in buf.drain()] == [1, 2]
+    assert buf.dropped == 0
+    # Once closed a full buffer drops instead of blocking forever
+    buf.put(q('A', 3))
+    buf.put(q('A', 4))
+    buf.close()
+    buf.put(q('A', 5))
+    assert buf.dropped == 1
+
+    d = Dispatcher(4, Overflow.coalesce)
+    for n in range(6):
+        d.put_quote(q('A' if n % 2 else 'B', n))
+    d.put_order(q('A', 6))
+    assert not d.idle()
+    entries = d.quotes.drain()
+    assert [e[1]['n'] for e in d.coalesce(entries)] == [4, 5]
+    for e in entries + d.orders.drain():
+        d.done(e)
+    assert d.idle()
+    print('test_dispatch passed')
+
+
+if __name__ == '__main__':
+    test_dispatch()
@@ -1,3 +1,4 @@
+from bisect import bisect_right
 from datetime import datetime
 from math import sqrt
 
@@ -6,32 +7,212 @@ from upstox_api.api import TransactionType, OrderType, ProductType, DurationType
 from utils import is_trade_active, round_off, Actions, print_s, print_l
 from utils import TradeStrategy
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class GannLevels:
+    '''Gann resistance and support levels for many symbols at once.
+
+    Every symbol has a row of resistance (sqrt(p) + a)**2 and support
+    (sqrt(p) - a)**2 levels, one per angle a. A row is recomputed only when
+    the anchor price p of its symbol changes; set_many() recomputes any
+    number of rows in one vectorized step. Rows are kept as tuples, shared
+    by every strategy of the symbol, so band() is a plain bisect. Strategies
+    discard() their row when they are dropped.
+    '''
+    engines = {}
+
+    @classmethod
+    def shared(cls, angles):
+        'One engine per angle set, shared by every strategy using it'
+        angles = tuple(angles)
+        engine = cls.engines.get(angles)
+        if engine is None:
+            engine = cls.engines[angles] = cls(angles)
+        return engine
+
+    def __init__(self, angles):
+        self.angles = tuple(angles)
+        self.index = {}
+        self.symbols = []
+        self.res_anchor = []
+        self.sup_anchor = []
+        self.res_rows = []
+        self.sup_rows = []
+        self.ladders = []
+        self.recomputed = 0
+        if np is not None:
+            self.angle_arr = np.array(self.angles)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def row(self, symbol):
+        'Row of symbol, added on first use'
+        i = self.index.get(symbol)
+        if i is not None:
+            return i
+        i = self.index[symbol] = len(self.symbols)
+        self.symbols.append(symbol)
+        self.res_anchor.append(None)
+        self.sup_anchor.append(None)
+        self.res_rows.append(None)
+        self.sup_rows.append(None)
+        self.ladders.append(None)
+        return i
+
+    def discard(self, symbol):
+        '''Drops the row of symbol, moving the last row into its place.
+        The engine itself is dropped from engines once it is empty.'''
+        i = self.index.pop(symbol, None)
+        if i is None:
+            return
+        rows = (self.symbols, self.res_anchor, self.sup_anchor,
+                self.res_rows, self.sup_rows, self.ladders)
+        last = len(self.symbols) - 1
+        if i != last:
+            for col in rows:
+                col[i] = col[last]
+            self.index[self.symbols[i]] = i
+        for col in rows:
+            col.pop()
+        if not self.symbols and self.engines.get(self.angles) is self:
+            del self.engines[self.angles]
+
+    def set_resistance(self, symbol, price):
+        'Resistance levels of symbol anchored at price, a tuple'
+        i = self.row(symbol)
+        if self.res_anchor[i] != price:
+            root = sqrt(price)
+            # y * y rather than ** 2, same rounding as the numpy path
+            levels = tuple([(root + a) * (root + a) for a in self.angles])
+            self._store(i, price, levels, None)
+        return self.res_rows[i]
+
+    def set_support(self, symbol, price):
+        'Support levels of symbol anchored at price, a tuple'
+        i = self.row(symbol)
+        if self.sup_anchor[i] != price:
+            root = sqrt(price)
+            levels = tuple([(root - a) * (root - a) for a in self.angles])
+            self._store(i, None, None, (price, levels))
+        return self.sup_rows[i]
+
+    def set_many(self, symbols, prices, resistance=True, support=True):
+        '''Anchors many symbols at once, only rows whose anchor changed
+        are recomputed. Returns the number of rows recomputed.'''
+        if np is None:
+            before = self.recomputed
+            for s, p in zip(symbols, prices):
+                if resistance:
+                    self.set_resistance(s, p)
+                if support:
+                    self.set_support(s, p)
+            return self.recomputed - before
+        rows = np.array([self.row(s) for s in symbols], dtype=np.intp)
+        prices = np.asarray(prices, dtype=np.float64)
+        roots = np.sqrt(prices)[:, None]
+        count = 0
+        for kind, anchors, on in (('res', self.res_anchor, resistance),
+                                  ('sup', self.sup_anchor, support)):
+            if not on:
+                continue
+            stale = np.array([anchors[r] != p for r, p in
+                              zip(rows.tolist(), prices.tolist())],
+                             dtype=bool)
+            if not stale.any():
+                continue
+            idx = rows[stale]
+            if kind == 'res':
+                levels = np.square(roots[stale] + self.angle_arr)
+            else:
+                levels = np.square(roots[stale] - self.angle_arr)
+            for r, p, lv in zip(idx.tolist(), prices[stale].tolist(),
+                                map(tuple, levels.tolist())):
+                if kind == 'res':
+                    self._store(r, p, lv, None)
+                else:
+                    self._store(r, None, None, (p, lv))
+            count += len(idx)
+        return count
+
+    def _store(self, i, res_price, res_levels, sup):
+        if res_levels is not None:
+            self.res_anchor[i] = res_price
+            self.res_rows[i] = res_levels
+        if sup is not None:
+            self.sup_anchor[i], self.sup_rows[i] = sup
+        self.ladders[i] = None
+        self.recomputed += 1
+
+    def resistance(self, symbol):
+        return self.res_rows[self.index[symbol]]
+
+    def support(self, symbol):
+        return self.sup_rows[self.index[symbol]]
+
+    def ladder(self, symbol):
+        'Every support and resistance level of symbol in ascending order'
+        i = self.index[symbol]
+        ladder = self.ladders[i]
+        if ladder is None:
+            ladder = self.ladders[i] = sorted((self.sup_rows[i] or ()) +
+                                              (self.res_rows[i] or ()))
+        return ladder
+
+    def band(self, symbol, ltp):
+        '''Position of ltp on the ladder: levels ladder[band - 1] <= ltp <
+        ladder[band]. 0 is below every level.'''
+        return bisect_right(self.ladder(symbol), ltp)
+
 
 
 class GannAngles(TradeStrategy):
+    __slots__ = ('test', 'ohlc', 'epoch', 'res_vals', 'sup_vals',
+                 'res_trigger', 'sup_trigger', 'init', 'buy_orderid',
+                 'stoploss_orderid', 'target_orderid', 'sell_orderid',
+                 'ordered', 'order_attempts', 'stoploss_order', 'modifying',
+                 'closed')
 
-    test = False
+    # Tunables, shared by every instance
     gann_angles = [0.02, 0.04, 0.08, 0.1, 0.15, 0.25, 0.35,
                    0.4, 0.42, 0.46, 0.48, 0.5, 0.67, 1.0]
-    res_vals = []
-    sup_vals = []
-    res_trigger = 0.0
-    sup_trigger = 0.0
-    init = False
-    buy_orderid = 0
-    stoploss_orderid = 0
-    target_orderid = 0
-    sell_orderid = 0
-    ordered = False
-    order_attempts = 0
+    # Indices into gann_angles used for the OCO bracket
+    trigger_idx = 3
+    price_idx = 4
+    support_idx = 5
+    target_idx = -1
+    quantity = 75
     max_attempts = 5
-    orders = []
-    trades = []
+
+    def __init__(self, inst):
+        TradeStrategy.__init__(self, inst)
+        self.test = False
+        self.ohlc = None
+        self.epoch = 0.0
+        self.res_vals = ()
+        self.sup_vals = ()
+        self.res_trigger = 0.0
+        self.sup_trigger = 0.0
+        self.init = False
+        self.buy_orderid = 0
+        self.stoploss_orderid = 0
+        self.target_orderid = 0
+        self.sell_orderid = 0
+        self.ordered = False
+        self.order_attempts = 0
+        self.stoploss_order = None
+        self.modifying = False
+        self.closed = False
 
     def initialize(self, quote_info, test=False):
         self.ohlc = OHLC().fromquote(quote_info)
         self.test = test
-        if is_trade_active():
+        # Quote time rather than wall clock, so replayed ticks work too
+        if is_trade_active(datetime.fromtimestamp(self.ohlc.epoch)):
             self.calc_resistance(self.ohlc.ltp)
             self.calc_support(self.ohlc.ltp)
             self.init = True
@@ -48,25 +229,75 @@ class GannAngles(TradeStrategy):
             return Actions.none, None
         self.last_update = datetime.now()
 
-        self.ohlc.ltp = float(quote_info['ltp'])
-        self.ohlc.atp = float(quote_info['atp'])
-        self.ohlc.op = float(quote_info['open'])
-        self.ohlc.hi = float(quote_info['high'])
-        self.ohlc.lo = float(quote_info['low'])
-        self.ohlc.cl = float(quote_info['close'])
-        self.epoch = int(quote_info['timestamp']) / 1000
+        # Only ltp drives the strategy, the rest is parsed on demand
+        ltp = float(quote_info['ltp'])
+        self.ohlc.ltp = ltp
 
         if self.ordered or self.order_attempts > self.max_attempts:
             return Actions.none, None
-        elif self.ohlc.ltp >= self.res_trigger and is_trade_active():
-            self.ordered = True
-            print_l('Order attempt {} of {}'.format(self.order_attempts,
-                                                    self.max_attempts))
-            return Actions.buy, self.buy_args()
-        elif self.ohlc.ltp <= self.sup_trigger:
-            self.calc_resistance(self.ohlc.ltp)
+        elif ltp >= self.res_trigger:
+            self.epoch = int(quote_info['timestamp']) / 1000
+            if is_trade_active(datetime.fromtimestamp(self.epoch)):
+                self.ordered = True
+                print_l('Order attempt {} of {}'.format(self.order_attempts,
+                                                        self.max_attempts))
+                return Actions.buy, self.buy_args()
+        elif ltp <= self.sup_trigger:
+            # Cached by the level engine while ltp stays the same
+            self.calc_resistance(ltp)
         return Actions.none, None
 
+    @classmethod
+    def on_quotes(cls, batch, strategies):
+        '''Vectorized quote_update over the latest quote of many symbols.
+
+        Trigger levels are compared for the whole batch at once; only
+        symbols that cross a trigger or are not initialized yet go through
+        the per quote path, and resistance is re-anchored for every symbol
+        at or below support in one GannLevels.set_many() call.'''
+        if np is None:
+            return super(GannAngles, cls).on_quotes(batch, strategies)
+        n = len(batch)
+        insts = [strategies[sym] for sym in batch.symbols]
+        res = np.full(n, np.inf)
+        sup = np.full(n, -np.inf)
+        slow = []
+        now = datetime.now()
+        for i, s in enumerate(insts):
+            if not s.init:
+                slow.append(i)
+            elif not s.ordered and s.order_attempts <= s.max_attempts:
+                res[i] = s.res_trigger
+                sup[i] = s.sup_trigger
+        ltp = batch.ltp
+        hit = ltp >= res
+        slow.extend(np.flatnonzero(hit).tolist())
+        actions = []
+        for i in slow:
+            action, args = insts[i].quote_update(batch.quotes[i])
+            if action != Actions.none:
+                actions.append((batch.symbols[i], action, args))
+
+        # Same precedence as quote_update: a buy trigger wins over support
+        low = np.flatnonzero((ltp <= sup) & ~hit).tolist()
+        shared = [i for i in low if insts[i].gann_angles is cls.gann_angles]
+        if shared:
+            levels = GannLevels.shared(cls.gann_angles)
+            levels.set_many([insts[i].instrument.symbol for i in shared],
+                            ltp[shared], support=False)
+        for i in low:
+            s = insts[i]
+            if s.gann_angles is cls.gann_angles:
+                s.res_vals = levels.resistance(s.instrument.symbol)
+                s.res_trigger = s.res_vals[s.trigger_idx]
+            else:
+                s.calc_resistance(float(ltp[i]))
+        for i, s in enumerate(insts):
+            if s.init:
+                s.ohlc.ltp = float(ltp[i])
+                s.last_update = now
+        return actions
+
     def order_update(self, order_info):
         if self.not_rejected(order_info['status']):
             if order_info['transaction_type'] == 'B':
@@ -77,7 +308,13 @@ class GannAngles(TradeStrategy):
                 self.stoploss_orderid = order_info['order_id']
             else:
                 self.target_orderid = order_info['order_id']
+            if order_info['transaction_type'] == 'S' and \
+               order_info['status'] == 'complete':
+                # One leg of the bracket filled, the position is closed
+                self.closed = True
         else:
+            if order_info['transaction_type'] == 'B':
+                self.closed = True
             self.order_attempts += 1
             print_l('Order rejected, {} attempts remaining'.format(self.max_attempts -
                     self.order_attempts))
@@ -86,25 +323,40 @@ class GannAngles(TradeStrategy):
     def trade_update(self, trade_info):
         if trade_info['transaction_type'] == 'S':
             self.sell_orderid = trade_info['transaction_type']
+            self.closed = True
         self.trades.append(trade_info)
 
 
+    @property
+    def levels(self):
+        'GannLevels engine shared by every strategy with these angles'
+        return GannLevels.shared(self.gann_angles)
+
+    def busy(self):
+        'True from the buy order until the position is closed or the buy fails'
+        return self.ordered and not self.closed
+
+    def close(self):
+        'Drops the level row of the symbol from the shared engine'
+        engine = GannLevels.engines.get(tuple(self.gann_angles))
+        if engine is not None:
+            engine.discard(self.instrument.symbol)
+
     def calc_resistance(self, price):
-        resistance = []
-        for x in self.gann_angles:
-            tmp = (sqrt(price) + x)**2
-            resistance.append(tmp)
-        self.res_vals = resistance
-        self.res_trigger = resistance[3]
+        self.res_vals = self.levels.set_resistance(self.instrument.symbol,
+                                                   price)
+        self.res_trigger = self.res_vals[self.trigger_idx]
 
 
     def calc_support(self, price):
-        support = []
-        for x in self.gann_angles:
-            tmp = (sqrt(price) - x)**2
-            support.append(tmp)
-        self.sup_vals = support
-        self.sup_trigger = support[5]
+        self.sup_vals = self.levels.set_support(self.instrument.symbol, price)
+        self.sup_trigger = self.sup_vals[self.support_idx]
+
+    def band(self, ltp=None):
+        'Band of ltp (default the last one) on the Gann level ladder'
+        if ltp is None:
+            ltp = self.ohlc.ltp
+        return self.levels.band(self.instrument.symbol, ltp)
 
     def buy_args(self):
         '''
@@ -125,17 +377,18 @@ class GannAngles(TradeStrategy):
         12 - Multiplier for 5 paise. Resultant no. is the flexibility
              given while placing orders.
         '''
+        price = self.res_vals[self.price_idx]
         args = (TransactionType.Buy,
                 self.instrument,
-                75,
+                self.quantity,
                 OrderType.StopLossLimit,
                 ProductType.OneCancelsOther,
-                round_off(self.res_vals[4]),
-                round_off(self.res_vals[3]),
+                round_off(price),
+                round_off(self.res_vals[self.trigger_idx]),
                 0,
                 DurationType.DAY,
-                round_off(self.res_vals[4] - self.sup_vals[5]),
-                round_off(self.res_vals[-1] - self.res_vals[4]),
+                round_off(price - self.sup_vals[self.support_idx]),
+                round_off(self.res_vals[self.target_idx] - price),
                 None
                 )
 
@@ -152,3 +405,57 @@ class GannAngles(TradeStrategy):
         if status == 'cancelled' or status == 'rejected':
             return False
         return True
+
+
+def test_gann():
+    'Instances must not share state and histories must stay bounded'
+    from collections import namedtuple
+    Inst = namedtuple('Instrument', 'exchange token symbol lot_size')
+    a = GannAngles(Inst('NSE_FO', 1, 'TESTA18FEB100CE', 75))
+    b = GannAngles(Inst('NSE_FO', 2, 'TESTB18FEB100CE', 75))
+    assert not hasattr(a, '__dict__')
+    for i in range(GannAngles.history * 3):
+        a.order_update({'status': 'open', 'transaction_type': 'B',
+                        'order_id': i, 'trigger_price': 0})
+        a.trade_update({'transaction_type': 'S', 'order_id': i})
+    assert len(a.orders) == GannAngles.history
+    assert len(a.trades) == GannAngles.history
+    assert len(b.orders) == 0 and len(b.trades) == 0
+    assert a.buy_orderid == GannAngles.history * 3 - 1
+    assert b.buy_orderid == 0
+
+    a.calc_resistance(100.0)
+    b.calc_resistance(200.0)
+    assert a.res_vals is not b.res_vals
+    assert a.res_trigger != b.res_trigger
+    assert len(b.res_vals) == len(GannAngles.gann_angles)
+
+    tuned = GannAngles.with_params(trigger_idx=2, quantity=150)
+    c = tuned(Inst('NSE_FO', 3, 'TESTC18FEB100CE', 75))
+    assert c.trigger_idx == 2 and c.quantity == 150
+    assert a.trigger_idx == GannAngles.trigger_idx == 3
+    assert not hasattr(c, '__dict__')
+
+    levels = GannLevels(GannAngles.gann_angles)
+    assert levels.set_many(['A', 'B'], [100.0, 200.0]) == 4
+    assert levels.set_many(['A', 'B'], [100.0, 201.0]) == 2
+    assert levels.set_many(['A', 'B'], [100.0, 201.0]) == 0
+    assert levels.resistance('B') == \
+        GannLevels(levels.angles).set_resistance('B', 201.0)
+
+    tuned = GannAngles.with_params(gann_angles=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6])
+    d = tuned(Inst('NSE_FO', 4, 'TESTD18FEB100CE', 75))
+    e = tuned(Inst('NSE_FO', 5, 'TESTE18FEB100CE', 75))
+    d.calc_resistance(100.0)
+    e.calc_resistance(110.0)
+    res = e.res_vals
+    d.close()
+    assert e.levels.resistance(e.instrument.symbol) is res
+    assert len(e.levels) == 1
+    e.close()
+    assert tuple(tuned.gann_angles) not in GannLevels.engines
+    print('test_gann passed')
+
+
+if __name__ == '__main__':
+    test_gann()
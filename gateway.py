@@ -0,0 +1,324 @@
+'''Order gateway: places and modifies orders off the listener thread.
+
+Strategies hand order intents to OrderGateway.submit, which returns at
+once. A small pool of worker threads sends them to the broker, no faster
+than a token bucket allows. Every symbol has at most one request in
+flight: a repeated buy is dropped while one is pending, and a newer
+stoploss modification replaces a queued one, so only the latest trigger is
+sent. Broker responses and failures are reported as order update messages,
+which TradeCenter feeds through its usual order_update path. Intents the
+gateway cannot send, because its queue is full or it has been stopped, are
+reported as rejected.
+'''
+
+from collections import namedtuple
+import queue
+import threading
+import time
+from utils import Actions, LatencyStats, print_l
+
+Intent = namedtuple('Intent', 'symbol action args submitted')
+
+
+class TokenBucket:
+    'Allows rate requests per second on average, burst at once'
+
+    def __init__(self, rate=10.0, burst=10):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last = time.perf_counter()
+        self.lock = threading.Lock()
+        self.waits = 0
+
+    def take(self):
+        'Blocks until a token is available. Returns the seconds waited.'
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.perf_counter()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    if waited:
+                        self.waits += 1
+                    return waited
+                delay = (1.0 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class OrderGateway:
+    '''Worker pool sending order intents to the broker.
+
+    send(action, args) makes the broker call and returns its response.
+    report(message) receives an order update dict for every response and
+    failure. ack holds submit to response latency, including time spent
+    queued and rate limited; call holds the broker call alone.
+    '''
+
+    def __init__(self, send, report, workers=4, rate=10.0, burst=10,
+                 max_pending=256):
+        self.send = send
+        self.report = report
+        self.workers = workers
+        self.bucket = TokenBucket(rate, burst)
+        self.queue = queue.Queue(max_pending)
+        self.lock = threading.Lock()
+        # symbol -> intent queued or being sent
+        self.inflight = {}
+        # symbol -> intent waiting for the in-flight one to finish
+        self.waiting = {}
+        self.threads = []
+        self.running = False
+        self.ack = LatencyStats()
+        self.call = LatencyStats()
+        self.submitted = 0
+        self.sent = 0
+        self.deduped = 0
+        self.replaced = 0
+        self.failed = 0
+        self.rejected = 0
+        # Reports taken off inflight but not passed on yet
+        self.reporting = 0
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        for i in range(self.workers):
+            t = threading.Thread(target=self.run, daemon=True,
+                                 name='order-{}'.format(i))
+            t.start()
+            self.threads.append(t)
+
+    def stop(self, timeout=5.0):
+        '''Sends what is queued, then stops the workers. Intents submitted
+        from now on, or still waiting for an earlier one of their symbol,
+        are rejected with a report.'''
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join(timeout)
+        self.threads = []
+        reports = []
+        with self.lock:
+            left = list(self.waiting.values())
+            self.waiting.clear()
+            while True:
+                try:
+                    intent = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if intent is not None:
+                    left.append(intent)
+            for intent in left:
+                self.inflight.pop(intent.symbol, None)
+                self._reject(intent, 'order gateway stopped', reports)
+        if left:
+            print_l('Order gateway stopped with unsent orders',
+                    count=len(left))
+        self._send_reports(reports)
+
+    def submit(self, symbol, action, args):
+        '''Queues an order intent. Returns False if it was dropped as a
+        duplicate, or rejected because the queue is full or the gateway
+        is stopped.'''
+        intent = Intent(symbol.upper(), action, args, time.perf_counter())
+        reports = []
+        with self.lock:
+            self.submitted += 1
+            current = self.inflight.get(intent.symbol)
+            if current is not None and self.running:
+                if action == Actions.mod_sl:
+                    if intent.symbol in self.waiting:
+                        self.replaced += 1
+                    self.waiting[intent.symbol] = intent
+                    return True
+                self.deduped += 1
+                return False
+            queued = self._enqueue(intent, reports)
+        self._send_reports(reports)
+        return queued
+
+    def _enqueue(self, intent, reports):
+        '''Called with the lock held. A rejection report is added to
+        reports, to be sent once the lock is released.'''
+        if not self.running:
+            self._reject(intent, 'order gateway stopped', reports)
+            return False
+        try:
+            self.queue.put_nowait(intent)
+        except queue.Full:
+            print_l('Order queue full, dropping order', symbol=intent.symbol)
+            self._reject(intent, 'order queue full', reports)
+            return False
+        self.inflight[intent.symbol] = intent
+        return True
+
+    def _reject(self, intent, error, reports):
+        'Called with the lock held'
+        self.rejected += 1
+        self.reporting += 1
+        reports.append((intent, None, 'rejected', error))
+
+    def _send_reports(self, reports):
+        '''Passes (intent, response, status, error) reports on. Must be
+        called without the lock, report() may call back into submit.'''
+        try:
+            for report in reports:
+                self._report(*report)
+        finally:
+            if reports:
+                with self.lock:
+                    self.reporting -= len(reports)
+
+    def run(self):
+        while True:
+            intent = self.queue.get()
+            if intent is None:
+                break
+            self.bucket.take()
+            start = time.perf_counter()
+            try:
+                response = self.send(intent.action, intent.args)
+                status, error = None, None
+            except Exception as e:
+                response, status, error = None, 'rejected', str(e)
+                print_l('Order request failed', symbol=intent.symbol,
+                        error=error)
+            end = time.perf_counter()
+            self.call.add(end - start)
+            self.ack.add(end - intent.submitted)
+            reports = [(intent, response, status, error)]
+            with self.lock:
+                self.sent += 1
+                self.reporting += 1
+                if error is not None:
+                    self.failed += 1
+                del self.inflight[intent.symbol]
+                following = self.waiting.pop(intent.symbol, None)
+                if following is not None:
+                    self._enqueue(following, reports)
+            self._send_reports(reports)
+
+    def _report(self, intent, response, status=None, error=None):
+        'Passes the broker response or failure on as an order update'
+        if intent.action == Actions.buy:
+            side = intent.args[0]
+            message = {'transaction_type': getattr(side, 'value', side),
+                       'trigger_price': intent.args[6]}
+        else:
+            message = {'transaction_type': 'S',
+                       'order_id': intent.args[0],
+                       'trigger_price': intent.args[1]}
+        if isinstance(response, dict):
+            message.update(response)
+        elif response is None and error is None:
+            # Nothing to report, the broker's own order update will follow
+            return
+        message['symbol'] = intent.symbol
+        message.setdefault('order_id', None)
+        if status is not None:
+            message['status'] = status
+        message.setdefault('status', 'open pending')
+        if error is not None:
+            message['message'] = error
+        self.report(message)
+
+    def idle(self):
+        'True when no intent is queued or being sent and all are reported'
+        with self.lock:
+            return not self.inflight and not self.reporting
+
+    def stats(self):
+        with self.lock:
+            stats = {'submitted': self.submitted, 'sent': self.sent,
+                     'deduped': self.deduped, 'replaced': self.replaced,
+                     'failed': self.failed, 'rejected': self.rejected,
+                     'inflight': len(self.inflight),
+                     'rate_waits': self.bucket.waits}
+        stats['ack'] = self.ack.as_dict()
+        stats['call'] = self.call.as_dict()
+        return stats
+
+
+def test_gateway():
+    'Rate limit, dedupe, stoploss replacement and rejections'
+    bucket = TokenBucket(rate=20, burst=2)
+    start = time.perf_counter()
+    for i in range(6):
+        bucket.take()
+    assert time.perf_counter() - start >= 0.19 and bucket.waits == 4
+
+    calls = []
+    reports = []
+    sending = threading.Event()
+    go = threading.Event()
+
+    def send(action, args):
+        calls.append((action, args))
+        sending.set()
+        go.wait(5.0)
+        if action == Actions.buy:
+            return {'order_id': len(calls)}
+
+    def report(message):
+        # Reports are never sent with the gateway lock held
+        assert not gw.lock.locked()
+        reports.append((message['symbol'], message['status'],
+                        message.get('message')))
+
+    buy = ('B', None, None, None, None, None, 99.0)
+    gw = OrderGateway(send, report, workers=1, rate=1000, burst=100,
+                      max_pending=1)
+    gw.start()
+
+    def wait_idle():
+        deadline = time.perf_counter() + 5.0
+        while not gw.idle() and time.perf_counter() < deadline:
+            time.sleep(0.01)
+        assert gw.idle()
+
+    assert gw.submit('a', Actions.buy, buy)
+    sending.wait(5.0)
+    assert gw.submit('B', Actions.buy, buy)
+    assert not gw.submit('C', Actions.buy, buy)
+    assert reports == [('C', 'rejected', 'order queue full')]
+    assert not gw.idle()
+    go.set()
+    wait_idle()
+    assert len(calls) == 2 and len(reports) == 3
+
+    go.clear()
+    sending.clear()
+    assert gw.submit('A', Actions.buy, buy)
+    sending.wait(5.0)
+    assert not gw.submit('A', Actions.buy, buy)
+    assert gw.submit('A', Actions.mod_sl, (1, 98.0))
+    assert gw.submit('A', Actions.mod_sl, (1, 97.0))
+    go.set()
+    wait_idle()
+    # Only the latest stoploss is sent, after the buy of its symbol
+    assert calls[2:] == [(Actions.buy, buy), (Actions.mod_sl, (1, 97.0))]
+    assert sorted(reports) == [('A', 'open pending', None),
+                               ('A', 'open pending', None),
+                               ('B', 'open pending', None),
+                               ('C', 'rejected', 'order queue full')]
+    gw.stop()
+    assert not gw.submit('D', Actions.buy, buy)
+    assert reports[-1] == ('D', 'rejected', 'order gateway stopped')
+    stats = gw.stats()
+    assert (stats['submitted'], stats['sent'], stats['deduped'],
+            stats['replaced'], stats['rejected']) == (8, 4, 1, 1, 2)
+    print('test_gateway passed')
+
+
+if __name__ == '__main__':
+    test_gateway()
@@ -0,0 +1,223 @@
+'''Bulk import of OHLC csv logs into StockDB.
+
+Files are streamed with OHLCLog.iter_rows and inserted chunk_rows at a time
+with executemany, one transaction per chunk. With several files and
+workers > 1, a process pool parses files into TickBuffers while this
+process does the inserts, as SQLite has a single writer.
+
+    python importer.py stock_db.sqlite logs/ --schema ticks --workers 4
+'''
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import os
+import re
+import time
+from ohlc import OHLCLog, TickBuffer
+from stockdb import StockDB, table_types
+from utils import print_l
+
+# OHLC-<symbol>-<ddMonyy>.csv, or <symbol>OHLC<ddMonyy>.csv from OHLClogger
+FILE_RE = re.compile(r'^(?:OHLC-(.+)-\d{2}[A-Za-z]{3}\d{2}|'
+                     r'(.+)OHLC\d{2}[A-Za-z]{3}\d{2})\.csv$')
+
+
+def symbol_from_filename(filename):
+    'Symbol encoded in an OHLC log file name, None if it does not match'
+    m = FILE_RE.match(os.path.basename(filename))
+    if m is None:
+        return None
+    return (m.group(1) or m.group(2)).upper()
+
+
+def find_files(paths):
+    'csv files under paths (files or directories), sorted'
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                found.extend(os.path.join(root, f) for f in files
+                             if f.lower().endswith('.csv'))
+        else:
+            found.append(path)
+    return sorted(found)
+
+
+def write_rows(db, rows, tabletype, tables):
+    '''Inserts a chunk of OHLC objects, creating missing tables.
+    Returns the number of rows written.'''
+    batches = {}
+    for o in rows:
+        batch = batches.get(o.symbol)
+        if batch is None:
+            batch = batches[o.symbol] = []
+        batch.append(o)
+    for symbol in batches:
+        table = db.table_name(symbol, tabletype)
+        if table not in tables:
+            db.create_table(symbol, tabletype)
+            tables.add(table)
+    if not db.write_batches({(symbol, tabletype): batch
+                             for symbol, batch in batches.items()}):
+        return 0
+    return len(rows)
+
+
+def import_file(db, filename, tabletype=table_types.ohlc, chunk_rows=10000,
+                progress=None):
+    '''Streams one csv file into db, chunk_rows per transaction.
+
+    progress(filename, rows) is called after every chunk. Returns
+    (rows written, rows skipped).'''
+    stats = {}
+    rows = OHLCLog.iter_rows(filename, symbol_from_filename(filename), stats)
+    tables = set(db.tables)
+    written = 0
+    while True:
+        chunk = list(islice(rows, chunk_rows))
+        if not chunk:
+            break
+        written += write_rows(db, chunk, tabletype, tables)
+        if progress is not None:
+            progress(filename, written)
+    return written, stats.get('bad', 0)
+
+
+def parse_file(filename):
+    '''Pool worker: parses a csv file into {symbol: TickBuffer}.
+    Returns (filename, buffers, rows skipped).'''
+    stats = {}
+    buffers = {}
+    for o in OHLCLog.iter_rows(filename, symbol_from_filename(filename),
+                               stats):
+        buf = buffers.get(o.symbol)
+        if buf is None:
+            buf = buffers[o.symbol] = TickBuffer(o.symbol)
+        buf.append(o)
+    return filename, buffers, stats.get('bad', 0)
+
+
+def import_files(db, filenames, tabletype=table_types.ohlc, workers=None,
+                 chunk_rows=10000, progress=None):
+    '''Imports many csv files. With workers != 1 the files are parsed in
+    a process pool and written here as each one completes.
+
+    Returns {filename: (rows written, rows skipped)}.'''
+    results = {}
+    if workers == 1 or len(filenames) < 2:
+        for filename in filenames:
+            results[filename] = import_file(db, filename, tabletype,
+                                            chunk_rows, progress)
+        return results
+    tables = set(db.tables)
+    with ProcessPoolExecutor(workers) as pool:
+        for filename, buffers, bad in pool.map(parse_file, filenames):
+            written = 0
+            for buf in buffers.values():
+                for a in range(0, len(buf), chunk_rows):
+                    chunk = [buf[i] for i in
+                             range(a, min(a + chunk_rows, len(buf)))]
+                    written += write_rows(db, chunk, tabletype, tables)
+                    if progress is not None:
+                        progress(filename, written)
+            results[filename] = (written, bad)
+    return results
+
+
+class Progress:
+    'Prints rows imported per file at most every interval seconds'
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self.last = 0.0
+        self.started = time.perf_counter()
+        self.rows = {}
+
+    def __call__(self, filename, rows):
+        self.rows[filename] = rows
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            total = sum(self.rows.values())
+            print_l('{} rows from {} files ({:.0f} rows/s)'.format(
+                total, len(self.rows), total / (now - self.started)),
+                file=os.path.basename(filename))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import OHLC csv logs '
+                                     'into a StockDB')
+    parser.add_argument('db', help='StockDB file')
+    parser.add_argument('paths', nargs='+', help='csv files or directories')
+    parser.add_argument('--schema', choices=('ohlc', 'ticks'),
+                        default='ohlc', help='per symbol tables or the '
+                        'normalized ticks table')
+    parser.add_argument('--workers', type=int,
+                        help='parser processes, 1 to parse inline')
+    parser.add_argument('--chunk', type=int, default=10000,
+                        help='rows per transaction')
+    args = parser.parse_args()
+
+    files = find_files(args.paths)
+    db = StockDB()
+    db.initialize(args.db)
+    start = time.perf_counter()
+    results = import_files(db, files, table_types[args.schema], args.workers,
+                           args.chunk, Progress())
+    db.close()
+    elapsed = time.perf_counter() - start
+    rows = sum(r[0] for r in results.values())
+    bad = sum(r[1] for r in results.values())
+    print_l('Imported {} rows from {} files in {:.1f}s, {} skipped'.format(
+        rows, len(results), elapsed, bad))
+
+
+def test_importer():
+    'Inline and pool imports give the same rows, bad rows are skipped'
+    import csv
+    import tempfile
+    from datetime import datetime
+    folder = tempfile.mkdtemp()
+    t0 = datetime(2018, 2, 1, 9, 15)
+    ms = int(t0.timestamp() * 1000)
+    with open(os.path.join(folder, 'mixed.csv'), 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(OHLCLog.fields)
+        w.writerow((ms // 1000, 'imp', 1.0, 1.0, 1.0, 1.0, 1.0, 1.0))
+        w.writerow((ms + 1000, 'IMP', 2.0, 1.0, 1.0, 1.0, 1.0, 1.0))
+        w.writerow((t0.isoformat(' ') + '.5', 'IMP', 3, 1, 1, 1, 1, 1))
+        w.writerow((ms + 3000, 'IMP', 'n/a', 1.0, 1.0, 1.0, 1.0, 1.0))
+    # The symbol of a file without a symbol column comes from its name
+    name = os.path.join(folder, 'OHLC-other-01Feb18.csv')
+    with open(name, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(('time', 'ltp', 'atp', 'open', 'high', 'low', 'close'))
+        for i in range(25):
+            w.writerow((ms + i, 4.0 + i, 1.0, 1.0, 1.0, 1.0, 1.0))
+    assert symbol_from_filename(name) == 'OTHER'
+    files = find_files([folder])
+    ticks = []
+    for workers in (1, 2):
+        db = StockDB()
+        db.initialize(':memory:')
+        results = import_files(db, files, table_types.ticks, workers,
+                               chunk_rows=10)
+        assert sorted(results.values()) == [(3, 1), (25, 0)]
+        ticks.append({sym: db.get_ticks(sym) for sym in ('IMP', 'OTHER')})
+        db.close()
+    for sym in ('IMP', 'OTHER'):
+        assert list(ticks[0][sym]['ts']) == list(ticks[1][sym]['ts'])
+        assert list(ticks[0][sym]['ltp']) == list(ticks[1][sym]['ltp'])
+    assert list(ticks[0]['IMP']['ts']) == [ms, ms + 500, ms + 1000]
+    assert list(ticks[0]['IMP']['ltp']) == [1.0, 3.0, 2.0]
+    assert len(ticks[0]['OTHER']['ts']) == 25
+    print('test_importer passed')
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        main()
+    else:
+        test_importer()
@@ -0,0 +1,285 @@
+'''Local registry of Upstox master contracts.
+
+The master contracts are downloaded at most once a day and kept in a
+SQLite snapshot, so a warm restart loads them from disk. Instruments are
+indexed by symbol, by token and by (underlying, expiry, strike, kind) from
+utils.parse_symbol, which makes whole option chains a dict lookup.
+'''
+
+from collections import OrderedDict
+from datetime import date
+import os
+import sqlite3
+from upstox_api.api import Instrument
+from utils import parse_symbol, print_l
+
+DEFAULT_EXCHANGES = ('nse_fo', 'nse_index')
+
+# upstox_api has no public way to preload master contracts. Upstox keeps
+# them in these private dicts, {exchange: {symbol or token: Instrument}},
+# whose name mangled names install() relies on. A release of upstox_api
+# that renames them makes install() decline, and the client downloads the
+# contracts itself through get_master_contract.
+CLIENT_MASTERS = ('_Upstox__master_contracts_by_symbol',
+                  '_Upstox__master_contracts_by_token')
+
+
+def _to_db(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def _from_db(value):
+    'Expiry dates are stored as ISO text'
+    if isinstance(value, str) and len(value) == 10 and value[4] == '-':
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            pass
+    return value
+
+
+class InstrumentRegistry:
+    '''Indexed master contracts with a once a day on-disk snapshot.
+
+    load() reads today's snapshot, or downloads the exchanges through the
+    client and writes a new one. Lookups load the snapshot lazily if it is
+    already there. Symbols are matched case insensitively.
+    '''
+
+    def __init__(self, snapshot='instruments.sqlite'):
+        self.snapshot = snapshot
+        self.day = None
+        self.loaded = False
+        # exchange -> {symbol (lower case): Instrument}
+        self.by_symbol = {}
+        # exchange -> {token: Instrument}
+        self.by_token = {}
+        # (underlying, expiry, strike, kind) -> Instrument
+        self.contracts = {}
+        # (underlying, expiry) -> sorted strikes
+        self.strike_lists = {}
+
+    def __len__(self):
+        return sum(len(v) for v in self.by_token.values())
+
+    def load(self, client=None, exchanges=DEFAULT_EXCHANGES, refresh=False):
+        '''Loads today's snapshot, downloading missing exchanges with client.
+        Returns the number of instruments.'''
+        exchanges = [e.lower() for e in exchanges]
+        today = date.today().isoformat()
+        if not refresh and not self.loaded:
+            self.read_snapshot(today)
+        missing = [e for e in exchanges if e not in self.by_token]
+        if refresh:
+            missing = exchanges
+        if missing and client is not None:
+            for exchange in missing:
+                contract = client.get_master_contract(exchange)
+                self.add(exchange, contract.values())
+            self.day = today
+            self.write_snapshot()
+        self.loaded = True
+        return len(self)
+
+    def add(self, exchange, instruments):
+        exchange = exchange.lower()
+        symbols = self.by_symbol[exchange] = OrderedDict()
+        tokens = self.by_token[exchange] = OrderedDict()
+        strikes = {}
+        for inst in instruments:
+            symbols[inst.symbol.lower()] = inst
+            tokens[inst.token] = inst
+            c = parse_symbol(inst.symbol)
+            if c.kind is None:
+                continue
+            self.contracts[c] = inst
+            if c.strike is not None:
+                strikes.setdefault((c.underlying, c.expiry), set()).add(
+                    c.strike)
+        for key, found in strikes.items():
+            self.strike_lists[key] = sorted(found.union(
+                self.strike_lists.get(key, ())))
+
+    def read_snapshot(self, day=None):
+        'Loads the snapshot if it was written on day (ISO, default today)'
+        if not os.path.exists(self.snapshot):
+            return False
+        conn = sqlite3.connect(self.snapshot)
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'day'").\
+                  fetchone()
+            if row is None or row[0] != (day or date.today().isoformat()):
+                return False
+            exchanges = {}
+            for row in conn.execute('SELECT * FROM instruments '
+                                    'ORDER BY rowid'):
+                exchanges.setdefault(row[0], []).append(
+                    Instrument._make([_from_db(v) for v in row[1:]]))
+        except sqlite3.OperationalError:
+            return False
+        finally:
+            conn.close()
+        for exchange, instruments in exchanges.items():
+            self.add(exchange, instruments)
+        self.day = day
+        self.loaded = True
+        print_l('Loaded {} instruments from {}'.format(len(self),
+                                                         self.snapshot))
+        return True
+
+    def write_snapshot(self):
+        fields = Instrument._fields
+        conn = sqlite3.connect(self.snapshot)
+        try:
+            with conn:
+                conn.execute('DROP TABLE IF EXISTS instruments')
+                conn.execute('CREATE TABLE instruments (master TEXT, {})'.
+                             format(', '.join(fields)))
+                conn.execute('CREATE TABLE IF NOT EXISTS meta '
+                             '(key TEXT PRIMARY KEY, value TEXT)')
+                sql = 'INSERT INTO instruments VALUES ({})'.\
+                      format(', '.join(['?'] * (len(fields) + 1)))
+                for exchange, tokens in self.by_token.items():
+                    conn.executemany(sql, (
+                        [exchange] + [_to_db(getattr(inst, f, None))
+                                      for f in fields]
+                        for inst in tokens.values()))
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('day', ?)",
+                             (self.day,))
+        finally:
+            conn.close()
+
+    def install(self, client):
+        '''Hands the indexes to an upstox_api Upstox client so its own
+        get_instrument_by_symbol/subscribe work without a download.
+
+        Returns False, leaving the client untouched, if it does not have
+        the private tables of CLIENT_MASTERS.'''
+        if not all(hasattr(client, name) and
+                   isinstance(getattr(client, name), dict)
+                   for name in CLIENT_MASTERS):
+            print_l('Client has no master contract tables to install into')
+            return False
+        by_symbol, by_token = [getattr(client, name)
+                               for name in CLIENT_MASTERS]
+        by_symbol.update(self.by_symbol)
+        by_token.update(self.by_token)
+        enabled = getattr(client, 'enabled_exchanges', None)
+        if isinstance(enabled, list):
+            for exchange in self.by_token:
+                if exchange not in enabled:
+                    enabled.append(exchange)
+        return True
+
+    # Lookups
+
+    def _ensure(self):
+        if not self.loaded:
+            self.read_snapshot()
+            self.loaded = True
+
+    def get(self, exchange, symbol):
+        'Instrument for symbol on exchange, or None'
+        self._ensure()
+        return self.by_symbol.get(exchange.lower(), {}).get(symbol.lower())
+
+    def get_many(self, exchange, symbols):
+        'Instruments for symbols in order, None for unknown ones'
+        self._ensure()
+        table = self.by_symbol.get(exchange.lower(), {})
+        return [table.get(s.lower()) for s in symbols]
+
+    def by_token_id(self, exchange, token):
+        self._ensure()
+        return self.by_token.get(exchange.lower(), {}).get(token)
+
+    def option(self, underlying, expiry, strike, kind):
+        'Instrument of a contract, e.g. option("NIFTY", "18FEB", 11200, "CE")'
+        self._ensure()
+        return self.contracts.get((underlying.upper(), expiry.upper(),
+                                   float(strike), kind.upper()))
+
+    def strikes(self, underlying, expiry):
+        'Sorted strikes listed for underlying and expiry'
+        self._ensure()
+        return self.strike_lists.get((underlying.upper(), expiry.upper()), [])
+
+    def chain(self, underlying, expiry, strikes=None, kinds=('CE', 'PE')):
+        '''Instruments of an option chain, by strike then kind. strikes
+        defaults to every listed strike; unlisted contracts are left out.'''
+        if strikes is None:
+            strikes = self.strikes(underlying, expiry)
+        underlying = underlying.upper()
+        expiry = expiry.upper()
+        found = []
+        for strike in strikes:
+            for kind in kinds:
+                inst = self.contracts.get((underlying, expiry, float(strike),
+                                           kind))
+                if inst is not None:
+                    found.append(inst)
+        return found
+
+
+def test_instruments():
+    'Warm restart from the snapshot and the chain lookups'
+    import tempfile
+
+    class Client:
+        downloads = 0
+
+        def get_master_contract(self, exchange):
+            Client.downloads += 1
+            if exchange == 'nse_index':
+                return {'nifty_50': Instrument('NSE_INDEX', 26000, None,
+                                               'NIFTY_50', 'Nifty 50', 0.0,
+                                               None, None, 0.05, 1, '', '')}
+            expiry = date(2018, 2, 22)
+            return {s.lower(): Instrument('NSE_FO', 100 + i, 26000, s, '',
+                                          0.0, expiry, k, 0.05, 75, 'OPTIDX',
+                                          '')
+                    for i, (s, k) in enumerate(
+                        ('NIFTY18FEB{}{}'.format(k, kind), k)
+                        for k in (11300, 11100, 11200)
+                        for kind in ('CE', 'PE'))}
+
+    path = os.path.join(tempfile.mkdtemp(), 'instruments.sqlite')
+    reg = InstrumentRegistry(path)
+    assert reg.load(Client()) == 7 and Client.downloads == 2
+    reg = InstrumentRegistry(path)
+    assert reg.load(Client()) == 7 and Client.downloads == 2
+    inst = reg.get('nse_fo', 'nifty18feb11200ce')
+    assert inst.token == 104 and inst.expiry == date(2018, 2, 22)
+    assert reg.by_token_id('NSE_FO', 104) is inst
+    assert reg.get_many('NSE_FO', ['NIFTY18FEB11200CE', 'UNKNOWN']) == \
+        [inst, None]
+    assert reg.option('nifty', '18feb', 11200, 'ce') is inst
+    assert reg.strikes('NIFTY', '18FEB') == [11100.0, 11200.0, 11300.0]
+    assert [i.symbol for i in reg.chain('NIFTY', '18FEB', [11200, 11300],
+                                        ('CE',))] == \
+        ['NIFTY18FEB11200CE', 'NIFTY18FEB11300CE']
+    assert reg.get('NSE_INDEX', 'NIFTY_50').token == 26000
+    # Snapshots of another day are not used
+    assert not InstrumentRegistry(path).read_snapshot('2018-02-01')
+    reg.load(Client(), refresh=True)
+    assert Client.downloads == 4
+    # Only a client with the private upstox_api tables takes the indexes
+    client = Client()
+    assert not reg.install(client) and not hasattr(client, 'enabled_exchanges')
+    setattr(client, CLIENT_MASTERS[0], {})
+    setattr(client, CLIENT_MASTERS[1], {})
+    client.enabled_exchanges = ['nse_eq']
+    assert reg.install(client)
+    assert getattr(client, CLIENT_MASTERS[0])['nse_fo'][
+        'nifty18feb11200ce'].token == 104
+    assert getattr(client, CLIENT_MASTERS[1])['nse_index'][26000].symbol == \
+        'NIFTY_50'
+    assert sorted(client.enabled_exchanges) == ['nse_eq', 'nse_fo',
+                                                'nse_index']
+    print('test_instruments passed')
+
+
+if __name__ == '__main__':
+    test_instruments()
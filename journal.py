@@ -0,0 +1,433 @@
+'''Append-only binary tick journals, a lighter alternative to StockDB.
+
+One file per trading day and symbol, journal_dir/YYYYMMDD/SYMBOL.ticks:
+
+    header  64 bytes  magic, version, record size, count, first/last ts,
+                      flags
+    records 56 bytes  ts int64 (epoch ms), ltp atp open high low close
+                      float64
+
+Records are written into a memory map. The count in the header is updated
+after each batch has been copied in, so a crash can only lose the rows of
+the batch in flight; anything past count is ignored and overwritten on
+reopen. The reader maps the committed records as a NumPy structured array
+without copying.
+
+TickJournal has the StockDB methods PersistWorker uses (initialize,
+create_table, table_name, add_data, add_many, write_batches, close) and only
+stores table_types.ohlc and ticks rows.
+'''
+
+from datetime import datetime, timedelta
+import mmap
+import os
+import struct
+from stockdb import table_types, tick_columns, to_epoch_ms, join_columns
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MAGIC = b'TICKJRNL'
+VERSION = 1
+HEADER = struct.Struct('<8sIIqqqI')
+HEADER_SIZE = 64
+RECORD = struct.Struct('<q6d')
+RECORD_SIZE = RECORD.size
+# Header flags
+UNORDERED = 1
+
+if np is not None:
+    tick_dtype = np.dtype([('ts', '<i8'), ('ltp', '<f8'), ('atp', '<f8'),
+                           ('open', '<f8'), ('high', '<f8'), ('low', '<f8'),
+                           ('close', '<f8')])
+
+
+def day_key(ts):
+    'YYYYMMDD of the local trading day of an epoch ms timestamp'
+    return datetime.fromtimestamp(ts / 1000.0).strftime('%Y%m%d')
+
+
+def _day_span(ts):
+    'Local midnight to midnight of ts, in epoch ms'
+    day = datetime.fromtimestamp(ts / 1000.0).replace(
+        hour=0, minute=0, second=0, microsecond=0)
+    return (int(day.timestamp() * 1000),
+            int((day + timedelta(days=1)).timestamp() * 1000))
+
+
+def journal_path(root, symbol, day):
+    return os.path.join(root, day, '{}.ticks'.format(symbol.upper()))
+
+
+def read_header(buf):
+    'Returns (count, first_ts, last_ts, flags), raises ValueError if invalid'
+    magic, version, size, count, first, last, flags = \
+        HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or size != RECORD_SIZE:
+        raise ValueError('Not a tick journal')
+    if version > VERSION:
+        raise ValueError('Unsupported journal version {}'.format(version))
+    return count, first, last, flags
+
+
+class JournalFile:
+    '''Writer for one journal file.
+
+    The file is grown grow records at a time and trimmed to the committed
+    length on close().
+    '''
+
+    def __init__(self, path, grow=65536):
+        self.path = path
+        self.grow = grow
+        exists = os.path.exists(path)
+        if not exists:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if exists and os.fstat(self.file.fileno()).st_size >= HEADER_SIZE:
+            self.count, self.first_ts, self.last_ts, self.flags = \
+                read_header(self.file.read(HEADER.size))
+        else:
+            self.count, self.first_ts, self.last_ts, self.flags = 0, 0, 0, 0
+            self.file.write(HEADER.pack(MAGIC, VERSION, RECORD_SIZE,
+                                        0, 0, 0, 0))
+        self.capacity = 0
+        self.mm = None
+        self._reserve(self.count + grow)
+
+    def _reserve(self, records):
+        size = HEADER_SIZE + records * RECORD_SIZE
+        if self.mm is not None:
+            if size <= len(self.mm):
+                return
+            self.mm.close()
+        if os.fstat(self.file.fileno()).st_size < size:
+            self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        self.capacity = records
+
+    def append(self, rows):
+        '''Appends (ts, ltp, atp, open, high, low, close) tuples and commits
+        them by updating the header count.'''
+        if not rows:
+            return 0
+        count = self.count
+        if count + len(rows) > self.capacity:
+            self._reserve(count + len(rows) + self.grow)
+        mm = self.mm
+        pack = RECORD.pack_into
+        offset = HEADER_SIZE + count * RECORD_SIZE
+        last = self.last_ts
+        flags = self.flags
+        for row in rows:
+            ts = row[0]
+            if ts < last:
+                flags |= UNORDERED
+            else:
+                last = ts
+            pack(mm, offset, *row)
+            offset += RECORD_SIZE
+        if count == 0:
+            self.first_ts = rows[0][0]
+        self.count = count + len(rows)
+        self.last_ts = last
+        self.flags = flags
+        HEADER.pack_into(mm, 0, MAGIC, VERSION, RECORD_SIZE, self.count,
+                         self.first_ts, self.last_ts, self.flags)
+        return len(rows)
+
+    def sync(self):
+        'Forces committed records to disk'
+        self.mm.flush()
+
+    def close(self):
+        if self.mm is None:
+            return
+        self.mm.flush()
+        self.mm.close()
+        self.mm = None
+        self.file.truncate(HEADER_SIZE + self.count * RECORD_SIZE)
+        self.file.close()
+
+
+def read_journal(path):
+    '''Maps a journal file read-only as a structured array of its committed
+    records (fields ts ltp atp open high low close). No data is copied.'''
+    if np is None:
+        raise ImportError('read_journal requires numpy')
+    with open(path, 'rb') as f:
+        count, first, last, flags = read_header(f.read(HEADER.size))
+    if count == 0:
+        return np.zeros(0, dtype=tick_dtype)
+    return np.memmap(path, dtype=tick_dtype, mode='r', offset=HEADER_SIZE,
+                     shape=(count,))
+
+
+def journal_info(path):
+    'Header of a journal file as a dict'
+    with open(path, 'rb') as f:
+        count, first, last, flags = read_header(f.read(HEADER.size))
+    return {'count': count, 'first_ts': first, 'last_ts': last,
+            'ordered': not flags & UNORDERED}
+
+
+class TickJournal:
+    '''Tick storage backend writing one JournalFile per symbol and day.
+
+    Not thread safe, use it from one thread like StockDB.
+    '''
+
+    def __init__(self):
+        self.root = 'journal'
+        self.tables = []
+        self.files = {}
+        # symbol -> (day start ms, day end ms, JournalFile)
+        self.current = {}
+        self.skipped = 0
+        self.sync = False
+
+    def initialize(self, root='journal', sync=False):
+        '''root is the journal directory. With sync, every batch is flushed
+        to disk before write_batches returns.'''
+        self.root = root
+        self.sync = sync
+        os.makedirs(root, exist_ok=True)
+        self.tables = self.symbols()
+
+    def symbols(self):
+        'Every symbol with at least one journal file'
+        found = set()
+        for day in self.days():
+            for name in os.listdir(os.path.join(self.root, day)):
+                if name.endswith('.ticks'):
+                    found.add(name[:-len('.ticks')])
+        return sorted(found)
+
+    def days(self, symbol=None):
+        'YYYYMMDD directories, only those holding symbol if given'
+        if not os.path.isdir(self.root):
+            return []
+        days = sorted(d for d in os.listdir(self.root)
+                      if d.isdigit() and len(d) == 8)
+        if symbol is not None:
+            days = [d for d in days
+                    if os.path.exists(journal_path(self.root, symbol, d))]
+        return days
+
+    def tick_symbols(self, start=None, end=None):
+        'Symbols with a journal for a day between start and end'
+        found = set()
+        for day in self._days_between(start, end):
+            for name in os.listdir(os.path.join(self.root, day)):
+                if name.endswith('.ticks'):
+                    found.add(name[:-len('.ticks')])
+        return sorted(found)
+
+    def delete_ticks(self, symbol, start=None, end=None):
+        '''Removes the journals of symbol for days that lie entirely
+        between start and end. Returns the number of ticks removed.'''
+        start = to_epoch_ms(start)
+        end = to_epoch_ms(end)
+        removed = 0
+        for day in self._days_between(start, end):
+            path = journal_path(self.root, symbol, day)
+            if not os.path.exists(path):
+                continue
+            first, last = _day_span(
+                datetime.strptime(day, '%Y%m%d').timestamp() * 1000)
+            if (start is not None and first < start) or \
+               (end is not None and last > end):
+                continue
+            journal = self.files.pop(path, None)
+            if journal is not None:
+                journal.close()
+                self.current.pop(symbol.upper(), None)
+            removed += journal_info(path)['count']
+            os.remove(path)
+        return removed
+
+    def _days_between(self, start, end):
+        start = to_epoch_ms(start)
+        end = to_epoch_ms(end)
+        first = None if start is None else day_key(start)
+        last = None if end is None else day_key(end - 1)
+        return [d for d in self.days()
+                if (first is None or d >= first) and
+                   (last is None or d <= last)]
+
+    def table_name(self, tablename, tabletype):
+        return tablename.upper()
+
+    def create_table(self, tablename, tabletype):
+        'Files are created on the first write, only checks the type'
+        if tabletype not in (table_types.ohlc, table_types.ticks):
+            return False
+        if tablename.upper() not in self.tables:
+            self.tables.append(tablename.upper())
+        return True
+
+    def add_data(self, tablename, tabletype, data):
+        return self.write_batches({(tablename, tabletype): [data]})
+
+    def add_many(self, tablename, tabletype, data):
+        return self.write_batches({(tablename, tabletype): data})
+
+    def write_batches(self, batches):
+        '''Accepts {(tablename, tabletype): [OHLC, ...]} like StockDB.
+        Rows of other table types are counted in skipped.'''
+        for (tablename, tabletype), data in batches.items():
+            if tabletype not in (table_types.ohlc, table_types.ticks):
+                self.skipped += len(data)
+                continue
+            symbol = tablename.upper()
+            rows = []
+            journal = None
+            for d in data:
+                cur = self.current.get(symbol)
+                if cur is None or not cur[0] <= d.ts < cur[1]:
+                    if rows:
+                        journal.append(rows)
+                        rows = []
+                    cur = self._open(symbol, d.ts)
+                journal = cur[2]
+                rows.append((d.ts, d.ltp, d.atp, d.op, d.hi, d.lo, d.cl))
+            if rows:
+                journal.append(rows)
+        if self.sync:
+            for journal in self.files.values():
+                journal.sync()
+        return True
+
+    def _open(self, symbol, ts):
+        start, end = _day_span(ts)
+        path = journal_path(self.root, symbol, day_key(ts))
+        journal = self.files.get(path)
+        if journal is None:
+            journal = self.files[path] = JournalFile(path)
+        cur = self.current[symbol] = (start, end, journal)
+        return cur
+
+    def close(self):
+        for journal in self.files.values():
+            journal.close()
+        self.files = {}
+        self.current = {}
+
+    # Reading, same results as StockDB.iter_ticks/get_ticks
+
+    def iter_ticks(self, symbol, start=None, end=None, fields=tick_columns,
+                   chunk_size=None):
+        '''Yields one {field: array} dict per day file for symbol with
+        start <= ts < end. Arrays are views into the mapped file when the
+        day was written in time order.'''
+        for f in fields:
+            if f not in tick_columns:
+                raise ValueError('Unknown tick field: {}'.format(f))
+        start = to_epoch_ms(start)
+        end = to_epoch_ms(end)
+        for day in self.days(symbol):
+            path = journal_path(self.root, symbol, day)
+            info = journal_info(path)
+            if info['count'] == 0 or \
+               (end is not None and info['first_ts'] >= end and
+                info['ordered']) or \
+               (start is not None and info['last_ts'] < start):
+                continue
+            recs = read_journal(path)
+            if info['ordered']:
+                a = 0 if start is None else \
+                    int(np.searchsorted(recs['ts'], start, 'left'))
+                b = len(recs) if end is None else \
+                    int(np.searchsorted(recs['ts'], end, 'left'))
+                recs = recs[a:b]
+            else:
+                mask = np.ones(len(recs), dtype=bool)
+                if start is not None:
+                    mask &= recs['ts'] >= start
+                if end is not None:
+                    mask &= recs['ts'] < end
+                recs = recs[mask]
+            if len(recs):
+                yield {f: recs[f] for f in fields}
+
+    def get_ticks(self, symbol, start=None, end=None, fields=tick_columns):
+        'Returns {field: array} of every matching tick of symbol'
+        return join_columns(list(self.iter_ticks(symbol, start, end,
+                                                 fields)), fields)
+
+
+def journal_bench(n=1000000):
+    'Append and read throughput of a scratch journal'
+    import tempfile
+    import time
+    from ohlc import OHLC
+    rows = [OHLC(1517377333560 + i, 'BENCH', 97.85, 103.58,
+                 100.0, 111.85, 95.0, 115.75) for i in range(n)]
+    tj = TickJournal()
+    tj.initialize(os.path.join(tempfile.mkdtemp(), 'journal'))
+    t = time.perf_counter()
+    for i in range(0, n, 2000):
+        tj.add_many('BENCH', table_types.ticks, rows[i:i + 2000])
+    tj.close()
+    t = time.perf_counter() - t
+    print('journal write: {:>10.0f} ticks/s'.format(n / t))
+    if np is not None:
+        t = time.perf_counter()
+        ticks = tj.get_ticks('BENCH')
+        ticks['ltp'].sum()
+        t = time.perf_counter() - t
+        print('journal read:  {:>10.0f} ticks/s'.format(n / t))
+
+
+def test_journal():
+    'Round trip through a journal matches the same rows in StockDB'
+    import tempfile
+    from ohlc import OHLC
+    from stockdb import StockDB
+    t0 = int(datetime(2018, 2, 1, 15, 0).timestamp() * 1000)
+    # Two trading days, with one row out of order on the first
+    times = [t0 + i * 60000 for i in range(10)] + [t0 + 30000] + \
+            [t0 + 86400000 + i * 60000 for i in range(10)]
+    rows = [OHLC(ts, 'JRN', 100.0 + i, 100.0, 100.0, 150.0, 90.0, 99.0)
+            for i, ts in enumerate(times)]
+    root = os.path.join(tempfile.mkdtemp(), 'journal')
+    tj = TickJournal()
+    tj.initialize(root)
+    tj.add_many('JRN', table_types.ticks, rows[:5])
+    tj.close()
+    # Reopening appends after the committed rows
+    tj.add_many('JRN', table_types.ticks, rows[5:])
+    tj.add_data('JRN', table_types.depth, {'timestamp': t0})
+    tj.close()
+    assert tj.skipped == 1
+    assert tj.days('JRN') == [day_key(t0), day_key(t0 + 86400000)]
+    info = journal_info(journal_path(root, 'JRN', day_key(t0)))
+    assert info['count'] == 11 and not info['ordered']
+    if np is not None:
+        # Reading maps the files as numpy arrays
+        db = StockDB()
+        db.initialize(':memory:')
+        db.create_tick_tables()
+        db.write_batches({('JRN', table_types.ticks): rows})
+        for start, end in ((None, None), (t0 + 30000, t0 + 300000),
+                           (t0 + 120000, t0 + 86400000 + 120000)):
+            a = tj.get_ticks('JRN', start, end)
+            b = db.get_ticks('JRN', start, end)
+            for f in tick_columns:
+                assert sorted(a[f]) == sorted(b[f]), (start, end, f)
+        db.close()
+    assert tj.delete_ticks('JRN', t0 - 3600000 * 15, t0 + 3600000 * 9) == 11
+    assert tj.days('JRN') == [day_key(t0 + 86400000)]
+    info = journal_info(journal_path(root, 'JRN', day_key(t0 + 86400000)))
+    assert info['count'] == 10 and info['ordered']
+    print('test_journal passed')
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        journal_bench()
+    else:
+        test_journal()
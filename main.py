@@ -12,8 +12,19 @@ class login_codes:
     other = 3
 
 
+def make_center():
+    'TradeCenter for the configured runtime, thread (default) or asyncio'
+    runtime = 'thread'
+    if config is not None:
+        runtime = config.get('runtime', runtime).strip().lower()
+    if runtime == 'asyncio':
+        from async_trader import AsyncTradeCenter
+        return AsyncTradeCenter(config)
+    return TradeCenter(config)
+
+
 def offline():
-    ts = TradeCenter(config)
+    ts = make_center()
     ts.run(True)
 
 
@@ -24,7 +35,7 @@ def online():
     stocks.append(('NSE_FO', "NIFTY" + ym + str(11200) + 'CE'))
     stocks.append(('NSE_FO', "NIFTY" + ym + str(11000) + 'PE'))
 
-    ts = TradeCenter(config)
+    ts = make_center()
     ts.run()
 
 
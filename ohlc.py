@@ -1,18 +1,45 @@
+from array import array
 import csv
-from datetime import datetime, date, timezone
+from datetime import datetime, date, timedelta, timezone
+from functools import lru_cache
 import os
+from sys import intern
+import time
 
 
+@lru_cache(maxsize=4096)
+def _local_second(sec):
+    'Local time string for an epoch second, cached since ticks share seconds'
+    return datetime.fromtimestamp(sec).strftime(OHLC.fmt)
+
+
+def parse_time(text):
+    '''Epoch ms from a csv time field: epoch seconds, epoch ms or ISO
+    (2018-02-01T09:15:00, fractions and a space separator allowed).'''
+    try:
+        t = float(text)
+    except ValueError:
+        t = datetime.fromisoformat(text).timestamp()
+    if t > 100000000000:
+        return int(t)
+    return int(round(t * 1000))
+
 
 class OHLC:
+    '''One quote snapshot.
+
+    The timestamp is kept as integer epoch ms in ts; epoch (seconds) and
+    localtime are derived only when asked for.'''
+    __slots__ = ('symbol', 'ts', 'ltp', 'atp', 'op', 'hi', 'lo', 'cl')
     fmt= '%Y-%m-%d %H:%M:%S'
     def __init__(self, epoch=0 , sym='0', ltp=0.0, atp=0.0, op=0.0, hi=0.0, lo=0.0, cl=0.0):
         "epoch: any UTC based timestamp , sym:str, ltp:float, atp:float, op:float, hi:float, lo:float, cl:float"
-        self.symbol = str(sym).upper()
-        if len(str(epoch)) > 12:
-            self.epoch = epoch/1000
+        self.symbol = intern(str(sym).upper())
+        # Anything past year 5138 in seconds must already be ms
+        if epoch > 100000000000:
+            self.ts = int(epoch)
         else:
-            self.epoch = epoch
+            self.ts = int(round(epoch * 1000))
         self.ltp = ltp
         self.atp = atp
         self.op = op
@@ -32,6 +59,15 @@ class OHLC:
                        w=self.lo,
                        c=self.cl)
 
+    @property
+    def epoch(self):
+        'Timestamp in epoch seconds'
+        return self.ts / 1000
+
+    @epoch.setter
+    def epoch(self, value):
+        self.ts = int(round(value * 1000))
+
     @property
     def as_dict(self):
         return {'time':self.epoch,
@@ -47,27 +83,30 @@ class OHLC:
     def as_tuple(self):
         '''Returns a tuple in
 
-        (epoch, ltp, atp, high, low, open, close)
+        (epoch, ltp, atp, open, high, low, close)
         Omits Symbol for ease of use with db storage methods'''
         return (self.epoch, self.ltp,
                 self.atp, self.op, self.hi, self.lo, self.cl)
 
     @classmethod
     def fromquote(cls, quote):
-        return cls(int(quote['timestamp']),
-                   str(quote['symbol']).upper(),
-                   float(quote['ltp']),
-                   float(quote['atp']),
-                   float(quote['open']),
-                   float(quote['high']),
-                   float(quote['low']),
-                   float(quote['close']))
+        o = cls.__new__(cls)
+        # Interned so every tick of a symbol shares one string
+        o.symbol = intern(str(quote['symbol']).upper())
+        # Upstox quote timestamps are always epoch ms
+        o.ts = int(quote['timestamp'])
+        o.ltp = float(quote['ltp'])
+        o.atp = float(quote['atp'])
+        o.op = float(quote['open'])
+        o.hi = float(quote['high'])
+        o.lo = float(quote['low'])
+        o.cl = float(quote['close'])
+        return o
 
     @property
     def localtime(self):
         'Get epoch as local date-time in ISO'
-        ts = datetime.fromtimestamp(self.epoch).strftime(self.fmt)
-        return str(ts[:22])
+        return _local_second(self.ts // 1000)
 
     def fromISO(self, iso_time):
         '''Set epoch from time format =  %Y-%m-%dT%H:%M:%S'''
@@ -75,69 +114,232 @@ class OHLC:
         self.epoch = datetime.strptime(iso_time, fmt).timestamp()
 
 
-class OHLCLog:
-    ''' DEPRECATED in favor of python's logging.
+class TickBuffer:
+    '''Columnar (struct of arrays) tick store for one symbol.
 
-    Use TradeCenter.init_logging() instead.
-    Reads/Writes OHLC data in csv file.
-    The symbol is used as the filename'''
+    append_quote() copies the quote fields straight into array.array
+    columns without creating a per-tick object; 8 bytes per field per tick.
+    OHLC objects are only built when indexing.'''
+    __slots__ = ('symbol', 'ts', 'ltp', 'atp', 'op', 'hi', 'lo', 'cl')
 
     def __init__(self, symbol=''):
+        self.symbol = str(symbol).upper()
+        self.ts = array('q')
+        self.ltp = array('d')
+        self.atp = array('d')
+        self.op = array('d')
+        self.hi = array('d')
+        self.lo = array('d')
+        self.cl = array('d')
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __getitem__(self, i):
+        return OHLC(self.ts[i], self.symbol, self.ltp[i], self.atp[i],
+                    self.op[i], self.hi[i], self.lo[i], self.cl[i])
+
+    def append_quote(self, quote):
+        self.ts.append(int(quote['timestamp']))
+        self.ltp.append(quote['ltp'])
+        self.atp.append(quote['atp'])
+        self.op.append(quote['open'])
+        self.hi.append(quote['high'])
+        self.lo.append(quote['low'])
+        self.cl.append(quote['close'])
+
+    def append(self, data):
+        'Appends an OHLC object'
+        self.ts.append(data.ts)
+        self.ltp.append(data.ltp)
+        self.atp.append(data.atp)
+        self.op.append(data.op)
+        self.hi.append(data.hi)
+        self.lo.append(data.lo)
+        self.cl.append(data.cl)
+
+    def columns(self):
+        'Same layout as StockDB.get_ticks'
+        return {'ts': self.ts, 'ltp': self.ltp, 'atp': self.atp,
+                'open': self.op, 'high': self.hi, 'low': self.lo,
+                'close': self.cl}
+
+    def clear(self):
+        for col in (self.ts, self.ltp, self.atp, self.op,
+                    self.hi, self.lo, self.cl):
+            del col[:]
+
+
+class OHLCLog:
+    '''Reads/Writes OHLC data in csv files, one file per symbol and day.
+
+    Files stay open while logging. Rows are buffered and written once
+    max_rows are pending or the oldest pending row is max_delay seconds
+    old; call poll() periodically so a quiet symbol still gets written, and
+    close() when done. A tick of a new day rotates the symbol to a new
+    file. Not thread safe, log from one thread.'''
+
+    fields = ('time', 'symbol', 'ltp', 'atp', 'open', 'high', 'low', 'close')
+
+    def __init__(self, symbol='', max_rows=1000, max_delay=1.0,
+                 pattern='OHLC-{symbol}-{date}.csv'):
         self.tod = date.today()
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.pattern = pattern
+        # symbol -> [file, writer, day end ms, filename]
         self.csv_dict = {}
+        self.pending = {}
+        self.count = 0
+        self.first_ts = 0.0
+        self.written = 0
+        if symbol:
+            self.create_ohlc_file(symbol)
+
 
+    def file_for(self, symbol, day):
+        return self.pattern.format(symbol=symbol, date=day.strftime("%d%b%y"))
 
-    def create_ohlc_file(self, symbol=None):
+
+    def create_ohlc_file(self, symbol=None, ts=None):
+        '''Opens the file of symbol for the day of ts (epoch ms, default
+        today), writing the header if the file is new.'''
         if symbol == None:
             return
-        filename = "OHLC-{}-{}.csv".format(symbol, self.tod.strftime("%d%b%y"))
-        if os.path.exists('./'+filename) == False:
-            with open(filename, 'w') as f:
-                fields = ['time', 'symbol', 'ltp', 'atp',
-                          'open', 'high', 'low', 'close']
-                writer = csv.DictWriter(f, fieldnames=fields)
-                writer.writeheader()
-        self.csv_dict[symbol] = filename
+        if ts is None:
+            day = datetime.combine(date.today(), datetime.min.time())
+        else:
+            day = datetime.fromtimestamp(ts / 1000).replace(
+                hour=0, minute=0, second=0, microsecond=0)
+        end = int((day + timedelta(days=1)).timestamp() * 1000)
+        filename = self.file_for(symbol, day)
+        old = self.csv_dict.get(symbol)
+        if old is not None:
+            if old[3] == filename:
+                return
+            self.flush(symbol)
+            old[0].close()
+        new = not os.path.exists(filename)
+        f = open(filename, 'a', newline='', buffering=1 << 16)
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(self.fields)
+        self.csv_dict[symbol] = [f, writer, end, filename]
+        self.pending.setdefault(symbol, [])
 
 
-    def logohlc(self, ohlc_dict):
-        try:
-            with open(self.csv_dict[ohlc_dict['symbol']], 'a') as f:
-                fields = ['time', 'symbol', 'ltp', 'atp',
-                          'open', 'high', 'low', 'close']
-                writer = csv.DictWriter(f, fieldnames=fields)
-                writer.writerow(ohlc_dict)
-        except Exception as e:
-            print("Error while adding OHLC record for", ohlc_dict['symbol'])
-            print(e)
-            raise
+    def logohlc(self, data):
+        '''Queues one row from an OHLC object, or a dict with the csv
+        fields as keys.'''
+        if isinstance(data, OHLC):
+            symbol = data.symbol
+            ts = data.ts
+            row = data.as_tuple
+            row = (row[0], symbol) + row[1:]
+        else:
+            symbol = data['symbol']
+            row = tuple(data[k] for k in self.fields)
+            ts = parse_time(str(row[0]))
+        entry = self.csv_dict.get(symbol)
+        if entry is None or ts >= entry[2]:
+            self.create_ohlc_file(symbol, ts)
+        if self.count == 0:
+            self.first_ts = time.monotonic()
+        self.pending[symbol].append(row)
+        self.count += 1
+        if self.count >= self.max_rows:
+            self.flush()
+
+
+    def poll(self):
+        'Writes pending rows once the oldest has waited max_delay'
+        if self.count and time.monotonic() - self.first_ts >= self.max_delay:
+            self.flush()
+
+
+    def flush(self, symbol=None):
+        '''Writes pending rows of symbol, or of every symbol, to disk'''
+        symbols = self.pending if symbol is None else (symbol,)
+        for sym in symbols:
+            rows = self.pending.get(sym)
+            if not rows:
+                continue
+            f, writer = self.csv_dict[sym][:2]
+            try:
+                writer.writerows(rows)
+                f.flush()
+            except Exception as e:
+                print("Error while adding OHLC record for", sym)
+                print(e)
+                raise
+            self.written += len(rows)
+            self.count -= len(rows)
+            del rows[:]
+
+
+    def close(self):
+        self.flush()
+        for f, writer, end, filename in self.csv_dict.values():
+            f.close()
+        self.csv_dict = {}
+        self.pending = {}
+        self.count = 0
+
+
+    @classmethod
+    def iter_rows(cls, filename, symbol=None, stats=None):
+        '''Streams typed OHLC objects from an OHLC csv file.
+
+        time may be ISO or epoch seconds/ms and prices are floats. symbol is
+        used when the file has no symbol column. Rows that do not parse are
+        skipped and counted in stats['bad'] when stats is a dict.'''
+        bad = 0
+        with open(filename, 'r', newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                return
+            idx = {name.strip(): i for i, name in enumerate(header)}
+            try:
+                cols = [idx[name] for name in ('time', 'ltp', 'atp', 'open',
+                                               'high', 'low', 'close')]
+            except KeyError as e:
+                raise ValueError('{}: missing column {}'.format(filename, e))
+            t, l, a, op, hi, lo, cl = cols
+            s = idx.get('symbol')
+            if symbol is not None:
+                symbol = intern(symbol.upper())
+            for row in reader:
+                if not row:
+                    continue
+                try:
+                    o = OHLC.__new__(OHLC)
+                    o.ts = parse_time(row[t])
+                    o.symbol = symbol if s is None else \
+                               intern(row[s].upper())
+                    o.ltp = float(row[l])
+                    o.atp = float(row[a])
+                    o.op = float(row[op])
+                    o.hi = float(row[hi])
+                    o.lo = float(row[lo])
+                    o.cl = float(row[cl])
+                except (ValueError, IndexError):
+                    bad += 1
+                    continue
+                yield o
+        if stats is not None:
+            stats['bad'] = stats.get('bad', 0) + bad
 
 
     @classmethod
-    def readohlc(self, filename=None, numrows=0):
+    def readohlc(cls, filename=None, numrows=0):
         'Returns specified number of rows from filename.csv as a list of OHLC objects'
         data = []
         try:
-            with open(filename, 'r') as f:
-                reader = csv.DictReader(f)
-                ctr = 0
-                for row in reader:
-                    if len(row) < 1:
-                        continue
-                    if ctr >= numrows and numrows > 0:
-                        return data
-                    o = OHLC()
-                    o.fromISO(row['time'])
-                    o.symbol = row['symbol']
-                    o.ltp = row['ltp']
-                    o.atp = row['atp']
-                    o.op = row['open']
-                    o.hi = row['high']
-                    o.lp = row['low']
-                    o.cl = row['close']
-                    data.append(o)
-                    if numrows > 0:
-                        ctr += 1
+            for o in cls.iter_rows(filename):
+                if numrows > 0 and len(data) >= numrows:
+                    break
+                data.append(o)
         except FileNotFoundError as e:
             print("ERROR - {} File not found! ".format(filename))
             print("\tPlease ensure filename is correct and")
@@ -175,7 +377,128 @@ def test_ohlc():
     print("Time in epoch\n", data.epoch)
     print(datetime.fromtimestamp(data.epoch, tz=timezone.utc))
     print("__str__ \n", data)
+    test_csv_log()
+
+
+def test_csv_log():
+    'Buffered rows reach one file per symbol and day, header written once'
+    import tempfile
+    folder = tempfile.mkdtemp()
+    pattern = os.path.join(folder, 'OHLC-{symbol}-{date}.csv')
+    t0 = int(datetime(2018, 2, 1, 15, 0).timestamp() * 1000)
+    rows = [OHLC(t0 + i * 3600000, sym, 100.0 + i, 1.0, 1.0, 1.0, 1.0, 1.0)
+            for i in range(12) for sym in ('LOGA', 'LOGB')]
+    log = OHLCLog(max_rows=100, max_delay=3600.0, pattern=pattern)
+    for o in rows[:10]:
+        log.logohlc(o)
+    assert log.written == 0 and log.count == 10
+    log.poll()
+    assert log.written == 0
+    log.max_delay = 0.0
+    log.poll()
+    assert log.written == 10 and log.count == 0
+    log.close()
+    # Reopened files are appended to, past midnight a new file starts
+    log = OHLCLog(max_rows=5, pattern=pattern)
+    for o in rows[10:]:
+        log.logohlc(o)
+    log.close()
+    days = sorted(set(datetime.fromtimestamp(o.ts / 1000).strftime('%d%b%y')
+                      for o in rows))
+    assert len(days) == 2
+    for sym in ('LOGA', 'LOGB'):
+        got = []
+        for day in days:
+            filename = pattern.format(symbol=sym, date=day)
+            with open(filename) as f:
+                assert f.read().count('time') == 1
+            got.extend((o.ts, o.ltp) for o in OHLCLog.iter_rows(filename))
+        assert got == [(o.ts, o.ltp) for o in rows if o.symbol == sym]
+    print('test_csv_log passed')
+
+
+def bench_ohlc(n=200000):
+    'Memory per million ticks for per-quote objects and TickBuffer'
+    import tracemalloc
+
+    class DictOHLC:
+        # Layout of OHLC before __slots__, for comparison
+        def __init__(self, epoch, sym, ltp, atp, op, hi, lo, cl):
+            self.symbol = sym
+            self.epoch = epoch / 1000
+            self.ltp = ltp
+            self.atp = atp
+            self.op = op
+            self.hi = hi
+            self.lo = lo
+            self.cl = cl
+
+    def quotes():
+        q = {'symbol': 'NIFTY18FEB11200CE', 'timestamp': '1517377333560',
+             'ltp': 97.85, 'atp': 103.58, 'open': 100.0, 'high': 111.85,
+             'low': 95.0, 'close': 115.75}
+        for i in range(n):
+            q['timestamp'] = str(1517377333560 + i)
+            q['ltp'] = 97.85 + i % 100
+            yield q
+
+    def measure(name, build):
+        tracemalloc.start()
+        held = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('{:<22} {:>8.1f} MB per million ticks'.
+              format(name, size * 1000000 / n / 2**20))
+        del held
+
+    measure('dict OHLC objects', lambda: [
+        DictOHLC(int(q['timestamp']), q['symbol'], float(q['ltp']),
+                 float(q['atp']), float(q['open']), float(q['high']),
+                 float(q['low']), float(q['close'])) for q in quotes()])
+    measure('slotted OHLC objects',
+            lambda: [OHLC.fromquote(q) for q in quotes()])
+
+    def columnar():
+        buf = TickBuffer('NIFTY18FEB11200CE')
+        for q in quotes():
+            buf.append_quote(q)
+        return buf
+    measure('TickBuffer', columnar)
+
+
+def bench_csv_log(n=100000):
+    'Rows/s of OHLCLog against reopening the file for every row'
+    import tempfile
+    rows = [OHLC(1517456700000 + i * 200, 'BENCH', 97.85, 103.58,
+                 100.0, 111.85, 95.0, 115.75) for i in range(n)]
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        # Previous implementation: open and DictWriter per row
+        count = min(n, 20000)
+        t = time.perf_counter()
+        for o in rows[:count]:
+            with open('legacy.csv', 'a') as f:
+                writer = csv.DictWriter(f, fieldnames=OHLCLog.fields)
+                writer.writerow(o.as_dict)
+        t = time.perf_counter() - t
+        print('reopen per row: {:>10.0f} rows/s'.format(count / t))
+
+        log = OHLCLog()
+        t = time.perf_counter()
+        for o in rows:
+            log.logohlc(o)
+        log.close()
+        t = time.perf_counter() - t
+        print('OHLCLog:        {:>10.0f} rows/s'.format(n / t))
+    finally:
+        os.chdir(cwd)
 
 
 if __name__ == '__main__':
-    test_ohlc()
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench_ohlc()
+        bench_csv_log()
+    else:
+        test_ohlc()
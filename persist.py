@@ -0,0 +1,280 @@
+'''Background tick persistence for TradeCenter.
+
+The listener hands OHLC objects to a PersistWorker, which owns its own
+StockDB connection and writes them in batches, so a slow commit never
+delays quote processing.
+'''
+
+from collections import namedtuple
+import csv
+import logging
+import os
+import queue
+import threading
+import time
+from depth import DEPTH_LEVELS
+from journal import TickJournal
+from ohlc import OHLC, OHLCLog
+from stockdb import StockDB, TickWriter, table_types
+from utils import DATE, LatencyStats, print_l
+
+Pols = namedtuple('PersistPolicy', 'drop spill')
+PersistPolicy = Pols(0, 1)
+
+
+class PersistWorker(threading.Thread):
+    '''Writer thread fed through a bounded queue.
+
+    put() has the same signature as StockDB.add_data and never blocks.
+    When the queue is full the row is either dropped or, with the spill
+    policy, appended to a CSV spill file that is loaded into the DB when the
+    worker stops.
+    lag records the time from put() to the commit that stored the row.
+    A batch whose write raises is spilled like a failed batch and the
+    worker carries on.
+    '''
+
+    def __init__(self, db_file='stock_db.sqlite', max_queue=100000,
+                 policy=PersistPolicy.spill, batch_rows=2000,
+                 batch_delay=0.5, synchronous='NORMAL',
+                 depth_levels=DEPTH_LEVELS, storage='sqlite',
+                 csv_log=False):
+        threading.Thread.__init__(self, name='PersistWorker', daemon=True)
+        self.db_file = db_file
+        self.queue = queue.Queue(max_queue)
+        self.policy = policy
+        self.batch_rows = batch_rows
+        self.batch_delay = batch_delay
+        self.synchronous = synchronous
+        self.depth_levels = depth_levels
+        # 'sqlite' for StockDB, 'journal' for TickJournal with db_file as
+        # the journal directory
+        self.storage = storage
+        # Also write ohlc/ticks rows to per symbol csv logs (ohlc.OHLCLog)
+        self.csv_log = csv_log
+        self.running = False
+        self.lag = LatencyStats()
+        self.dropped = 0
+        self.spilled = 0
+        self.spill_file = 'spill{}.csv'.format(DATE)
+        self.spill = None
+        self.spill_writer = None
+        # put() spills on the caller's thread, failed batches on this one
+        self.spill_lock = threading.Lock()
+        self.failed = 0
+        # Exceptions raised while storing rows
+        self.errors = 0
+
+    def put(self, tablename, tabletype, data):
+        try:
+            self.queue.put_nowait((time.perf_counter(), tablename,
+                                   tabletype, data))
+        except queue.Full:
+            if self.policy == PersistPolicy.spill and \
+               (tabletype == table_types.ohlc or
+                tabletype == table_types.ticks):
+                self._spill(tablename, tabletype, data)
+            else:
+                self.dropped += 1
+            return False
+        return True
+
+    def _spill(self, tablename, tabletype, data):
+        # The file object buffers the writes.
+        with self.spill_lock:
+            if self.spill is None:
+                self.spill = open(self.spill_file, 'a', newline='')
+                self.spill_writer = csv.writer(self.spill)
+            self.spill_writer.writerow((tabletype, tablename) + data.as_tuple)
+            self.spilled += 1
+
+    def _spill_batches(self, batches):
+        'TickWriter on_failed: keeps rows that could not be written'
+        for (tablename, tabletype), rows in batches.items():
+            if tabletype == table_types.ohlc or \
+               tabletype == table_types.ticks:
+                for data in rows:
+                    self._spill(tablename, tabletype, data)
+            else:
+                self.failed += len(rows)
+                print_l('Lost {} rows'.format(len(rows)), logging.ERROR,
+                        table=tablename, type=tabletype)
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def start(self):
+        self.running = True
+        threading.Thread.start(self)
+
+    def stop(self, timeout=None):
+        'Stops accepting rows, flushes everything queued and joins'
+        self.running = False
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        if self.storage == 'journal':
+            db = TickJournal()
+            db.initialize(self.db_file, self.synchronous == 'FULL')
+        else:
+            db = StockDB()
+            db.initialize(self.db_file, synchronous=self.synchronous)
+            if 'depth' not in db.tables:
+                db.depth_levels = self.depth_levels
+        writer = TickWriter(db, self.batch_rows, self.batch_delay,
+                            on_failed=self._spill_batches)
+        log = None
+        if self.csv_log:
+            log = OHLCLog(max_rows=self.batch_rows,
+                          max_delay=self.batch_delay)
+        tables = set(db.tables)
+        waiting = []
+        get = self.queue.get
+        while self.running or not self.queue.empty():
+            try:
+                item = get(timeout=self.batch_delay)
+            except queue.Empty:
+                item = None
+            try:
+                flushes = writer.flushes
+                while item is not None:
+                    ts, tablename, tabletype, data = item
+                    table = db.table_name(tablename, tabletype)
+                    if table not in tables:
+                        db.create_table(tablename, tabletype)
+                        tables.add(table)
+                    # add() keeps the row even when its flush raises
+                    item = None
+                    writer.add(tablename, tabletype, data)
+                    if log is not None and (tabletype == table_types.ohlc or
+                                            tabletype == table_types.ticks):
+                        log.logohlc(data)
+                    waiting.append(ts)
+                    if writer.flushes != flushes:
+                        self._record_lag(waiting)
+                        flushes = writer.flushes
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        item = None
+                writer.poll()
+                if log is not None:
+                    log.poll()
+                if writer.flushes != flushes:
+                    self._record_lag(waiting)
+            except Exception as e:
+                self._recover(writer, waiting, e, item)
+        try:
+            writer.close()
+        except Exception as e:
+            self._recover(writer, waiting, e)
+        self._record_lag(waiting)
+        self._load_spill(db, tables, log)
+        if log is not None:
+            log.close()
+        db.close()
+
+    def _recover(self, writer, waiting, error, item=None):
+        '''Spills the rows of a batch that raised, and item if it was not
+        added yet, so one bad write does not stop the worker'''
+        self.errors += 1
+        print_l('Persist error, spilling pending rows', logging.ERROR,
+                error='{}: {}'.format(type(error).__name__, error))
+        batches = writer.discard()
+        if item is not None:
+            batches.setdefault((item[1], item[2]), []).append(item[3])
+        del waiting[:]
+        self._spill_batches(batches)
+
+    def _record_lag(self, waiting):
+        now = time.perf_counter()
+        for ts in waiting:
+            self.lag.add(now - ts)
+        del waiting[:]
+
+    def _load_spill(self, db, tables, log=None):
+        with self.spill_lock:
+            if self.spill is None:
+                return
+            self.spill.close()
+            self.spill = None
+        writer = TickWriter(db, self.batch_rows)
+        with open(self.spill_file, 'r', newline='') as f:
+            for row in csv.reader(f):
+                tabletype = int(row[0])
+                tablename = row[1]
+                table = db.table_name(tablename, tabletype)
+                if table not in tables:
+                    db.create_table(tablename, tabletype)
+                    tables.add(table)
+                vals = [float(x) for x in row[2:]]
+                o = OHLC(vals[0], tablename, *vals[1:])
+                writer.add(tablename, tabletype, o)
+                if log is not None:
+                    log.logohlc(o)
+        if writer.close():
+            os.remove(self.spill_file)
+            print_l('Loaded {} spilled rows'.format(self.spilled))
+        else:
+            print_l('Spilled rows kept in {}'.format(self.spill_file),
+                    logging.ERROR)
+
+    def stats(self):
+        return {'depth': self.depth,
+                'dropped': self.dropped,
+                'spilled': self.spilled,
+                'failed': self.failed,
+                'errors': self.errors,
+                'lag': self.lag.as_dict()}
+
+
+def test_persist():
+    'Spilled rows reach the DB when the worker stops'
+    import tempfile
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'persist.sqlite')
+    rows = [OHLC(1517377333000 + i, 'PER', 100.0 + i, 100.0, 100.0, 150.0,
+                 90.0, 99.0) for i in range(50)]
+    worker = PersistWorker(path, max_queue=10, batch_rows=8)
+    worker.spill_file = os.path.join(folder, 'spill.csv')
+    # Not started yet, so the queue fills up and the rest spills
+    for o in rows:
+        worker.put('PER', table_types.ticks, o)
+    assert worker.put('PER', table_types.depth, {'timestamp': 0}) is False
+    assert (worker.spilled, worker.dropped) == (40, 1)
+    worker.start()
+    worker.stop()
+    stats = worker.stats()
+    assert stats['depth'] == 0 and stats['lag']['count'] == 10
+    assert not os.path.exists(worker.spill_file)
+    db = StockDB()
+    db.initialize(path)
+    ticks = db.get_ticks('PER')
+    assert list(ticks['ts']) == [o.ts for o in rows]
+    assert list(ticks['ltp']) == [o.ltp for o in rows]
+    db.close()
+
+    # A batch that raises is spilled and the worker keeps storing rows
+    worker = PersistWorker(path, batch_rows=1000, batch_delay=0.05)
+    worker.spill_file = os.path.join(folder, 'spill2.csv')
+    worker.start()
+    more = [OHLC(o.ts + 100, 'PER', o.ltp, 100.0, 100.0, 150.0, 90.0, 99.0)
+            for o in rows]
+    for o in more[:25]:
+        worker.put('PER', table_types.ticks, o)
+    worker.put('PER', table_types.bars, object())
+    for o in more[25:]:
+        worker.put('PER', table_types.ticks, o)
+    worker.stop(5.0)
+    assert not worker.is_alive()
+    assert worker.errors >= 1 and worker.failed == 1
+    db.initialize(path)
+    assert len(db.get_ticks('PER')['ts']) == 100
+    db.close()
+    print('test_persist passed')
+
+
+if __name__ == '__main__':
+    test_persist()
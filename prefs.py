@@ -232,10 +232,12 @@ class Configurator(Frame):
         global sym_dict
         choice = self.symbol_combo.get()
         sym = sym_dict[choice]
-        try:
-            inst = self.ts.client.get_instrument_by_symbol(exch, choice)
-        except Exception as e:
-            print('Unable to load the instrument ' + choice)
+        inst = self.ts.instruments.get(exch, choice)
+        if inst is None:
+            try:
+                inst = self.ts.client.get_instrument_by_symbol(exch, choice)
+            except Exception as e:
+                print('Unable to load the instrument ' + choice)
 
         try:
             feed = self.ts.client.get_live_feed(inst, LiveFeedType.Full)
@@ -246,10 +248,16 @@ class Configurator(Frame):
         bp = round_off(feed['ltp'], 100)
         strike_prices = []
 
-        mult = 100
-        for x in range(-5, 5):
-            sp = int(bp + (x * mult))
-            strike_prices.append(str(sp))
+        listed = self.ts.instruments.strikes(sym, self.dates_combo.get())
+        if listed:
+            # Ten listed strikes around the money
+            nearest = sorted(listed, key=lambda p: abs(p - bp))[:10]
+            strike_prices = [str(int(p)) for p in sorted(nearest)]
+        else:
+            mult = 100
+            for x in range(-5, 5):
+                sp = int(bp + (x * mult))
+                strike_prices.append(str(sp))
 
         self.price_combo['text'] = str(bp)
         self.price_combo['values'] = strike_prices
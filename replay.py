@@ -0,0 +1,377 @@
+'''Offline stand-in for the Upstox client.
+
+ReplayClient implements the part of upstox_api.api.Upstox that TradeCenter
+uses and plays recorded quotes into the registered quote handler at 1x, Nx
+or maximum speed. Orders are filled deterministically with
+backtest.SimBroker, so the whole pipeline can be timed without a live
+websocket:
+
+    python replay.py stock_db.sqlite NIFTY18FEB11200CE --speed 0
+'''
+
+import argparse
+import heapq
+import os
+import tempfile
+import threading
+import time
+from backtest import SimBroker, SimInstrument, make_quote
+from utils import print_l
+
+
+class _Relay:
+    'Forwards SimBroker order/trade messages to the client callbacks'
+
+    def __init__(self, client, instrument):
+        self.client = client
+        self.instrument = instrument
+
+    def order_update(self, message):
+        self.client.emit_order(message)
+
+    def trade_update(self, message):
+        self.client.emit_trade(message)
+
+
+class ReplayClient:
+    '''Replays time ordered quote dicts to the quote handler.
+
+    speed is the replay rate relative to the recording: 1 is real time,
+    10 ten times faster, 0 as fast as possible. Only subscribed symbols are
+    played. With autostart=False, start_websocket() waits for play().
+
+    If settled is set to a callable, as run_replay does with
+    TradeCenter.settled, every quote and every broker fill waits until it
+    returns True before the replay moves on. Orders then fill against the
+    tick they were placed on, like Backtester.run_day, and repeated replays
+    give the same orders and trades. Set settled to None to measure raw
+    throughput instead.
+    '''
+
+    def __init__(self, quotes, speed=0, autostart=True, settle_timeout=5.0):
+        self.quotes = quotes
+        self.speed = speed
+        self.autostart = autostart
+        self.settled = None
+        self.settle_timeout = settle_timeout
+        self.settle_timeouts = 0
+        self.instruments = {}
+        self.subscribed = set()
+        self.quote_handler = None
+        self.order_handler = None
+        self.trade_handler = None
+        self.brokers = {}
+        self.orders = []
+        self.trades = []
+        self.last_quote = {}
+        self.sent = 0
+        self.started = 0.0
+        self.finished = 0.0
+        self.done = threading.Event()
+        self.go = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add_instrument(self, instrument):
+        self.instruments[instrument.symbol.upper()] = instrument
+
+    # Upstox API surface used by TradeCenter
+
+    def set_on_quote_update(self, func):
+        self.quote_handler = func
+
+    def set_on_order_update(self, func):
+        self.order_handler = func
+
+    def set_on_trade_update(self, func):
+        self.trade_handler = func
+
+    def get_master_contract(self, exchange):
+        return dict(self.instruments)
+
+    def get_instrument_by_symbol(self, exchange, symbol):
+        return self.instruments.get(symbol.upper())
+
+    def subscribe(self, instrument, feed_type=None):
+        if isinstance(instrument, (list, tuple)) and \
+           not hasattr(instrument, 'symbol'):
+            for inst in instrument:
+                self.subscribe(inst, feed_type)
+            return {'success': True}
+        self.subscribed.add(instrument.symbol.upper())
+        return {'success': True}
+
+    def unsubscribe(self, instrument, feed_type=None):
+        if isinstance(instrument, (list, tuple)) and \
+           not hasattr(instrument, 'symbol'):
+            for inst in instrument:
+                self.unsubscribe(inst, feed_type)
+            return {'success': True}
+        self.subscribed.discard(instrument.symbol.upper())
+        return {'success': True}
+
+    def get_live_feed(self, instrument, feed_type=None):
+        return self.last_quote.get(instrument.symbol.upper())
+
+    def start_websocket(self, run_in_background=False):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        if self.autostart:
+            self.go.set()
+        if not run_in_background:
+            self.thread.join()
+
+    def place_order(self, transaction_type, instrument, *args):
+        sym = instrument.symbol.upper()
+        with self.lock:
+            broker = self.brokers.get(sym)
+            if broker is None:
+                broker = SimBroker(_Relay(self, instrument))
+                self.brokers[sym] = broker
+            return broker.place_order(transaction_type, instrument, *args)
+
+    def modify_order(self, order_id, trigger_price=None, **kwargs):
+        with self.lock:
+            for broker in self.brokers.values():
+                broker.modify_order(order_id, trigger_price)
+        return {'order_id': order_id}
+
+    def get_order_history(self):
+        return list(self.orders)
+
+    def get_trade_book(self):
+        return list(self.trades)
+
+    # Replay
+
+    def emit_order(self, message):
+        message = dict(message, product='OCO', order_type='SL',
+                       exchange_time=message.get('exchange_time'))
+        self.orders.append(message)
+        if self.order_handler is not None:
+            self.order_handler(message)
+
+    def emit_trade(self, message):
+        self.trades.append(message)
+        if self.trade_handler is not None:
+            self.trade_handler(message)
+
+    def play(self):
+        self.go.set()
+
+    def wait_settled(self):
+        settled = self.settled
+        if settled is None:
+            return
+        deadline = time.perf_counter() + self.settle_timeout
+        while not settled():
+            if time.perf_counter() > deadline:
+                self.settle_timeouts += 1
+                print_l('Replay gave up waiting for the listener',
+                        sent=self.sent)
+                return
+            time.sleep(0)
+
+    def run(self):
+        self.go.wait()
+        self.started = time.perf_counter()
+        first_ts = None
+        i = 0
+        for quote in self.quotes:
+            sym = quote['symbol'].upper()
+            if sym not in self.subscribed:
+                continue
+            ts = int(quote['timestamp'])
+            if self.speed:
+                if first_ts is None:
+                    first_ts = ts
+                due = self.started + (ts - first_ts) / 1000.0 / self.speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self.last_quote[sym] = quote
+            self.quote_handler(quote)
+            self.sent += 1
+            self.wait_settled()
+            broker = self.brokers.get(sym)
+            if broker is not None:
+                with self.lock:
+                    broker.on_tick(i, ts, quote['ltp'])
+                # Fills go through the order/trade handlers
+                self.wait_settled()
+            i += 1
+        self.finished = time.perf_counter()
+        self.done.set()
+
+
+def quotes_from_db(db, symbols, start=None, end=None, exchange='NSE_FO'):
+    '''Merges the ticks of symbols from a StockDB into one time ordered
+    stream of quote dicts. Returns (instruments, quote iterator).'''
+    instruments = [SimInstrument(exchange, i, sym.upper(), 75)
+                   for i, sym in enumerate(symbols)]
+
+    def stream(inst):
+        for cols in db.iter_ticks(inst.symbol, start, end):
+            for i in range(len(cols['ts'])):
+                yield (cols['ts'][i], inst.token,
+                       make_quote(inst, cols['ts'][i], cols['ltp'][i],
+                                  cols['atp'][i], cols['open'][i],
+                                  cols['high'][i], cols['low'][i],
+                                  cols['close'][i]))
+    merged = heapq.merge(*[stream(inst) for inst in instruments])
+    return instruments, (q for ts, token, q in merged)
+
+
+def run_replay(tc, client, timeout=None, lockstep=True):
+    '''Drives a TradeCenter from a ReplayClient and reports throughput.
+
+    With lockstep, each tick is fully processed, orders included, before
+    the next one is played, which makes the replay deterministic.
+    Instruments must already be added to the client. Returns a stats dict.
+    '''
+    tc.client = client
+    client.settled = tc.settled if lockstep else None
+    tc.check_session = False
+    tc.register_handlers()
+    tc.register_stocks(list(client.instruments))
+    client.autostart = False
+    tc.start_listener()
+    tc.ready.wait(timeout)
+    client.play()
+    client.done.wait(timeout)
+    while tc.listening and tc.dispatch.depth() > 0:
+        time.sleep(0.01)
+    drained = time.perf_counter()
+    tc.close_ops()
+    elapsed = max(drained - client.started, 1e-9)
+    stats = tc.dispatch_stats()
+    stats['ticks'] = client.sent
+    stats['elapsed'] = elapsed
+    stats['ticks_per_sec'] = client.sent / elapsed
+    stats['orders'] = len(client.orders)
+    stats['trades'] = len(client.trades)
+    stats['settle_timeouts'] = client.settle_timeouts
+    return stats
+
+
+def main():
+    from stockdb import StockDB
+    from trader import TradeCenter
+    parser = argparse.ArgumentParser(description='Replay stored ticks '
+                                     'through TradeCenter')
+    parser.add_argument('db', help='StockDB file with a ticks table')
+    parser.add_argument('symbols', nargs='+')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='1 = real time, 0 = max speed')
+    parser.add_argument('--trade', action='store_true',
+                        help='send orders to the simulated broker')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='use the asyncio runtime')
+    parser.add_argument('--free-run', action='store_true',
+                        help='do not wait for each tick to be processed; '
+                        'faster, but fills are not deterministic')
+    args = parser.parse_args()
+
+    db = StockDB()
+    db.initialize(args.db)
+    instruments, quotes = quotes_from_db(db, args.symbols)
+    # Materialized so the db connection stays on this thread
+    client = ReplayClient(list(quotes), args.speed)
+    db.close()
+    for inst in instruments:
+        client.add_instrument(inst)
+
+    out = tempfile.mkdtemp()
+    if args.asyncio:
+        from async_trader import AsyncTradeCenter as TradeCenter
+    tc = TradeCenter({'db_file': os.path.join(out, 'replay.sqlite'),
+                      'db_schema': 'ticks'})
+    tc.trading = args.trade
+    stats = run_replay(tc, client, lockstep=not args.free_run)
+    print_l('Replayed {ticks} ticks in {elapsed:.2f}s '
+            '({ticks_per_sec:.0f} ticks/s)'.format(**stats))
+    print_l('Dispatch latency: {}'.format(stats['latency']))
+    print_l('Storage lag: {}'.format(stats['persist']['lag']))
+
+
+def test_replay():
+    'Merged quote order, lockstep settling and fills on the placed tick'
+    import queue
+    from ohlc import OHLC
+    from stockdb import StockDB, table_types
+    t0 = 1517456760000
+    db = StockDB()
+    db.initialize(':memory:')
+    db.create_tick_tables()
+    for sym, times in (('RPA', (0, 2000, 4000, 5000)),
+                       ('RPB', (1000, 2000, 3000))):
+        db.write_batches({(sym, table_types.ticks):
+                          [OHLC(t0 + dt, sym, 100.0 + dt / 1000.0)
+                           for dt in times]})
+    instruments, quotes = quotes_from_db(db, ['RPA', 'RPB'])
+    quotes = list(quotes)
+    db.close()
+    assert [(q['symbol'], int(q['timestamp']) - t0) for q in quotes] == \
+        [('RPA', 0), ('RPB', 1000), ('RPA', 2000), ('RPB', 2000),
+         ('RPB', 3000), ('RPA', 4000), ('RPA', 5000)]
+
+    # A listener thread handles each quote after the client returns, the
+    # client waits for it before playing the next one
+    client = ReplayClient(quotes + [dict(quotes[0], symbol='OTHER')])
+    for inst in instruments:
+        client.add_instrument(inst)
+        client.subscribe(inst)
+    inbox = queue.Queue()
+    seen = []
+    overlaps = []
+
+    def on_quote(quote):
+        if inbox.unfinished_tasks:
+            overlaps.append(quote)
+        inbox.put(quote)
+
+    def listener():
+        while True:
+            quote = inbox.get()
+            if quote is None:
+                break
+            time.sleep(0.002)
+            seen.append(quote)
+            if quote['symbol'] == 'RPB' and len(seen) == 2:
+                # Fills against this very tick, as in a backtest
+                client.place_order('B', instruments[1], 75, 'L', 'OCO',
+                                   quote['ltp'], quote['ltp'], 0, 'DAY',
+                                   1.5, 1.5)
+            inbox.task_done()
+
+    thread = threading.Thread(target=listener)
+    thread.start()
+    client.set_on_quote_update(on_quote)
+    client.settled = lambda: inbox.unfinished_tasks == 0
+    client.start_websocket()
+    inbox.put(None)
+    thread.join()
+    assert seen == quotes and not overlaps and client.sent == len(quotes)
+    assert client.settle_timeouts == 0
+    fills = [(m['transaction_type'], m['price']) for m in client.trades]
+    # Bought at 101, the stoploss at 99.5 is never hit, the target at
+    # 102.5 is reached by the 103 tick
+    assert fills == [('B', 101.0), ('S', 103.0)]
+
+    # Without a listener every tick gives up after settle_timeout
+    client = ReplayClient(quotes[:2], settle_timeout=0.01)
+    for inst in instruments:
+        client.subscribe(inst)
+    client.set_on_quote_update(lambda quote: None)
+    client.settled = lambda: False
+    client.start_websocket()
+    assert client.settle_timeouts == 2
+    print('test_replay passed')
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        main()
+    else:
+        test_replay()
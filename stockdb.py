@@ -1,11 +1,22 @@
+from array import array
 from bunch import Bunch
 import csv
 from datetime import timedelta, datetime
+from depth import DEPTH_LEVELS, depth_fields, depth_row, imbalance_sql
 from ohlc import OHLC, OHLCLog
+import logging
 import pickle
 import sqlite3
 from sqlite3 import OperationalError
 import time
+from utils import print_l
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NAN = float('nan')
 
 ohlc_table_fields = ({'name':'ts', 'type':'DATETIME'},
                      {'name':'ltp', 'type':'REAL'},
@@ -15,7 +26,100 @@ ohlc_table_fields = ({'name':'ts', 'type':'DATETIME'},
                      {'name':'low', 'type':'REAL'},
                      {'name':'close', 'type':'REAL'})
 
-table_types = Bunch(ohlc=0, open_orders=1)
+# Normalized schema: one ticks table for every symbol, ts in epoch ms
+ticks_table_fields = ({'name':'symbol_id', 'type':'INTEGER NOT NULL'},
+                      {'name':'ts', 'type':'INTEGER NOT NULL'},
+                      {'name':'ltp', 'type':'REAL'},
+                      {'name':'atp', 'type':'REAL'},
+                      {'name':'open', 'type':'REAL'},
+                      {'name':'high', 'type':'REAL'},
+                      {'name':'low', 'type':'REAL'},
+                      {'name':'close', 'type':'REAL'})
+
+# Time bars from bars.BarBuilder, ts is the bar start in epoch ms
+bars_table_fields = ({'name':'symbol_id', 'type':'INTEGER NOT NULL'},
+                     {'name':'res', 'type':'INTEGER NOT NULL'},
+                     {'name':'ts', 'type':'INTEGER NOT NULL'},
+                     {'name':'open', 'type':'REAL'},
+                     {'name':'high', 'type':'REAL'},
+                     {'name':'low', 'type':'REAL'},
+                     {'name':'close', 'type':'REAL'},
+                     {'name':'volume', 'type':'REAL'})
+
+table_types = Bunch(ohlc=0, open_orders=1, ticks=2, bars=3, depth=4)
+
+# Columns returned by StockDB.get_ticks
+tick_columns = ('ts', 'ltp', 'atp', 'open', 'high', 'low', 'close')
+
+# Tables that belong to the normalized schema, never per-symbol tables
+schema_tables = ('symbols', 'ticks', 'bars', 'depth')
+
+
+def ohlc_row(data):
+    'Row tuple for the ohlc table from an OHLC object'
+    return (data.localtime, data.ltp, data.atp,
+            data.op, data.hi, data.lo, data.cl)
+
+
+def to_epoch_ms(t):
+    '''Converts a datetime, epoch seconds or epoch ms to epoch ms.
+
+    None is passed through for open ended ranges.'''
+    if t is None:
+        return None
+    if isinstance(t, datetime):
+        return int(t.timestamp() * 1000)
+    if t > 100000000000:
+        return int(t)
+    return int(t * 1000)
+
+
+def make_columns(fields, rows):
+    '''Transposes row tuples into one array per field.
+
+    ts is int64 and prices float64; numpy arrays when numpy is installed,
+    array.array otherwise. NULL prices become NaN.'''
+    cols = list(zip(*rows)) if rows else [()] * len(fields)
+    data = {}
+    for name, col in zip(fields, cols):
+        if name != 'ts' and None in col:
+            col = [NAN if v is None else v for v in col]
+        if np is not None:
+            data[name] = np.array(col, dtype=np.int64 if name == 'ts'
+                                  else np.float64)
+        else:
+            data[name] = array('q' if name == 'ts' else 'd', col)
+    return data
+
+
+def join_columns(chunks, fields):
+    'Concatenates column dicts from iter_ticks into one'
+    if not chunks:
+        return make_columns(fields, [])
+    if len(chunks) == 1:
+        return chunks[0]
+    data = {}
+    for name in fields:
+        if np is not None:
+            data[name] = np.concatenate([c[name] for c in chunks])
+        else:
+            col = chunks[0][name]
+            for c in chunks[1:]:
+                col.extend(c[name])
+            data[name] = col
+    return data
+
+
+def tick_row(data, symbol_id):
+    'Row tuple for the ticks table from an OHLC object'
+    return (symbol_id, data.ts, data.ltp, data.atp,
+            data.op, data.hi, data.lo, data.cl)
+
+
+def bar_row(bar, symbol_id):
+    'Row tuple for the bars table from a bars.Bar'
+    return (symbol_id, bar.res, bar.ts, bar.open,
+            bar.high, bar.low, bar.close, bar.volume)
 
 class StockDB:
     sqlite_file = "trade_db.sqlite"
@@ -25,12 +129,22 @@ class StockDB:
     initialized = False
 
 
-    def initialize(self, db_name=None):
-        "Connects to or creates the sqlite DB"
+    def initialize(self, db_name=None, journal_mode='WAL',
+                   synchronous='NORMAL'):
+        """Connects to or creates the sqlite DB
+
+        WAL with synchronous=NORMAL only syncs at checkpoints instead of on
+        every commit. Pass synchronous='FULL' for strict durability."""
         if db_name is not None:
             self.sqlite_file = db_name
         self.conn = sqlite3.connect(self.sqlite_file)
         self.cursor = self.conn.cursor()
+        self.tables = []
+        self.symbol_ids = {}
+        self.depth_levels = DEPTH_LEVELS
+        self.archive = None
+        self.cursor.execute('PRAGMA journal_mode={}'.format(journal_mode))
+        self.cursor.execute('PRAGMA synchronous={}'.format(synchronous))
         try:
             with self.conn:
                 self.cursor.execute(
@@ -42,6 +156,11 @@ class StockDB:
         result = self.cursor.fetchall()
         for r in result:
             self.tables.append(r[0])
+        if 'depth' in self.tables:
+            # Reuse the level count the depth table was created with
+            self.cursor.execute('PRAGMA table_info(depth)')
+            cols = [c[1] for c in self.cursor.fetchall()]
+            self.depth_levels = len([c for c in cols if c.startswith('bp')])
 
         self.initialized = True
 
@@ -49,6 +168,12 @@ class StockDB:
     def create_table(self, tablename, tabletype):
         global ohlc_table_fields
 
+        if tabletype == table_types.ticks:
+            return self.create_tick_tables()
+        if tabletype == table_types.bars:
+            return self.create_bar_tables()
+        if tabletype == table_types.depth:
+            return self.create_depth_table()
         if tabletype == table_types['ohlc']:
             fields = ohlc_table_fields
         else:
@@ -79,31 +204,116 @@ class StockDB:
         return False
 
 
+    def create_tick_tables(self):
+        '''Creates the symbol dictionary and the normalized ticks table.
+
+        The (symbol_id, ts) index turns per-symbol time ranges into index
+        range scans.'''
+        if 'ticks' in self.tables:
+            return True
+        cols = ', '.join('{} {}'.format(f['name'], f['type'])
+                         for f in ticks_table_fields)
+        with self.conn:
+            self.create_symbols_table()
+            self.cursor.execute(
+                'CREATE TABLE IF NOT EXISTS ticks ({})'.format(cols))
+            self.cursor.execute('''CREATE INDEX IF NOT EXISTS ticks_symbol_ts
+                                ON ticks (symbol_id, ts)''')
+        self.tables.append('ticks')
+        return True
+
+
+    def create_bar_tables(self):
+        'Creates the bars table, one row per (symbol, resolution, start)'
+        if 'bars' in self.tables:
+            return True
+        cols = ', '.join('{} {}'.format(f['name'], f['type'])
+                         for f in bars_table_fields)
+        with self.conn:
+            self.create_symbols_table()
+            self.cursor.execute(
+                'CREATE TABLE IF NOT EXISTS bars ({})'.format(cols))
+            self.cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS
+                                bars_symbol_res_ts
+                                ON bars (symbol_id, res, ts)''')
+        self.tables.append('bars')
+        return True
+
+
+    def create_depth_table(self, levels=None):
+        '''Creates the order book table with levels price/qty/orders
+        columns per side (see depth.depth_fields).'''
+        if 'depth' in self.tables:
+            return True
+        if levels is not None:
+            self.depth_levels = levels
+        cols = ['symbol_id INTEGER NOT NULL', 'ts INTEGER NOT NULL']
+        for name in depth_fields(self.depth_levels):
+            ctype = 'INTEGER' if name[1] in 'qo' or name in ('tbq', 'tsq') \
+                    else 'REAL'
+            cols.append('{} {}'.format(name, ctype))
+        with self.conn:
+            self.create_symbols_table()
+            self.cursor.execute('CREATE TABLE IF NOT EXISTS depth ({})'.
+                                format(', '.join(cols)))
+            self.cursor.execute('''CREATE INDEX IF NOT EXISTS depth_symbol_ts
+                                ON depth (symbol_id, ts)''')
+        self.tables.append('depth')
+        return True
+
+
+    def create_symbols_table(self):
+        self.cursor.execute('''CREATE TABLE IF NOT EXISTS symbols
+                            (id INTEGER PRIMARY KEY,
+                            symbol TEXT UNIQUE NOT NULL)''')
+        if 'symbols' not in self.tables:
+            self.tables.append('symbols')
+
+
+    def symbol_id(self, symbol, create=True):
+        'Returns the id of symbol in the symbols table, adding it if needed'
+        symbol = symbol.upper()
+        sid = self.symbol_ids.get(symbol)
+        if sid is not None:
+            return sid
+        if create:
+            self.cursor.execute(
+                'INSERT OR IGNORE INTO symbols (symbol) VALUES (?)', (symbol,))
+        self.cursor.execute('SELECT id FROM symbols WHERE symbol = ?',
+                            (symbol,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        self.symbol_ids[symbol] = row[0]
+        return row[0]
+
+
+    def table_name(self, tablename, tabletype):
+        'Name of the table that add_data(tablename, tabletype) writes to'
+        if tabletype == table_types.ticks:
+            return 'ticks'
+        if tabletype == table_types.bars:
+            return 'bars'
+        if tabletype == table_types.depth:
+            return 'depth'
+        return tablename
+
+
     def add_data(self, tablename, tabletype, data):
         '''Accepts an OHLC class object and inserts it to the database.
         
         Fails if table does not exist
         Returns True on success, False on fail
+        For table_types.ticks, bars and depth, tablename is the symbol.
+        Depth data is the raw full quote dict.
         '''
-        if tabletype == table_types.ohlc:
+        if tabletype in (table_types.ohlc, table_types.ticks,
+                         table_types.bars, table_types.depth):
             try:
                 with self.conn:
-                    self.cursor.execute(
-                        '''INSERT INTO {tn} VALUES
-                        (:t,
-                        :l,
-                        :a,
-                        :op,
-                        :hi,
-                        :lo,
-                        :cl)'''.format(tn=tablename), \
-                        {'t':data.localtime,
-                         'l':data.ltp,
-                         'a':data.atp,
-                         'op':data.op,
-                         'hi':data.hi,
-                         'lo':data.lo,
-                         'cl':data.cl})
+                    self.cursor.execute(self.insert_sql(tablename, tabletype),
+                                        self.make_row(tablename, tabletype,
+                                                      data))
             except sqlite3.OperationalError as e:
                 print(e)
                 return False
@@ -111,6 +321,151 @@ class StockDB:
         return False
 
 
+    def add_many(self, tablename, tabletype, data):
+        '''Inserts a list of OHLC objects in a single transaction.
+
+        Returns True on success, False on fail
+        '''
+        return self.write_batches({(tablename, tabletype): data})
+
+
+    def write_batches(self, batches):
+        '''Accepts {(tablename, tabletype): [OHLC, ...]} and inserts every
+        row with executemany inside one transaction.'''
+        try:
+            with self.conn:
+                for (tablename, tabletype), data in batches.items():
+                    sql = self.insert_sql(tablename, tabletype)
+                    if sql is None:
+                        continue
+                    rows = [self.make_row(tablename, tabletype, d)
+                            for d in data]
+                    self.cursor.executemany(sql, rows)
+        except sqlite3.Error as e:
+            print_l('Batch write failed, rolled back', logging.WARNING,
+                    error='{}: {}'.format(type(e).__name__, e),
+                    rows=sum(len(d) for d in batches.values()))
+            return False
+        return True
+
+
+    def merge_bars(self, symbol, bars):
+        '''Stores bars.Bar rows of symbol rebuilt from ticks. Stored bars
+        get the new prices but keep their volume, which ticks do not have.
+        Returns True on success, False on fail.'''
+        try:
+            with self.conn:
+                sid = self.symbol_id(symbol)
+                self.cursor.executemany(
+                    '''INSERT INTO bars VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT (symbol_id, res, ts) DO UPDATE SET
+                       open = excluded.open, high = excluded.high,
+                       low = excluded.low, close = excluded.close''',
+                    [bar_row(bar, sid) for bar in bars])
+        except sqlite3.Error as e:
+            print_l('Bar merge failed, rolled back', logging.WARNING,
+                    error='{}: {}'.format(type(e).__name__, e),
+                    symbol=symbol)
+            return False
+        return True
+
+
+    def insert_sql(self, tablename, tabletype):
+        if tabletype == table_types.ohlc:
+            return 'INSERT INTO {tn} VALUES (?, ?, ?, ?, ?, ?, ?)'.\
+                   format(tn=tablename)
+        if tabletype == table_types.ticks:
+            return 'INSERT INTO ticks VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+        if tabletype == table_types.bars:
+            return 'INSERT OR REPLACE INTO bars VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+        if tabletype == table_types.depth:
+            return 'INSERT INTO depth VALUES ({})'.format(
+                ', '.join(['?'] * (len(depth_fields(self.depth_levels)) + 2)))
+        return None
+
+
+    def make_row(self, tablename, tabletype, data):
+        if tabletype == table_types.ticks:
+            return tick_row(data, self.symbol_id(tablename))
+        if tabletype == table_types.bars:
+            return bar_row(data, self.symbol_id(tablename))
+        if tabletype == table_types.depth:
+            return (self.symbol_id(tablename),) + \
+                   depth_row(data, self.depth_levels)
+        return ohlc_row(data)
+
+
+    def migrate_to_ticks(self, drop=False):
+        '''Folds every per-symbol ohlc table into the ticks table.
+
+        Local time strings are converted to epoch ms. They only have whole
+        seconds while live ticks have ms, so a row is not copied again when
+        ticks already holds a tick of that symbol in the same second with
+        the same ltp. An interrupted run, or one after live capture wrote
+        to ticks, can be repeated. With drop=True a per-symbol table is
+        removed once every one of its rows is found in ticks.
+        Returns the number of rows migrated.
+        '''
+        self.create_tick_tables()
+        names = [f['name'] for f in ohlc_table_fields]
+        total = 0
+        for table in list(self.tables):
+            if table in schema_tables or table.startswith('sqlite_'):
+                continue
+            self.cursor.execute('PRAGMA table_info({})'.format(table))
+            if [c[1] for c in self.cursor.fetchall()] != names:
+                continue
+            with self.conn:
+                sid = self.symbol_id(table)
+            with self.conn:
+                before = self.tick_count(sid)
+                existing = self.tick_keys(sid)
+                read = self.conn.cursor()
+                read.execute('SELECT * FROM {}'.format(table))
+                rows = []
+                keys = set()
+                for r in read:
+                    ts = int(datetime.strptime(r[0], OHLC.fmt).timestamp()
+                             * 1000)
+                    key = (ts // 1000, r[1])
+                    keys.add(key)
+                    if key not in existing:
+                        rows.append((sid, ts) + tuple(r[1:]))
+                self.cursor.executemany(
+                    self.insert_sql(table, table_types.ticks), rows)
+                if self.tick_count(sid) != before + len(rows) or \
+                   not keys <= self.tick_keys(sid):
+                    # Rolls back this table's transaction
+                    raise sqlite3.IntegrityError(
+                        'Row count check failed migrating {}'.format(table))
+                total += len(rows)
+                print('Migrated {} rows from {}'.format(len(rows), table))
+                if drop:
+                    self.cursor.execute('DROP TABLE {}'.format(table))
+                    self.tables.remove(table)
+        return total
+
+
+    def tick_count(self, symbol_id):
+        self.cursor.execute('SELECT COUNT(*) FROM ticks WHERE symbol_id = ?',
+                            (symbol_id,))
+        return self.cursor.fetchone()[0]
+
+
+    def tick_times(self, symbol_id):
+        'Set of tick timestamps stored for symbol_id'
+        self.cursor.execute('SELECT ts FROM ticks WHERE symbol_id = ?',
+                            (symbol_id,))
+        return {r[0] for r in self.cursor.fetchall()}
+
+
+    def tick_keys(self, symbol_id):
+        '(epoch second, ltp) of every tick stored for symbol_id'
+        self.cursor.execute('SELECT ts / 1000, ltp FROM ticks '
+                            'WHERE symbol_id = ?', (symbol_id,))
+        return set(self.cursor.fetchall())
+
+
     def table_exists(self, table_name):
         '''Returns True if table_name exists in DB. will not check fields'''
         try:
@@ -134,6 +489,181 @@ class StockDB:
                  print("Table does not exist")
         return None
 
+    def iter_ticks(self, symbol, start=None, end=None, fields=tick_columns,
+                   chunk_size=100000):
+        '''Yields {field: array} chunks of at most chunk_size ticks for
+        symbol with start <= ts < end, in time order.
+
+        start/end can be datetimes, epoch seconds or epoch ms. Rows are
+        streamed from an index range scan, so memory only depends on
+        chunk_size. Needs the ticks schema (see migrate_to_ticks). With an
+        archive attached (attach_archive) its days are merged in.
+        '''
+        for f in fields:
+            if f not in tick_columns:
+                raise ValueError('Unknown tick field: {}'.format(f))
+        has_ticks = 'ticks' in self.tables
+        if not has_ticks and self.archive is None:
+            print('No ticks table, run migrate_to_ticks() first')
+            return
+        start = to_epoch_ms(start)
+        end = to_epoch_ms(end)
+        spans = []
+        if self.archive is not None:
+            spans = self.archive.spans(symbol, start, end)
+        # Days not archived come from the db alone, archived days from the
+        # archive merged with db rows it does not hold (late ticks, or a day
+        # compacted without delete)
+        for lo, hi in spans:
+            if has_ticks and (start is None or start < lo):
+                for cols in self.iter_range('ticks', symbol, start, lo,
+                                            fields, fields, chunk_size):
+                    yield cols
+            cols = self._archived_day(symbol, lo, hi, fields, has_ticks)
+            if len(cols['ts']):
+                yield {f: cols[f] for f in fields}
+            start = hi
+        if has_ticks:
+            for cols in self.iter_range('ticks', symbol, start, end,
+                                        fields, fields, chunk_size):
+                yield cols
+
+
+    def _archived_day(self, symbol, lo, hi, fields, has_ticks):
+        'Archived ticks of one day span plus the db rows missing from it'
+        names = ('ts',) + tuple(f for f in fields if f != 'ts')
+        cols = self.archive.get_ticks(symbol, lo, hi, names)
+        if not has_ticks:
+            return cols
+        new = join_columns(list(self.iter_range('ticks', symbol, lo, hi,
+                                                names, names)), names)
+        keep = ~np.isin(new['ts'], cols['ts'])
+        if not keep.any():
+            return cols
+        ts = np.concatenate((cols['ts'], new['ts'][keep]))
+        order = np.argsort(ts, kind='stable')
+        return {f: np.concatenate((cols[f], new[f][keep]))[order]
+                for f in names}
+
+
+    def attach_archive(self, root='archive'):
+        '''Makes iter_ticks/get_ticks also return ticks compacted into the
+        columnar archive at root (see archive.compact_day).'''
+        from archive import ColumnStore
+        self.archive = ColumnStore(root)
+
+
+    def tick_symbols(self, start=None, end=None):
+        'Symbols with rows in the ticks table between start and end'
+        if 'ticks' not in self.tables:
+            return []
+        query = '''SELECT symbol FROM symbols s WHERE EXISTS
+                   (SELECT 1 FROM ticks WHERE symbol_id = s.id'''
+        params = []
+        start = to_epoch_ms(start)
+        end = to_epoch_ms(end)
+        if start is not None:
+            query += ' AND ts >= ?'
+            params.append(start)
+        if end is not None:
+            query += ' AND ts < ?'
+            params.append(end)
+        self.cursor.execute(query + ') ORDER BY symbol', params)
+        return [r[0] for r in self.cursor.fetchall()]
+
+
+    def delete_ticks(self, symbol, start=None, end=None):
+        'Deletes ticks of symbol with start <= ts < end, returns the count'
+        sid = self.symbol_id(symbol, create=False)
+        if sid is None or 'ticks' not in self.tables:
+            return 0
+        query = 'DELETE FROM ticks WHERE symbol_id = ?'
+        params = [sid]
+        start = to_epoch_ms(start)
+        end = to_epoch_ms(end)
+        if start is not None:
+            query += ' AND ts >= ?'
+            params.append(start)
+        if end is not None:
+            query += ' AND ts < ?'
+            params.append(end)
+        with self.conn:
+            self.cursor.execute(query, params)
+        return self.cursor.rowcount
+
+
+    def iter_range(self, table, symbol, start, end, exprs, names,
+                   chunk_size=100000):
+        '''Streams SELECT exprs for one symbol and ts range of a
+        (symbol_id, ts) indexed table as {name: array} chunks.'''
+        sid = self.symbol_id(symbol, create=False)
+        if sid is None:
+            return
+        query = 'SELECT {} FROM {} WHERE symbol_id = ?'.\
+                format(', '.join(exprs), table)
+        params = [sid]
+        start = to_epoch_ms(start)
+        end = to_epoch_ms(end)
+        if start is not None:
+            query += ' AND ts >= ?'
+            params.append(start)
+        if end is not None:
+            query += ' AND ts < ?'
+            params.append(end)
+        query += ' ORDER BY ts'
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield make_columns(names, rows)
+        cursor.close()
+
+
+    def get_ticks(self, symbol, start=None, end=None, fields=tick_columns):
+        '''Returns {field: array} for symbol with start <= ts < end.
+
+        ts is epoch ms. See iter_ticks for the argument formats.'''
+        fields = tuple(fields)
+        return join_columns(list(self.iter_ticks(symbol, start, end, fields)),
+                            fields)
+
+
+    def get_depth(self, symbol, start=None, end=None, fields=None):
+        '''Returns {field: array} order book columns for symbol, ts first.
+
+        fields defaults to every depth column (see depth.depth_fields).'''
+        names = depth_fields(self.depth_levels)
+        if fields is None:
+            fields = names
+        for f in fields:
+            if f not in names:
+                raise ValueError('Unknown depth field: {}'.format(f))
+        if 'depth' not in self.tables:
+            return make_columns(['ts'] + list(fields), [])
+        names = ['ts'] + list(fields)
+        return join_columns(list(self.iter_range('depth', symbol, start, end,
+                                                 names, names)), names)
+
+
+    def get_imbalance(self, symbol, start=None, end=None, levels=None):
+        '''Order book imbalance over time for symbol.
+
+        Returns {'ts', 'imbalance'} where imbalance is
+        (bid qty - ask qty) / (bid qty + ask qty) over the top levels,
+        computed inside SQLite. NaN when both sides are empty.'''
+        if levels is None or levels > self.depth_levels:
+            levels = self.depth_levels
+        names = ['ts', 'imbalance']
+        if 'depth' not in self.tables:
+            return make_columns(names, [])
+        # NULL for an empty book, make_columns turns it into NaN
+        exprs = ['ts', imbalance_sql(levels)]
+        return join_columns(list(self.iter_range('depth', symbol, start, end,
+                                                 exprs, names)), names)
+
+
     def summary(self):
         'Prints all tables with first 5 entries'
         for t in self.tables:
@@ -152,12 +682,99 @@ class StockDB:
     def close(self):
         self.conn.close()
 
-    def load_ohlc_from_csv(self, ohlc_csv_file):
-        data = OHLCLog.readohlc(ohlc_csv_file)
-        sym = data[0].symbol
-        self.create_table(sym, table_types.ohlc)
-        for item in data:
-            self.add_data(sym, table_types.ohlc, item)
+    def load_ohlc_from_csv(self, ohlc_csv_file, tabletype=table_types.ohlc):
+        '''Streams an OHLC csv log into the db in chunked transactions.
+        Returns (rows written, rows skipped).'''
+        from importer import import_file
+        return import_file(self, ohlc_csv_file, tabletype)
+
+
+class TickWriter:
+    '''Buffers rows for a StockDB and writes them in one transaction.
+
+    add() has the same signature as StockDB.add_data. Rows are flushed once
+    max_rows are pending or the oldest pending row is max_delay seconds old.
+    Call poll() periodically so a quiet stream still gets flushed, and
+    close() on shutdown. Must be used on the thread that owns the StockDB.
+
+    A batch that fails to write is kept and retried on the next flush.
+    After retries failed attempts it is passed to on_failed(batches) if
+    given, and discarded otherwise.
+    '''
+
+    def __init__(self, db, max_rows=2000, max_delay=0.5, retries=3,
+                 on_failed=None):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.retries = retries
+        self.on_failed = on_failed
+        self.batches = {}
+        self.pending = 0
+        self.first_ts = 0.0
+        self.written = 0
+        self.flushes = 0
+        self.attempts = 0
+        self.failed = 0
+
+    def add(self, tablename, tabletype, data):
+        key = (tablename, tabletype)
+        rows = self.batches.get(key)
+        if rows is None:
+            rows = self.batches[key] = []
+        rows.append(data)
+        if self.pending == 0:
+            self.first_ts = time.monotonic()
+        self.pending += 1
+        if self.pending >= self.max_rows:
+            return self.flush()
+        return True
+
+    def poll(self):
+        'Flushes if the oldest pending row has waited max_delay'
+        if self.pending and \
+           time.monotonic() - self.first_ts >= self.max_delay:
+            return self.flush()
+        return True
+
+    def flush(self):
+        if self.pending == 0:
+            return True
+        ok = self.db.write_batches(self.batches)
+        if ok:
+            self.written += self.pending
+        else:
+            self.attempts += 1
+            if self.attempts < self.retries:
+                # Keep the rows, poll() retries after max_delay
+                self.first_ts = time.monotonic()
+                return False
+            self.failed += self.pending
+            print_l('Giving up on {} rows after {} attempts'.format(
+                self.pending, self.attempts), logging.ERROR)
+            if self.on_failed is not None:
+                self.on_failed(self.batches)
+        self.attempts = 0
+        self.flushes += 1
+        self.batches = {}
+        self.pending = 0
+        return ok
+
+    def discard(self):
+        'Removes and returns the pending batches without writing them'
+        batches = self.batches
+        self.batches = {}
+        self.pending = 0
+        self.attempts = 0
+        return batches
+
+    def close(self):
+        '''Flushes what is pending, retrying a failing batch up to
+        retries times before it is handed to on_failed.'''
+        while True:
+            ok = self.flush()
+            if ok or self.pending == 0:
+                return ok
 
 
 def db_test():
@@ -165,6 +782,97 @@ def db_test():
     db.initialize(':memory:')
     db.summary()
     db.close()
+    test_migrate()
+    test_imbalance()
+
+def test_migrate():
+    'Migration merges into existing ticks and only drops checked tables'
+    rows = [OHLC(1517377333000 + i * 1000, 'MIG', 97.85 + i, 103.58,
+                 100.0, 111.85, 95.0, 115.75) for i in range(100)]
+    db = StockDB()
+    db.initialize(':memory:')
+    db.create_table('MIG', table_types.ohlc)
+    db.write_batches({('MIG', table_types.ohlc): rows})
+    db.create_tick_tables()
+    # A live run already captured part of the day
+    db.write_batches({('MIG', table_types.ticks): rows[:10]})
+    assert db.migrate_to_ticks(drop=True) == 90
+    assert 'MIG' not in db.tables
+    sid = db.symbol_id('MIG')
+    assert db.tick_count(sid) == 100
+    assert db.tick_times(sid) == {o.ts for o in rows}
+    assert db.migrate_to_ticks(drop=True) == 0
+    assert db.tick_count(sid) == 100
+    # Live ticks have ms, the legacy table only whole seconds
+    live = [OHLC(o.ts + 250, 'LIVE', o.ltp, o.atp, o.op, o.hi, o.lo, o.cl)
+            for o in rows[50:]]
+    db.write_batches({('LIVE', table_types.ticks): live})
+    legacy = [OHLC(o.ts, 'LIVE', o.ltp, o.atp, o.op, o.hi, o.lo, o.cl)
+              for o in rows[:60]]
+    db.create_table('LIVE', table_types.ohlc)
+    db.write_batches({('LIVE', table_types.ohlc): legacy})
+    assert db.migrate_to_ticks() == 50
+    assert db.migrate_to_ticks(drop=True) == 0
+    sid = db.symbol_id('LIVE')
+    assert db.tick_count(sid) == 100
+    assert 'LIVE' not in db.tables
+    db.close()
+    print('test_migrate passed')
+
+def test_imbalance():
+    'An empty book gives NaN imbalance, with or without numpy'
+    quotes = [{'timestamp': 1000,
+               'bids': [{'quantity': 30, 'price': 99.0, 'orders': 2}],
+               'asks': [{'quantity': 10, 'price': 101.0, 'orders': 1}]},
+              {'timestamp': 2000, 'bids': [], 'asks': []}]
+    db = StockDB()
+    db.initialize(':memory:')
+    db.create_tick_tables()
+    db.create_depth_table()
+    for q in quotes:
+        db.add_data('IMB', table_types.depth, q)
+    imb = db.get_imbalance('IMB')
+    assert list(imb['ts']) == [1000, 2000]
+    assert imb['imbalance'][0] == 0.5
+    assert imb['imbalance'][1] != imb['imbalance'][1]
+    db.close()
+    print('test_imbalance passed')
+
+def db_bench(n=100000):
+    'Compares per-row add_data against TickWriter on a scratch DB'
+    import os
+    import tempfile
+    rows = [OHLC(1517377333560 + i, 'BENCH', 97.85, 103.58,
+                 100.0, 111.85, 95.0, 115.75) for i in range(n)]
+    path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    db = StockDB()
+    db.initialize(path)
+    db.create_table('BENCH', table_types.ohlc)
+    count = min(n, 2000)
+    t = time.perf_counter()
+    for o in rows[:count]:
+        db.add_data('BENCH', table_types.ohlc, o)
+    t = time.perf_counter() - t
+    print('add_data:   {:>10.0f} ticks/s'.format(count / t))
+    writer = TickWriter(db)
+    t = time.perf_counter()
+    for o in rows:
+        writer.add('BENCH', table_types.ohlc, o)
+    writer.close()
+    t = time.perf_counter() - t
+    print('TickWriter: {:>10.0f} ticks/s'.format(n / t))
+    db.close()
+
 
 if __name__ == '__main__':
-    db_test()
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        db_bench()
+    elif len(sys.argv) > 2 and sys.argv[1] == 'migrate':
+        # python stockdb.py migrate stock_db.sqlite [drop]
+        db = StockDB()
+        db.initialize(sys.argv[2])
+        db.migrate_to_ticks(drop='drop' in sys.argv[3:])
+        db.close()
+    else:
+        db_test()
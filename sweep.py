@@ -0,0 +1,211 @@
+'''Parameter sweep of GannAngles over stored ticks.
+
+Each symbol's ts/ltp arrays are written once to .npy files; worker
+processes memory-map them instead of receiving pickled copies, and run
+backtest.gann_fast() for every day and parameter combination.
+
+    python sweep.py stock_db.sqlite NIFTY18FEB11200CE NIFTY18FEB11000PE
+'''
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from itertools import product
+import os
+import tempfile
+from backtest import day_bounds, gann_fast, summarize
+from gann import GannAngles
+from utils import DATE
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Per process cache of memory-mapped arrays, keyed by file path
+_mapped = {}
+
+
+def grid(trigger_idx=(2, 3, 4), price_idx=(3, 4, 5), support_idx=(4, 5, 6),
+         target_idx=(-1, -2, -3), quantity=(GannAngles.quantity,)):
+    '''Parameter dicts for every usable combination.
+
+    Combinations where the order price is below the trigger or the target
+    is not above the order price are skipped.'''
+    n = len(GannAngles.gann_angles)
+    params = []
+    for t, p, s, g, q in product(trigger_idx, price_idx, support_idx,
+                                 target_idx, quantity):
+        if p < t or g % n <= p:
+            continue
+        params.append({'trigger_idx': t, 'price_idx': p, 'support_idx': s,
+                       'target_idx': g, 'quantity': q})
+    return params
+
+
+def export_ticks(db, symbols, workdir, start=None, end=None):
+    'Writes ts/ltp .npy files per symbol, returns {symbol: (ts, ltp) paths}'
+    paths = {}
+    for sym in symbols:
+        ticks = db.get_ticks(sym, start, end, fields=('ts', 'ltp'))
+        if len(ticks['ts']) == 0:
+            print('No ticks for', sym)
+            continue
+        ts_path = os.path.join(workdir, '{}-ts.npy'.format(sym))
+        ltp_path = os.path.join(workdir, '{}-ltp.npy'.format(sym))
+        np.save(ts_path, np.asarray(ticks['ts'], dtype=np.int64))
+        np.save(ltp_path, np.asarray(ticks['ltp'], dtype=np.float64))
+        paths[sym] = (ts_path, ltp_path)
+    return paths
+
+
+def _load(path):
+    arr = _mapped.get(path)
+    if arr is None:
+        arr = _mapped[path] = np.load(path, mmap_mode='r')
+    return arr
+
+
+def run_job(job):
+    '''Worker: backtests one symbol over every day for a list of params.
+
+    Returns [(symbol, params, summary), ...].'''
+    sym, ts_path, ltp_path, param_list = job
+    ts = _load(ts_path)
+    ltp = _load(ltp_path)
+    days = day_bounds(ts)
+    results = []
+    for params in param_list:
+        trades = []
+        for day, a, b in days:
+            trade = gann_fast(sym, ts[a:b], ltp[a:b], **params)
+            if trade is not None:
+                trades.append(trade)
+        results.append((sym, params, summarize(trades)))
+    return results
+
+
+def sweep(db, symbols, params=None, start=None, end=None, workers=None,
+          chunk=16):
+    '''Runs every param combination for every symbol in a process pool.
+
+    Returns rows ranked by total pnl across symbols:
+    [{'rank', params..., 'symbols', 'trades', 'pnl', 'win_rate'}, ...]
+    '''
+    if np is None:
+        raise ImportError('sweep requires numpy')
+    if params is None:
+        params = grid()
+    with tempfile.TemporaryDirectory() as workdir:
+        paths = export_ticks(db, symbols, workdir, start, end)
+        jobs = []
+        for sym, (ts_path, ltp_path) in paths.items():
+            for i in range(0, len(params), chunk):
+                jobs.append((sym, ts_path, ltp_path, params[i:i + chunk]))
+        totals = {}
+        with ProcessPoolExecutor(workers) as pool:
+            for results in pool.map(run_job, jobs):
+                for sym, p, summary in results:
+                    key = tuple(sorted(p.items()))
+                    row = totals.get(key)
+                    if row is None:
+                        row = totals[key] = dict(p, symbols=0, trades=0,
+                                                 pnl=0.0, wins=0.0)
+                    row['symbols'] += 1
+                    row['trades'] += summary['trades']
+                    row['pnl'] += summary['pnl']
+                    row['wins'] += summary['win_rate'] * summary['trades']
+    rows = sorted(totals.values(), key=lambda r: r['pnl'], reverse=True)
+    for rank, row in enumerate(rows, 1):
+        wins = row.pop('wins')
+        row['win_rate'] = wins / row['trades'] if row['trades'] else 0.0
+        row['rank'] = rank
+    return rows
+
+
+def write_results(rows, filename=None):
+    if filename is None:
+        filename = 'sweep{}.csv'.format(DATE)
+    fields = ['rank', 'trigger_idx', 'price_idx', 'support_idx',
+              'target_idx', 'quantity', 'symbols', 'trades', 'pnl',
+              'win_rate']
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    return filename
+
+
+def main():
+    from stockdb import StockDB
+    parser = argparse.ArgumentParser(description='GannAngles parameter sweep')
+    parser.add_argument('db', help='StockDB file with a ticks table')
+    parser.add_argument('symbols', nargs='+')
+    parser.add_argument('--start', type=int, help='epoch ms')
+    parser.add_argument('--end', type=int, help='epoch ms')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--out', help='results csv')
+    args = parser.parse_args()
+
+    db = StockDB()
+    db.initialize(args.db)
+    rows = sweep(db, args.symbols, start=args.start, end=args.end,
+                 workers=args.workers)
+    db.close()
+    print('Wrote', write_results(rows, args.out))
+    for row in rows[:10]:
+        print(row)
+
+
+def test_sweep():
+    'Pool results match serial run_job over the exported .npy files'
+    if np is None:
+        print('test_sweep skipped, sweep requires numpy')
+        return
+    import random
+    from datetime import datetime
+    from ohlc import OHLC
+    from stockdb import StockDB, table_types
+    params = grid()
+    n = len(GannAngles.gann_angles)
+    assert params and all(p['price_idx'] >= p['trigger_idx'] and
+                          p['target_idx'] % n > p['price_idx']
+                          for p in params)
+    params = params[:2]
+    symbol = 'SWP18FEB100CE'
+    random.seed(3)
+    rows = []
+    for day in (1, 2):
+        t0 = int(datetime(2018, 2, day, 9, 16).timestamp() * 1000)
+        ltp = 100.0
+        for i in range(300):
+            ltp = max(1.0, ltp + random.gauss(0, 0.5))
+            rows.append(OHLC(t0 + i * 1000, symbol, ltp, ltp, ltp, ltp, ltp,
+                             ltp))
+    db = StockDB()
+    db.initialize(':memory:')
+    db.create_tick_tables()
+    db.write_batches({(symbol, table_types.ticks): rows})
+    with tempfile.TemporaryDirectory() as workdir:
+        ts_path, ltp_path = export_ticks(db, [symbol], workdir)[symbol]
+        assert list(np.load(ts_path, mmap_mode='r')) == [o.ts for o in rows]
+        assert list(np.load(ltp_path, mmap_mode='r')) == \
+            [o.ltp for o in rows]
+        serial = run_job((symbol, ts_path, ltp_path, params))
+    ranked = sweep(db, [symbol], params, workers=2, chunk=1)
+    db.close()
+    assert len(ranked) == 2 and serial[0][2]['trades'] > 0
+    for sym, p, summary in serial:
+        row = [r for r in ranked
+               if all(r[k] == v for k, v in p.items())][0]
+        assert (row['symbols'], row['trades']) == (1, summary['trades'])
+        assert abs(row['pnl'] - summary['pnl']) < 1e-9
+    print('test_sweep passed')
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        main()
+    else:
+        test_sweep()
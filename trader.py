@@ -1,35 +1,164 @@
+from bars import BarBuilder
+from chain import ChainSubscriber, ChainWindow, BATCH_SIZE, INDEX_SYMBOLS
 from datetime import datetime, date
+from depth import DEPTH_LEVELS
+from dispatch import Dispatcher, Overflow
 from gann import GannAngles
+from gateway import OrderGateway
+from instruments import InstrumentRegistry
 from ohlc import OHLC
 import pickle
 from requests.exceptions import HTTPError
-from stockdb import StockDB, table_types
+from persist import PersistWorker, PersistPolicy
+from stockdb import table_types
+import logging
 import time
 import threading
 from upstox_api.api import *
-from utils import print_l, print_s, Actions, is_trade_active
+from utils import print_l, print_s, Actions, QuoteBatch, is_trade_active
+from utils import parse_symbol
+from utils import init_logging, close_logging, log_enabled
 
 
 class TradeCenter:
     def __init__(self, config=None):
+        self.config = config
+        self.init_logging()
         print_l("Initializing...")
+        if config is None:
+            print_s()
+            print_l('No config provided. Will be unable to sign in.')
+
         self.client = None
-        self.condition = threading.Condition()
         self.indices = ['NSE_FO']
         self.stock_dict = {}
         self.listening = False
         self.trading = False
-        # init db in listen() for thread compatibility
-        self.db = None
+        # Set once listen() is ready to drain the dispatch queues
+        self.ready = threading.Event()
+        # Stop listening outside market hours; off for offline replays
+        self.check_session = True
+        # Tick storage runs on its own thread with its own db connection
+        self.persist = None
+        # 'sqlite' for StockDB, 'journal' for per-day binary tick journals
+        self.storage = self.setting('storage', 'sqlite')
+        if self.storage == 'journal':
+            self.db_file = self.setting('journal_dir', 'journal')
+        else:
+            self.db_file = self.setting('db_file', 'stock_db.sqlite')
+        # 'ohlc' keeps one table per symbol, 'ticks' the normalized table
+        self.table_type = table_types[self.setting('db_schema', 'ohlc')]
+        # Bar lengths in seconds, closed bars go to subscribers and the db
+        res = self.setting('bar_resolutions', '1,60,300')
+        self.bars = BarBuilder(int(r) for r in res.split(',') if r)
+        if self.storage == 'sqlite':
+            # Journals only hold ticks
+            self.bars.subscribe(self.store_bar)
+
+        # Only the latest pending quote per symbol reaches the strategies
+        self.coalesce_quotes = self.setting('coalesce_quotes', False)
+        # With coalescing on, still store every tick rather than the latest
+        self.store_all_ticks = self.setting('store_all_ticks', True)
+        # Bounded quote/order/trade buffers fed by the websocket handlers.
+        # When every tick must be stored, a full buffer holds up the
+        # websocket thread instead of dropping ticks.
+        policy = getattr(Overflow, self.setting(
+            'queue_overflow',
+            'block' if self.store_all_ticks else 'drop_oldest'))
+        self.dispatch = Dispatcher(self.setting('queue_size', 4096), policy,
+                                   self.setting('queue_batch', 512))
+        self.listener = None
+        # Order book rows (top depth_levels bids/asks, OI, volume) per tick
+        self.capture_depth = self.setting('capture_depth', False) and \
+                             self.storage == 'sqlite'
+        self.depth_levels = self.setting('depth_levels', DEPTH_LEVELS)
+        # Per symbol csv tick logs, written by the persistence thread
+        self.csv_log = self.setting('csv_log', False)
+        # Strategies see only the latest quote per symbol per drain cycle,
+        # through one TradeStrategy.on_quotes() call per strategy class
+        self.batch_quotes = self.setting('batch_quotes', False)
+        # Master contracts, downloaded once a day and snapshotted to disk
+        self.instruments = InstrumentRegistry(
+            self.setting('instrument_snapshot', 'instruments.sqlite'))
+        # Live feed subscriptions, made in batches
+        self.subscriptions = ChainSubscriber(
+            batch_size=self.setting('subscribe_batch', BATCH_SIZE))
+        # (underlying, expiry) -> ChainWindow followed by subscribe_chain
+        self.chains = {}
+        self.chain_width = self.setting('chain_width', 5)
+        # Strike steps past the half-way point before a chain moves
+        self.chain_hysteresis = self.setting('chain_hysteresis', 0.25)
+        # underlying -> last spot_price seen in its quotes
+        self.spot = {}
+        # Orders go through a rate limited worker pool instead of being
+        # placed inline on the listener
+        self.gateway = None
+        if self.setting('order_gateway', False):
+            self.gateway = OrderGateway(
+                self.send_order, self.order_handler,
+                self.setting('order_workers', 4),
+                self.setting('order_rate', 10.0),
+                self.setting('order_burst', 10),
+                self.setting('order_queue', 256))
+
+
+    def init_logging(self, level=None):
+        '''Starts the background log writer.
+
+        level defaults to the log_level setting (DEBUG, INFO, WARNING...).'''
+        if level is None:
+            level = getattr(logging, self.setting('log_level', 'INFO').upper())
+        init_logging(level, self.setting('log_console', True))
+
+
+    def setting(self, key, default=None):
+        'Returns config[key] cast to the type of default, or default'
+        if self.config is None or key not in self.config:
+            return default
+        val = self.config[key]
+        if isinstance(default, bool):
+            return val.strip().lower() in ('1', 'true', 'yes', 'on')
+        if default is not None:
+            return type(default)(val)
+        return val
+
+
+    @property
+    def queue_depth(self):
+        'Pending messages per stream'
+        return {'quotes': len(self.dispatch.quotes),
+                'orders': len(self.dispatch.orders),
+                'trades': len(self.dispatch.trades)}
+
+
+    @property
+    def latency(self):
+        'Queue-to-processed latency of every dispatched message'
+        return self.dispatch.latency
+
+
+    @property
+    def coalesced(self):
+        'Quotes skipped by strategies because a newer one was pending'
+        return self.dispatch.coalesced
+
+
+    @property
+    def persist_lag(self):
+        'Time from a tick being queued for storage to its commit'
+        if self.persist is None:
+            return None
+        return self.persist.lag
 
-        if config is None:
-            print_s()
-            print_l('No config provided. Will be unable to sign in.')
-        self.config = config
 
-        self.quote_queue = []
-        self.trade_queue = []
-        self.order_queue = []
+    def dispatch_stats(self):
+        stats = self.dispatch.stats()
+        if self.persist is not None:
+            stats['persist'] = self.persist.stats()
+        stats['subscribe'] = self.subscriptions.stats()
+        if self.gateway is not None:
+            stats['gateway'] = self.gateway.stats()
+        return stats
 
 
     def run(self, offline=False):
@@ -53,11 +182,14 @@ class TradeCenter:
             print_l('Error while starting websocket - ')
             print_l(e.args[0])
 
-        listener = threading.Thread(target=self.listen)
+        if self.gateway is not None:
+            self.gateway.start()
+        self.listener = threading.Thread(target=self.listen)
         try:
-            listener.start()
             self.listening = True
+            self.listener.start()
         except Exception as e:
+            self.listening = False
             print_s()
             print_l('Unexpected error')
             print_l(e)
@@ -68,44 +200,138 @@ class TradeCenter:
         'Checks update queues and calls the required update method'
         # Extra sleep so main thread can finish print statements
         time.sleep(1.0)
-        # DB init here for thread compatibility.
-        self.db = StockDB()
-        self.db.initialize('stock_db.sqlite')
-        for key in self.stock_dict:
-            if self.db.create_table(key, table_types.ohlc):
-                print_l('Table verified for: ' + str(key))
+        self.start_persist()
         print_l('Receiving updates...')
-        while self.listening:
-            try:
-                with self.condition:
-                    self.condition.wait()
-                if len(self.quote_queue) > 0:
-                    for q in self.quote_queue:
-                        o = OHLC.fromquote(q)
-                        self.db.add_data(q['symbol'], table_types.ohlc, o)
-                        self.quote_update(q)
-                        self.quote_queue.remove(q)
-
-                if len(self.order_queue) > 0:
-                    self.order_update(self.order_queue.pop())
-                if len(self.trade_queue) > 0:
-                    self.trade_update(self.trade_queue.pop())
-                time.sleep(0.2)
-            except KeyboardInterrupt as e:
-                self.listening = False
-            if not is_trade_active():
-                self.listening = False
+        self.ready.set()
+        dispatch = self.dispatch
+        batch = dispatch.batch_size
+        try:
+            while self.listening:
+                try:
+                    dispatch.wait(1.0)
+                    entries, latest = self.take_quotes(batch)
+                    if self.batch_quotes:
+                        self.evaluate([entry[1] for entry in latest])
+                    else:
+                        for entry in latest:
+                            self.quote_update(entry[1])
+                    if self.chains:
+                        self.track_spot([entry[1] for entry in latest])
+                    self.finish_quotes(entries)
+                    self.process_updates(batch)
+                except KeyboardInterrupt as e:
+                    self.listening = False
+                if self.check_session and not is_trade_active():
+                    self.listening = False
+        finally:
+            self.listening = False
+            self.dispatch.close()
+            self.ready.clear()
+            self.report_drops()
+            # Flush queued ticks on shutdown, close_ops() waits for this
+            self.bars.flush()
+            if self.persist is not None:
+                self.persist.stop()
 #        else:
 #            self.close_ops()
 
 
+    def settled(self):
+        '''True when every dispatched message has been processed and no
+        order call is pending. Used to replay ticks in lockstep.'''
+        if self.gateway is not None and not self.gateway.idle():
+            return False
+        return self.dispatch.idle()
+
+
+    def report_drops(self):
+        'Logs quotes lost to a full dispatch buffer'
+        stats = self.dispatch.quotes.stats()
+        if stats['dropped']:
+            print_l('{} of {} quotes dropped by the full quote buffer'.format(
+                stats['dropped'], stats['received']), logging.WARNING,
+                policy=Overflow._fields[self.dispatch.quotes.policy])
+
+
+    def start_persist(self):
+        'Starts the tick storage thread'
+        self.persist = PersistWorker(
+            self.db_file,
+            self.setting('persist_queue', 100000),
+            getattr(PersistPolicy, self.setting('persist_policy', 'spill')),
+            self.setting('db_batch_rows', 2000),
+            self.setting('db_batch_delay', 0.5),
+            self.setting('db_synchronous', 'NORMAL'),
+            self.depth_levels,
+            self.storage,
+            self.csv_log)
+        self.persist.start()
+
+
+    def take_quotes(self, batch):
+        '''Drains up to batch quotes and queues them for storage.
+
+        Returns (entries, latest): every drained entry, and the entries
+        strategies should see, one per symbol when coalescing.'''
+        dispatch = self.dispatch
+        entries = dispatch.quotes.drain(batch)
+        if self.coalesce_quotes:
+            latest = dispatch.coalesce(entries)
+            stored = entries if self.store_all_ticks else latest
+        else:
+            latest = stored = entries
+        for entry in stored:
+            q = entry[1]
+            o = OHLC.fromquote(q)
+            self.persist.put(q['symbol'], self.table_type, o)
+            if self.capture_depth:
+                self.persist.put(q['symbol'], table_types.depth, q)
+        if self.batch_quotes and not self.coalesce_quotes:
+            latest = dispatch.coalesce(entries)
+        return entries, latest
+
+
+    def finish_quotes(self, entries):
+        'Feeds processed quotes to the bar builder and records latency'
+        dispatch = self.dispatch
+        for entry in entries:
+            self.bars.update_quote(entry[1])
+            dispatch.done(entry)
+
+
+    def process_updates(self, batch):
+        'Drains pending order and trade updates'
+        dispatch = self.dispatch
+        for entry in dispatch.orders.drain(batch):
+            self.order_update(entry[1])
+            dispatch.done(entry)
+        for entry in dispatch.trades.drain(batch):
+            self.trade_update(entry[1])
+            dispatch.done(entry)
+
+
+    def store_bar(self, bar):
+        'BarBuilder subscriber that queues closed bars for storage'
+        if self.persist is not None:
+            self.persist.put(bar.symbol, table_types.bars, bar)
+
+
     def register_masters(self, masters=["nse_fo", 'nse_index']):
-        'Boilerplate for adding exchanges to enable stock data subscriptions'
+        '''Boilerplate for adding exchanges to enable stock data subscriptions
+
+        Uses today's instrument snapshot if there is one, otherwise
+        downloads the master contracts and saves them.'''
         try:
             print_s()
             print_l("Registering Indices")
-            for ind in masters:
-                print(len(self.client.get_master_contract(ind)))
+            count = self.instruments.load(self.client, masters)
+            print_l('{} instruments'.format(count))
+            if not self.instruments.install(self.client):
+                # Client keeps its own tables, let it load them the usual way
+                for ind in masters:
+                    print_l('{} instruments'.format(
+                        len(self.client.get_master_contract(ind))),
+                        exchange=ind)
         except AttributeError:
             print_l("Masters preloaded/no valid masters provided")
         except HTTPError as e:
@@ -129,17 +355,166 @@ class TradeCenter:
 
 
     def register_stocks(self, sym=None):
-        '''Subscribes to stocks for live feed.'''
-        inst = None
-        try:
-            inst = self.client.get_instrument_by_symbol('NSE_FO', sym)
-        except Exception as e:
-            print(e)
-        try:
-            self.client.subscribe(inst, LiveFeedType.Full)
-        except Exception as e:
-            print(e)
-        self.stock_dict[sym.upper()] = GannAngles(inst)
+        '''Subscribes to stocks for live feed.
+
+        sym is a symbol or a list of them, subscribed in batches. Returns
+        the instruments that are subscribed.'''
+        symbols = [sym] if isinstance(sym, str) else list(sym)
+        insts = []
+        for sym, inst in zip(symbols,
+                             self.instruments.get_many('NSE_FO', symbols)):
+            if inst is None:
+                try:
+                    inst = self.client.get_instrument_by_symbol('NSE_FO', sym)
+                except Exception as e:
+                    print(e)
+            if inst is None:
+                print_l('Unknown instrument', symbol=sym)
+                continue
+            insts.append(inst)
+        new = self.add_strategies(insts)
+        self.subscriptions.subscribe(self.client, insts)
+        return self.keep_subscribed(insts, new)
+
+
+    def add_strategies(self, insts):
+        '''Adds strategies for insts before they are subscribed, so the
+        first quotes are not dropped. Returns the instruments added.'''
+        new = []
+        for inst in insts:
+            if inst.symbol.upper() not in self.stock_dict:
+                self.stock_dict[inst.symbol.upper()] = GannAngles(inst)
+                new.append(inst)
+        return new
+
+
+    def keep_subscribed(self, insts, new):
+        '''Drops the strategies in new whose subscription failed. Returns
+        the instruments of insts that are subscribed.'''
+        for inst in new:
+            if inst.symbol.upper() not in self.subscriptions:
+                self.stock_dict.pop(inst.symbol.upper()).close()
+        return [inst for inst in insts
+                if inst.symbol.upper() in self.subscriptions]
+
+
+    def unregister_stocks(self, symbols):
+        '''Unsubscribes symbols and drops their strategies, keeping those
+        with orders in flight. Returns the symbols dropped.'''
+        insts = self.releasable(symbols)
+        return self.drop_strategies(
+            self.subscriptions.unsubscribe(self.client, insts))
+
+
+    def releasable(self, symbols):
+        'Instruments of symbols whose strategies have no open orders'
+        insts = []
+        for sym in symbols:
+            stock = self.stock_dict.get(sym.upper())
+            if stock is None or stock.busy():
+                continue
+            insts.append(stock.instrument)
+        return insts
+
+
+    def drop_strategies(self, insts):
+        'Drops the strategies of unsubscribed insts, returns their symbols'
+        dropped = []
+        for inst in insts:
+            stock = self.stock_dict.pop(inst.symbol.upper(), None)
+            if stock is not None:
+                stock.close()
+            dropped.append(inst.symbol.upper())
+        return dropped
+
+
+    def spot_price(self, underlying):
+        'Last traded price of the index of an F&O underlying'
+        underlying = underlying.upper()
+        symbol = INDEX_SYMBOLS.get(underlying, underlying)
+        inst = self.instruments.get('NSE_INDEX', symbol)
+        if inst is None:
+            inst = self.client.get_instrument_by_symbol('NSE_INDEX', symbol)
+        return float(self.client.get_live_feed(inst, LiveFeedType.LTP)['ltp'])
+
+
+    def subscribe_chain(self, underlying, expiry, width=None, spot=None,
+                        kinds=('CE', 'PE')):
+        '''Follows the option chain of underlying and expiry, width strikes
+        either side of the money. Returns the instruments subscribed.'''
+        key = (underlying.upper(), expiry.upper())
+        if width is None:
+            width = self.chain_width
+        self.chains[key] = ChainWindow(self.instruments, underlying, expiry,
+                                       width, kinds, self.chain_hysteresis)
+        return self.rebalance_chain(underlying, expiry, spot)[0]
+
+
+    def track_spot(self, messages):
+        '''Follows spot_price in quotes and moves chains whose spot left
+        the hysteresis band. Returns the number of chains moved.'''
+        keys = self.chains_to_move(messages)
+        for underlying, expiry in keys:
+            self.rebalance_chain(underlying, expiry, self.spot[underlying])
+        return len(keys)
+
+
+    def chains_to_move(self, messages):
+        '''Records the spot_price of quotes. Returns the (underlying,
+        expiry) keys of chains whose spot left the hysteresis band.'''
+        moved = set()
+        for message in messages:
+            spot = message.get('spot_price')
+            if not spot:
+                continue
+            underlying = parse_symbol(message['symbol']).underlying
+            self.spot[underlying] = float(spot)
+            moved.add(underlying)
+        return [(underlying, expiry)
+                for (underlying, expiry), window in list(self.chains.items())
+                if underlying in moved and
+                window.should_move(self.spot[underlying])]
+
+
+    def rebalance_chain(self, underlying, expiry, spot=None):
+        '''Moves a followed chain to the strikes around spot (the index
+        price if not given). Returns (instruments added, symbols dropped).'''
+        window = self.chains[(underlying.upper(), expiry.upper())]
+        if spot is None:
+            spot = self.spot_price(underlying)
+        start = time.perf_counter()
+        entering, leaving = window.move(spot)
+        added = self.register_stocks([inst.symbol for inst in entering])
+        dropped = self.unregister_stocks(leaving)
+        self.hold_chain(window, leaving, dropped)
+        self.log_rebalance(window, start, entering, leaving, added, dropped)
+        return added, dropped
+
+
+    def log_rebalance(self, window, start, entering, leaving, added,
+                      dropped):
+        if entering or leaving:
+            print_l('Chain rebalanced in {:.3f}s'.format(
+                time.perf_counter() - start), underlying=window.underlying,
+                expiry=window.expiry, atm=window.atm, added=len(added),
+                dropped=len(dropped))
+
+
+    def hold_chain(self, window, leaving, dropped):
+        'Keeps symbols that left window but are still subscribed as held'
+        dropped = set(dropped)
+        window.held = {sym for sym in leaving
+                       if sym not in dropped and sym in self.stock_dict}
+
+
+    def release_chains(self, sym):
+        '''Unsubscribes sym if a chain holds it for an order that has
+        closed. Called after every order update.'''
+        for window in self.chains.values():
+            if sym in window.held:
+                leaving = sorted(window.held)
+                self.hold_chain(window, leaving,
+                                self.unregister_stocks(leaving))
 
 
     def quote_handler(self, message):
@@ -147,9 +522,7 @@ class TradeCenter:
         
         This handler runs on the Upstox websocket thread.
         '''
-        with self.condition:
-            self.quote_queue.append(message)
-            self.condition.notify_all()
+        self.dispatch.put_quote(message)
 
 
     def order_handler(self, message):
@@ -157,18 +530,14 @@ class TradeCenter:
         
         This handler runs on the Upstox websocket thread.
         '''
-        with self.condition:
-            self.order_queue.append(message)
-            self.condition.notify_all()
+        self.dispatch.put_order(message)
 
     def trade_handler(self, message):
         '''Addes message to queue for processing.
         
         This handler runs on the Upstox websocket thread.
         '''
-        with self.condition:
-            self.trade_queue.append(message)
-            self.condition.notify_all()
+        self.dispatch.put_trade(message)
 
 
     def quote_update(self, message):
@@ -200,30 +569,61 @@ class TradeCenter:
         'atp': 103.58}
         '''
 
-        sym = message['symbol']
+        sym = message['symbol'].upper()
 
         try:
-            action, args = self.stock_dict[sym].quote_update(message)
+            strategy = self.stock_dict[sym]
         except KeyError:
-            print('Update for unsubscribed stock/symbol, unsubscribing')
-            self.client.unsubscribe(quote_update['instrument'],
-                                    LiveFeedType.Full)
+            self.drop_symbol(message)
+            return
+        action, args = strategy.quote_update(message)
+        self.execute(sym, action, args)
+
+
+    def evaluate(self, messages):
+        '''Runs the latest quote of every symbol through the strategies,
+        one on_quotes() call per strategy class.'''
+        groups = {}
+        for message in messages:
+            strategy = self.stock_dict.get(message['symbol'].upper())
+            if strategy is None:
+                self.drop_symbol(message)
+                continue
+            groups.setdefault(type(strategy), []).append(message)
+        for cls, quotes in groups.items():
+            for sym, action, args in cls.on_quotes(QuoteBatch(quotes),
+                                                   self.stock_dict):
+                self.execute(sym, action, args)
+
+
+    def drop_symbol(self, message):
+        print_l('Update for unsubscribed stock/symbol, unsubscribing',
+                symbol=message.get('symbol'))
+        try:
+            self.client.unsubscribe(message['instrument'], LiveFeedType.Full)
+        except Exception as e:
+            print_l('Unsubscribe failed', logging.WARNING,
+                    symbol=message.get('symbol'), error=str(e))
 
+
+    def execute(self, sym, action, args):
+        '''Places or modifies orders for an action returned by a strategy'''
         order = ''
         if action == Actions.buy and args is not None:
-            print_l('')
-            print_s('OUT')
-            print_l('Placing order:')
-            print_l('Instrument:    {}'.format(args[1].symbol))
-            print_l('Order Price:   {}'.format(args[5]))
-            print_l('Trigger price: {}'.format(args[6]))
-            print_l('Sell Target:   {}'.format(args[5] + args[10]))
-            print_l('Stoploss:      {}'.format(args[5] - args[9]))
-            print_l('Quantity:      {}'.format(args[2]))
-            print_s('OUT')
-            print_l('')
-
-            if self.trading:
+            if log_enabled():
+                print_s('OUT')
+                print_l('Placing order',
+                        instrument=args[1].symbol,
+                        price=args[5],
+                        trigger=args[6],
+                        target=args[5] + args[10],
+                        stoploss=args[5] - args[9],
+                        quantity=args[2])
+                print_s('OUT')
+
+            if self.trading and self.gateway is not None:
+                self.gateway.submit(sym, action, args)
+            elif self.trading:
                 try:
                     order = self.client.place_order(*args)
                 except Exception as e:
@@ -237,6 +637,9 @@ class TradeCenter:
             print_s('OUT')
             print_l("{} - modifying stoploss order".format(sym))
             print_l("order_id = {}".format(args[0]))
+            if self.gateway is not None:
+                self.gateway.submit(sym, action, args)
+                return order
             try:
                 order = self.client.modify_order(order_id=args[0],
                                                  trigger_price=args[1])
@@ -252,6 +655,15 @@ class TradeCenter:
                 print_l('Object of type - {}.'.format(type(order)))
                 print_l(order)
                 print_s('IN')
+        return order
+
+
+    def send_order(self, action, args):
+        'OrderGateway worker call, runs on a gateway thread'
+        if action == Actions.buy:
+            return self.client.place_order(*args)
+        return self.client.modify_order(order_id=args[0],
+                                        trigger_price=args[1])
 
 
     def order_update(self, message):
@@ -268,6 +680,8 @@ class TradeCenter:
         except Exception as e:
             print_l("Unhandled Error in order_update:")
             print_l(e)
+        if self.chains:
+            self.release_chains(sym)
 
         print_s('IN')
 
@@ -286,9 +700,12 @@ class TradeCenter:
         except Exception as e:
             print("Error in trade_update_handler:")
             print(e)
+        if self.chains:
+            self.release_chains(sym)
         print_l('Trade info received:')
-        for key in message:
-            print_l(message[key])
+        if log_enabled(logging.DEBUG):
+            for key in message:
+                print_l(message[key], logging.DEBUG)
         print_s('IN')
 
 
@@ -418,14 +835,30 @@ class TradeCenter:
         return access_token
 
 
+    def stop_listener(self):
+        'Makes listen() return after the batch at hand'
+        self.listening = False
+        self.dispatch.wake()
+
+
+    def join_listener(self):
+        'Waits for listen() to flush storage and exit'
+        if self.listener is not None and \
+           self.listener is not threading.current_thread():
+            self.listener.join(5.0)
+
+
     def close_ops(self):
         'Unsubscribe from upstox scrips and closes other threads'
         print_s()
         print_l('Shutting Down')
-        for sym, stock in self.stock_dict.items():
-            self.client.unsubscribe(stock.instrument, LiveFeedType.Full)
+        self.subscriptions.unsubscribe_all(self.client)
+        # Before the listener stops, so it still sees the last reports
+        if self.gateway is not None:
+            self.gateway.stop()
+        # listen() flushes the persistence queue before it exits
+        self.stop_listener()
+        self.join_listener()
         print_l('Shut Down Complete.')
         print_s()
-        with self.condition:
-            self.listening = False
-            self.condition.notify_all()
+        close_logging()
@@ -1,6 +1,18 @@
+from array import array
 from datetime import datetime, date
-from collections import namedtuple
+from collections import deque, namedtuple
+import atexit
+import logging
+from logging.handlers import QueueHandler
+import queue
 import re
+import sys
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 DATE = date.today().strftime("%d%b%y")
 TIMEFMT = '%d%b%y-%H:%M:%S.%f'
@@ -18,26 +30,183 @@ CONFIG_TEXT = '''!This file is auto generated. Do not edit.
 Acts = namedtuple('Actions', 'none buy mod_target mod_sl')
 Actions = Acts(0, 1, 2, 3)
 
-def print_l(line):
-    global DATE
-    with open('log{}.txt'.format(DATE), 'a') as f:
-        formatted = '[{}] {}'.format(datetime.now(), line)
-        print(formatted)
-        formatted = formatted + '\n'
-        f.write(formatted)
+# Parts of an NSE F&O trading symbol, e.g. NIFTY18FEB11200CE
+Contract = namedtuple('Contract', 'underlying expiry strike kind')
+SYMBOL_RE = re.compile(r'^([A-Z&_-]+?)(\d{2}[A-Z]{3})(\d+(?:\.\d+)?)?(CE|PE|FUT)$')
+
+LOGGER = logging.getLogger('trader')
+LOGGER.setLevel(logging.INFO)
+LOG_WRITER = None
+# Arguments of the last init_logging(), reused if print_l restarts logging
+LOG_ARGS = None
+# Set at interpreter exit, after which records are dropped
+LOG_SHUTDOWN = False
+# Serializes starting and stopping the log writer
+LOG_LOCK = threading.RLock()
+
+
+class LogFormatter(logging.Formatter):
+    '''[local time] message key=value ...
+
+    Keyword fields passed to print_l are appended as key=value pairs.'''
+
+    def format(self, record):
+        line = '[{}] {}'.format(datetime.fromtimestamp(record.created),
+                                record.getMessage())
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join('{}={}'.format(k, v)
+                                   for k, v in fields.items())
+        return line
+
+
+class DailyFileHandler(logging.Handler):
+    '''Appends to log{%d%b%y}.txt, picking the file from each record's date.
+
+    Writes are buffered; the LogWriter flushes after every batch.'''
+
+    def __init__(self, pattern='log{}.txt'):
+        logging.Handler.__init__(self)
+        self.pattern = pattern
+        self.day = None
+        self.stream = None
+
+    def emit(self, record):
+        day = date.fromtimestamp(record.created)
+        if day != self.day:
+            if self.stream is not None:
+                self.stream.close()
+            self.day = day
+            self.stream = open(self.pattern.format(day.strftime('%d%b%y')),
+                               'a')
+        self.stream.write(self.format(record) + '\n')
+
+    def flush(self):
+        if self.stream is not None:
+            self.stream.flush()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        logging.Handler.close(self)
+
+
+class LogWriter(threading.Thread):
+    '''Background thread that takes records off a queue and hands them to
+    the real handlers in batches, flushing once per batch.'''
+
+    def __init__(self, handlers, batch=1000):
+        threading.Thread.__init__(self, name='LogWriter', daemon=True)
+        self.queue = queue.SimpleQueue()
+        self.handlers = handlers
+        self.batch = batch
+
+    def run(self):
+        running = True
+        while running:
+            records = [self.queue.get()]
+            try:
+                while len(records) < self.batch:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            for record in records:
+                if record is None:
+                    running = False
+                    continue
+                for h in self.handlers:
+                    if record.levelno >= h.level:
+                        h.handle(record)
+            for h in self.handlers:
+                h.flush()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+        for h in self.handlers:
+            h.close()
+
+
+def init_logging(level=logging.INFO, console=True, pattern='log{}.txt'):
+    '''Routes print_l through a LogWriter thread.
+
+    Calling it again replaces the previous setup, e.g. to change level.
+    print_l after close_logging() starts it again with the same arguments.'''
+    global LOG_WRITER, LOG_ARGS
+    with LOG_LOCK:
+        close_logging()
+        LOG_ARGS = (level, console, pattern)
+        formatter = LogFormatter()
+        handlers = [DailyFileHandler(pattern)]
+        if console:
+            handlers.append(logging.StreamHandler(sys.stdout))
+        for h in handlers:
+            h.setFormatter(formatter)
+        writer = LogWriter(handlers)
+        writer.start()
+        LOGGER.handlers = [QueueHandler(writer.queue)]
+        LOGGER.setLevel(level)
+        LOGGER.propagate = False
+        # Published last, print_l logs without the lock once it is set
+        LOG_WRITER = writer
+
+
+def close_logging():
+    'Flushes and stops the log writer thread'
+    global LOG_WRITER
+    with LOG_LOCK:
+        if LOG_WRITER is not None:
+            LOGGER.handlers = []
+            LOG_WRITER.stop()
+            LOG_WRITER = None
+
+def _shutdown_logging():
+    global LOG_SHUTDOWN
+    with LOG_LOCK:
+        LOG_SHUTDOWN = True
+        close_logging()
+
+atexit.register(_shutdown_logging)
+
+
+def log_enabled(level=logging.INFO):
+    'Lets hot paths skip building messages that would be filtered out'
+    return LOGGER.isEnabledFor(level)
 
-def print_s(spacer=''):
+
+def print_l(line, level=logging.INFO, **fields):
+    if not LOGGER.isEnabledFor(level):
+        return
+    if LOG_WRITER is None:
+        # Only one thread restarts logging, the others wait for it
+        with LOG_LOCK:
+            if LOG_SHUTDOWN:
+                return
+            if LOG_WRITER is None:
+                if LOG_ARGS is None:
+                    init_logging(LOGGER.level)
+                else:
+                    init_logging(*LOG_ARGS)
+    if fields:
+        LOGGER.log(level, line, extra={'fields': fields})
+    else:
+        LOGGER.log(level, line)
+
+def print_s(spacer='', level=logging.INFO):
     if spacer == 'IN':
-        print_l("<<<<<<<<<<<<<<")
+        print_l("<<<<<<<<<<<<<<", level)
     elif spacer == 'OUT':
-        print_l(">>>>>>>>>>>>>>")
+        print_l(">>>>>>>>>>>>>>", level)
     else:
-        print_l("=============================")
+        print_l("=============================", level)
 
 
 
-def is_trade_active():
-    now = datetime.now()
+def is_trade_active(now=None):
+    'True between 09:15 and 15:31 on the day of now (default: current time)'
+    if now is None:
+        now = datetime.now()
     start_time = datetime(year=now.year,
                             month=now.month,
                             day=now.day,
@@ -76,33 +245,195 @@ def load_config():
     return config
 
 
+class QuoteBatch():
+    '''Latest quote per symbol from one drain cycle, in columns.
+
+    symbols and quotes are lists, ltp (float) and ts (epoch ms) are numpy
+    arrays when numpy is installed, array.array otherwise.'''
+    __slots__ = ('symbols', 'quotes', 'ltp', 'ts')
+
+    def __init__(self, quotes=()):
+        self.quotes = list(quotes)
+        self.symbols = [q['symbol'].upper() for q in self.quotes]
+        ltp = [float(q['ltp']) for q in self.quotes]
+        ts = [int(q['timestamp']) for q in self.quotes]
+        if np is not None:
+            self.ltp = np.array(ltp, dtype=np.float64)
+            self.ts = np.array(ts, dtype=np.int64)
+        else:
+            self.ltp = array('d', ltp)
+            self.ts = array('q', ts)
+
+    def __len__(self):
+        return len(self.symbols)
+
+
 class TradeStrategy():
+    '''Per symbol strategy state.
+
+    Instances use __slots__ and keep only the last history order and trade
+    messages, so memory stays flat over a session with hundreds of
+    instruments. Subclasses declare __slots__ for their own state and keep
+    tunables as class attributes (see with_params).'''
+    __slots__ = ('instrument', 'orders', 'trades', 'start_time',
+                 'last_update', 'verbose')
+    history = 50
 
     def __init__(self, inst):
         self.instrument = inst
-        instrument = None
-        orders = []
-        trades = []
-        start_time = datetime.now()
-        last_update = None
-        verbose = False
+        self.orders = deque(maxlen=self.history)
+        self.trades = deque(maxlen=self.history)
+        self.start_time = datetime.now()
+        self.last_update = None
+        self.verbose = False
+
+    @classmethod
+    def with_params(cls, **params):
+        'Subclass with class attributes overridden, e.g. per backtest run'
+        if not params:
+            return cls
+        return type(cls.__name__, (cls,), dict(params, __slots__=()))
 
     def quote_update(self, quote_info):
         return Actions.none, None
 
+    @classmethod
+    def on_quotes(cls, batch, strategies):
+        '''Evaluates a QuoteBatch for many instances of this class at once.
+
+        strategies maps each symbol of the batch to its instance. Returns
+        [(symbol, action, args), ...] for every action other than none.
+        Calls quote_update per quote unless a subclass does better.'''
+        actions = []
+        for sym, quote in zip(batch.symbols, batch.quotes):
+            action, args = strategies[sym].quote_update(quote)
+            if action != Actions.none:
+                actions.append((sym, action, args))
+        return actions
+
     def order_update(self, order_info):
         return Actions.none, None
 
     def trade_update(self, trade_info):
         return Actions.none, None
 
+    def busy(self):
+        'True while orders of the strategy are open, it is not dropped then'
+        return False
+
+    def close(self):
+        'Called once the strategy is dropped, releases shared state'
+        pass
+
+
+class LatencyStats():
+    '''Running latency counters with a power-of-two histogram.
+
+    Samples are added in seconds; histogram buckets are in microseconds,
+    bucket i holding samples below 2**i us.'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+        self.buckets = [0] * 32
+
+    def add(self, secs):
+        self.count += 1
+        self.total += secs
+        self.last = secs
+        if secs > self.max:
+            self.max = secs
+        us = int(secs * 1000000)
+        self.buckets[min(us.bit_length(), 31)] += 1
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, pct):
+        'Upper bound in seconds of the bucket holding the pct-th sample'
+        if self.count == 0:
+            return 0.0
+        target = self.count * pct / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return min((1 << i) / 1000000, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean': self.mean,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'max': self.max,
+                'last': self.last}
+
 
 def round_off(num, div=0.1):
     x = div*round(num/div)
     return float(x)
 
+def parse_symbol(symbol):
+    '''Splits a trading symbol into a Contract.
+
+    NIFTY18FEB11200CE -> Contract('NIFTY', '18FEB', 11200.0, 'CE'),
+    NIFTY18FEBFUT -> Contract('NIFTY', '18FEB', None, 'FUT'). Anything else,
+    such as a cash or index symbol, is its own underlying with the other
+    fields None.
+    '''
+    symbol = symbol.upper()
+    m = SYMBOL_RE.match(symbol)
+    if m is None:
+        return Contract(symbol, None, None, None)
+    strike = m.group(3)
+    return Contract(m.group(1), m.group(2),
+                    float(strike) if strike else None, m.group(4))
+
 def test_utils():
+    assert parse_symbol('NIFTY18FEB11200CE') == \
+        Contract('NIFTY', '18FEB', 11200.0, 'CE')
+    assert parse_symbol('banknifty18feb25500pe').underlying == 'BANKNIFTY'
+    assert parse_symbol('NIFTY18FEBFUT').kind == 'FUT'
+    assert parse_symbol('NIFTY_50') == Contract('NIFTY_50', None, None, None)
     load_config()
+    test_logging()
+
+def test_logging():
+    'print_l after close_logging keeps the configured handlers'
+    import os
+    import tempfile
+    folder = tempfile.mkdtemp()
+    pattern = os.path.join(folder, 'test{}.log')
+    init_logging(logging.DEBUG, console=False, pattern=pattern)
+    close_logging()
+    threads = [threading.Thread(target=print_l, args=('restarted {}'.format(i),
+                                                      logging.DEBUG))
+               for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    handlers = LOG_WRITER.handlers
+    assert LOGGER.level == logging.DEBUG
+    assert [type(h) for h in handlers] == [DailyFileHandler]
+    assert handlers[0].pattern == pattern
+    close_logging()
+    # The file is named after the day each record was written
+    lines = []
+    for name in os.listdir(folder):
+        with open(os.path.join(folder, name)) as f:
+            lines.extend(f.read().splitlines())
+    assert sorted(line.split()[-1] for line in lines) == \
+        [str(i) for i in range(8)]
 
 if __name__ == '__main__':
     test_utils()